@@ -0,0 +1,599 @@
+"""
+bench
+~~~~~
+
+Benchmarks for pjisocial, run against a local stand-in for Graph API
+so they need no network, no Facebook app, and no OS secret store.
+
+Run them with::
+
+    python -m pjisocial.bench
+
+Results are compared with the stored baseline and the run fails if
+any benchmark got slower than the tolerance allows. Pass --save to
+store the results as the new baseline.
+
+Latencies in the baseline aren't stored in seconds, which would only
+mean something on the machine that saved them. Each run first times
+a fixed pure Python loop, and latencies are stored and compared as
+multiples of that time, so a baseline saved on one machine can be
+checked on another.
+"""
+import argparse
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from random import Random
+from threading import Thread
+from time import perf_counter, sleep
+from typing import Any, Callable, Iterator, Mapping, Optional, Sequence
+from urllib.parse import parse_qs, urlsplit
+
+from pjisocial import connect as cx
+from pjisocial import facebook as fb
+
+
+# Configuration.
+HOST = '127.0.0.1'
+ITERATIONS = 200
+WARMUP = 10
+TOLERANCE = 1.0
+MIN_P99_ITERATIONS = 100
+SCHEDULER_RATE = 1000
+CALIBRATION_LOOPS = 100_000
+CALIBRATION_REPEAT = 5
+BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'benchmarks',
+    'baseline.json'
+)
+
+
+# Public classes.
+class FakeGraph:
+    """A local stand-in for Graph API.
+
+    Access token calls return a new access token, other GET calls
+    return a page with one object, and POST calls to the root return
+    a successful response for each request in a batch. The server runs
+    in a background thread.
+
+    :param latency: (Optional.) The seconds to wait before each
+        response. The default is zero.
+    :param error_rate: (Optional.) The fraction of calls that fail
+        with a Graph API error. The default is zero.
+    :param error_status: (Optional.) The HTTP status of the failed
+        calls. The default is 500.
+    :param usage: (Optional.) The percentage reported in the
+        X-App-Usage header, which drives the rate limit scheduler.
+        The default is zero.
+    :param seed: (Optional.) The seed for choosing which calls fail.
+        The default is zero, so runs fail the same calls.
+    """
+    def __init__(self, latency: float = 0,
+                 error_rate: float = 0,
+                 error_status: int = 500,
+                 usage: float = 0,
+                 seed: int = 0) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.usage = usage
+        self.calls = 0
+        self._random = Random(seed)
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[Thread] = None
+
+    def __repr__(self) -> str:
+        return (f'FakeGraph(latency={self.latency}, '
+                f'error_rate={self.error_rate}, usage={self.usage})')
+
+    def __enter__(self) -> 'FakeGraph':
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    @property
+    def domain(self) -> str:
+        """The address of the server, used in place of DOMAIN."""
+        if self._server is None:
+            raise RuntimeError('The server is not running.')
+        return f'{HOST}:{self._server.server_port}'
+
+    # Public methods.
+    def respond(self, method: str, path: str,
+                query: Mapping[str, Any]) -> tuple[int, Any]:
+        """Return the status and body for a call."""
+        self.calls += 1
+        if self.latency:
+            sleep(self.latency)
+        if self.error_rate and self._random.random() < self.error_rate:
+            error = {
+                'message': 'An unexpected error has occurred.',
+                'type': 'OAuthException',
+                'code': 2,
+            }
+            return self.error_status, {'error': error, }
+
+        if path.endswith('/oauth/access_token'):
+            return 200, {
+                'access_token': f'token{self.calls}',
+                'token_type': 'bearer',
+                'expires_in': 5183944,
+            }
+        if method == 'POST':
+            batch = json.loads(query.get('batch', ['[]'])[0])
+            return 200, [{'code': 200, 'body': '{"id": "1"}'} for _ in batch]
+        return 200, {'data': [{'id': '1'}, ], 'paging': {}}
+
+    def start(self) -> None:
+        """Start the server on a free port."""
+        if self._server is not None:
+            return
+        self._server = ThreadingHTTPServer((HOST, 0), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = Thread(
+            target=self._server.serve_forever,
+            name='pjisocial_fake_graph',
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the server."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+        self._server = None
+        self._thread = None
+
+
+class Result:
+    """The timings from a benchmark.
+
+    :param name: The name of the benchmark.
+    :param latencies: The seconds each call took.
+    :param elapsed: The seconds the whole run took.
+    :param errors: (Optional.) The number of calls that failed. The
+        default is zero.
+    """
+    def __init__(self, name: str,
+                 latencies: Sequence[float],
+                 elapsed: float,
+                 errors: int = 0) -> None:
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.elapsed = elapsed
+        self.errors = errors
+
+    def __repr__(self) -> str:
+        return (f"Result('{self.name}', p50={self.p50:.6f}, "
+                f'p99={self.p99:.6f}, throughput={self.throughput:.1f})')
+
+    @property
+    def p50(self) -> float:
+        """The median latency in seconds."""
+        return percentile(self.latencies, 50)
+
+    @property
+    def p99(self) -> float:
+        """The 99th percentile latency in seconds."""
+        return percentile(self.latencies, 99)
+
+    @property
+    def throughput(self) -> float:
+        """The calls per second."""
+        if not self.elapsed:
+            return 0.0
+        return len(self.latencies) / self.elapsed
+
+    # Public methods.
+    def to_dict(self, unit: float = 1.0) -> dict[str, float]:
+        """Return the summary stored in a baseline.
+
+        :param unit: (Optional.) The seconds the latencies are given
+            as multiples of, usually from calibrate(). The default is
+            one, which gives them in seconds.
+        :return: The latencies and the number of errors.
+        :rtype: dict
+        """
+        return {
+            'p50': round(self.p50 / unit, 6),
+            'p99': round(self.p99 / unit, 6),
+            'errors': self.errors,
+        }
+
+
+# Benchmarks.
+def bench_token_get(iterations: int = ITERATIONS) -> Result:
+    """Time reading a secret from the in-memory backend."""
+    backend = cx.MemoryBackend({('bench', 'user'): 'spam', })
+    token = cx.Token('bench', 'user', backend=backend)
+    return measure('token_get', token.get, iterations)
+
+
+def bench_token_set(iterations: int = ITERATIONS) -> Result:
+    """Time storing a secret in the in-memory backend."""
+    backend = cx.MemoryBackend()
+    token = cx.Token('bench', 'user', temp=True, backend=backend)
+    return measure('token_set', lambda: token.set('spam'), iterations)
+
+
+def bench_exchange_token(graph: FakeGraph,
+                         iterations: int = ITERATIONS) -> Result:
+    """Time exchanging an access token with the stand-in."""
+    backend = cx.MemoryBackend({
+        ('bench_app_id', 'user'): 'spam',
+        ('bench_app_secret', 'user'): 'eggs',
+    })
+    app_id = cx.Token('bench_app_id', 'user', backend=backend)
+    app_secret = cx.Token('bench_app_secret', 'user', backend=backend)
+
+    def call() -> None:
+        fb.exchange_token(app_id, app_secret, 'bacon')
+
+    with graph_api(graph):
+        return measure('exchange_token', call, iterations, fb.GraphError)
+
+
+def bench_login_callback(iterations: int = ITERATIONS) -> Result:
+    """Time a login redirect from the listener receiving it to the
+    waiting login getting its code.
+    """
+    from pjisocial import httplistener as hl
+    server = hl.make_server(HOST, 0, threaded=True)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://{HOST}:{server.server_port}/facebook_login'
+    session = cx.Session()
+    states = iter(range(iterations + WARMUP))
+
+    def call() -> None:
+        state = f'bench{next(states)}'
+        flow = hl.flows.register(state)
+        try:
+            session.get(url, {'state': state, 'code': 'spam'})
+            flow.result(fb.TIMEOUT)
+        finally:
+            hl.flows.unregister(state)
+
+    try:
+        return measure('login_callback', call, iterations)
+
+    # Clean up.
+    finally:
+        session.close()
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def run(iterations: int = ITERATIONS,
+        latency: float = 0,
+        error_rate: float = 0,
+        usage: float = 0,
+        error_status: int = 500) -> dict[str, Result]:
+    """Run all the benchmarks.
+
+    :param iterations: (Optional.) The number of timed calls in each
+        benchmark. The default is ITERATIONS.
+    :param latency: (Optional.) The seconds the Graph API stand-in
+        waits before each response. The default is zero.
+    :param error_rate: (Optional.) The fraction of Graph API calls
+        that fail. The default is zero.
+    :param usage: (Optional.) The usage percentage the stand-in
+        reports in its rate limit headers. The default is zero.
+    :param error_status: (Optional.) The HTTP status of the failed
+        calls. The default is 500.
+    :return: The results by the name of the benchmark.
+    :rtype: dict
+    """
+    results = [
+        bench_token_get(iterations),
+        bench_token_set(iterations),
+        bench_login_callback(iterations),
+    ]
+    with FakeGraph(latency, error_rate, error_status, usage) as graph:
+        results.append(bench_exchange_token(graph, iterations))
+    return {result.name: result for result in results}
+
+
+# Baselines.
+def calibrate(loops: int = CALIBRATION_LOOPS,
+              repeat: int = CALIBRATION_REPEAT) -> float:
+    """Return the seconds a fixed pure Python loop takes on this
+    machine, which is the unit latencies are stored in.
+
+    :param loops: (Optional.) The length of the loop. The default is
+        CALIBRATION_LOOPS.
+    :param repeat: (Optional.) The times to run the loop. The fastest
+        run is used. The default is CALIBRATION_REPEAT.
+    :return: The seconds the loop took.
+    :rtype: float
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        total = 0
+        for i in range(loops):
+            total += i * i
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def compare(results: Mapping[str, Result],
+            baseline: Mapping[str, Mapping[str, float]],
+            tolerance: float = TOLERANCE,
+            unit: float = 1.0) -> list[str]:
+    """Find the benchmarks that got slower than the baseline.
+
+    The 99th percentile of a short run is set by one or two slow
+    calls, so it is only compared for benchmarks with at least
+    MIN_P99_ITERATIONS calls.
+
+    :param results: The results of a run.
+    :param baseline: The stored baseline.
+    :param tolerance: (Optional.) The fraction a latency can grow
+        over the baseline before it is a regression. The default is
+        TOLERANCE.
+    :param unit: (Optional.) The seconds the baseline's latencies
+        are multiples of on this machine, usually from calibrate().
+        The default is one, for a baseline in seconds.
+    :return: A description of each regression.
+    :rtype: list
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        stats = ['p50', ]
+        if len(result.latencies) >= MIN_P99_ITERATIONS:
+            stats.append('p99')
+        for stat in stats:
+            limit = base[stat] * unit * (1 + tolerance)
+            value = getattr(result, stat)
+            if value > limit:
+                regressions.append(
+                    f'{name} {stat} is {value * 1e3:.3f} ms, over the '
+                    f'limit of {limit * 1e3:.3f} ms.'
+                )
+    return regressions
+
+
+def load_baseline(path: str = BASELINE_PATH) -> dict[str, Any]:
+    """Return the stored baseline, or an empty one if there is none."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def save_baseline(results: Mapping[str, Result],
+                  path: str = BASELINE_PATH,
+                  unit: float = 1.0) -> None:
+    """Store the results of a run as the baseline, with latencies
+    as multiples of the given unit in seconds.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    data = {
+        name: result.to_dict(unit)
+        for name, result in results.items()
+    }
+    with open(path, 'w') as fh:
+        json.dump(data, fh, indent=4, sort_keys=True)
+        fh.write('\n')
+
+
+# Measurement.
+@contextmanager
+def graph_api(graph: FakeGraph) -> Iterator[FakeGraph]:
+    """Send the facebook module's Graph API calls to the stand-in.
+
+    The calls aren't retried while they are sent to the stand-in, so
+    each call is timed on its own. If the stand-in reports usage, the
+    calls are paced by a scheduler allowing SCHEDULER_RATE calls a
+    second, so the timings show how the pacing reacts to the usage.
+    Otherwise they aren't paced.
+    """
+    saved = (fb.SCHEME, fb.DOMAIN, fb.retry_policy, fb.scheduler)
+    fb.SCHEME = 'http'
+    fb.DOMAIN = graph.domain
+    fb.set_retry_policy(None)
+    if graph.usage > 0:
+        fb.set_scheduler(fb.Scheduler(SCHEDULER_RATE))
+    else:
+        fb.set_scheduler(None)
+    try:
+        yield graph
+
+    # Clean up.
+    finally:
+        fb.SCHEME, fb.DOMAIN = saved[:2]
+        fb.set_retry_policy(saved[2])
+        fb.set_scheduler(saved[3])
+
+
+def measure(name: str,
+            func: Callable[[], Any],
+            iterations: int = ITERATIONS,
+            expected: Any = ()) -> Result:
+    """Time calls to a function.
+
+    :param name: The name of the benchmark.
+    :param func: The function to call.
+    :param iterations: (Optional.) The number of timed calls. The
+        default is ITERATIONS.
+    :param expected: (Optional.) The exceptions that count as failed
+        calls rather than stopping the benchmark. The default is none.
+    :return: The timings.
+    :rtype: pjisocial.bench.Result
+    """
+    for _ in range(WARMUP):
+        try:
+            func()
+        except expected:
+            pass
+
+    latencies = []
+    errors = 0
+    start = perf_counter()
+    for _ in range(iterations):
+        call_start = perf_counter()
+        try:
+            func()
+        except expected:
+            errors += 1
+        latencies.append(perf_counter() - call_start)
+    elapsed = perf_counter() - start
+    return Result(name, latencies, elapsed, errors)
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """Return a percentile of sorted values by the nearest rank.
+
+        >>> percentile([1, 2, 3, 4], 50)
+        2
+        >>> percentile([1, 2, 3, 4], 99)
+        4
+    """
+    if not values:
+        return 0.0
+    rank = max(1, -(-len(values) * q // 100))
+    return values[int(rank) - 1]
+
+
+# Utility functions.
+def _make_handler(graph: FakeGraph) -> type:
+    """Return a request handler class that answers for a FakeGraph."""
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        # The headers and body are sent in separate writes, which
+        # Nagle's algorithm would hold up waiting for an ACK.
+        disable_nagle_algorithm = True
+
+        def do_GET(self) -> None:
+            url = urlsplit(self.path)
+            self._send(*graph.respond('GET', url.path, parse_qs(url.query)))
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length).decode('utf_8')
+            url = urlsplit(self.path)
+            self._send(*graph.respond('POST', url.path, parse_qs(body)))
+
+        def log_message(self, *args) -> None:
+            """Don't log every request."""
+
+        def _send(self, status: int, body: Any) -> None:
+            data = json.dumps(body).encode('utf_8')
+            usage = json.dumps({
+                'call_count': graph.usage,
+                'total_cputime': graph.usage,
+                'total_time': graph.usage,
+            })
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('X-App-Usage', usage)
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+# Command line interface.
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    """Parse the command line arguments for running the benchmarks."""
+    p = argparse.ArgumentParser(
+        prog='pjisocial.bench',
+        description='Run the pjisocial benchmarks.'
+    )
+    p.add_argument(
+        '--iterations',
+        default=ITERATIONS,
+        type=int,
+        help=f'The timed calls in each benchmark. Default: {ITERATIONS}.'
+    )
+    p.add_argument(
+        '--latency',
+        default=0,
+        type=float,
+        help='The seconds the Graph API stand-in waits. Default: 0.'
+    )
+    p.add_argument(
+        '--error-rate',
+        default=0,
+        type=float,
+        help='The fraction of Graph API calls that fail. Default: 0.'
+    )
+    p.add_argument(
+        '--error-status',
+        default=500,
+        type=int,
+        help='The HTTP status of the failed calls. Default: 500.'
+    )
+    p.add_argument(
+        '--usage',
+        default=0,
+        type=float,
+        help='The usage percentage in rate limit headers. Default: 0.'
+    )
+    p.add_argument(
+        '--baseline',
+        default=BASELINE_PATH,
+        help='The path to the baseline file.'
+    )
+    p.add_argument(
+        '--tolerance',
+        default=TOLERANCE,
+        type=float,
+        help=f'The allowed slowdown over the baseline. Default: {TOLERANCE}.'
+    )
+    p.add_argument(
+        '--save',
+        action='store_true',
+        help='Store the results as the new baseline.'
+    )
+    return p.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Run the benchmarks from the command line."""
+    args = parse_args(argv)
+    unit = calibrate()
+    results = run(
+        args.iterations,
+        args.latency,
+        args.error_rate,
+        args.usage,
+        args.error_status
+    )
+    for result in results.values():
+        print(
+            f'{result.name:<16} p50 {result.p50 * 1e3:8.3f} ms  '
+            f'p99 {result.p99 * 1e3:8.3f} ms  '
+            f'{result.throughput:10.1f} calls/s  '
+            f'{result.errors} errors'
+        )
+
+    if args.save:
+        save_baseline(results, args.baseline, unit)
+        print(f'Saved baseline to {args.baseline}.')
+        return 0
+
+    regressions = compare(results, load_baseline(args.baseline),
+                          args.tolerance, unit)
+    for regression in regressions:
+        print(regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -4,9 +4,71 @@ connect
 
 Basic HTTP connectivity for the pjisocial module.
 """
+from abc import ABC, abstractmethod
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from hashlib import sha256
+from importlib import import_module
+import json
+import os
+import re
 import secrets
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import monotonic, time
+from types import ModuleType
+from typing import (Any, Callable, Hashable, Iterable, Iterator, Mapping,
+                    Optional, Sequence, Union)
+from urllib.parse import urlencode, urlsplit
 
 from keyring import delete_password, get_password, set_password
+from requests import Response, Session as _Session   # type: ignore
+from requests.adapters import BaseAdapter, HTTPAdapter  # type: ignore
+from requests.structures import CaseInsensitiveDict  # type: ignore
+
+from pjisocial import metrics
+
+
+# Faster JSON decoders are used when they are installed.
+def _import_optional(name: str) -> Optional[ModuleType]:
+    """Import a module if it is installed."""
+    try:
+        return import_module(name)
+    except ImportError:
+        return None
+
+
+orjson = _import_optional('orjson')
+msgspec = _import_optional('msgspec')
+
+# File locks are taken with whichever of these the platform has.
+fcntl = _import_optional('fcntl')
+msvcrt = _import_optional('msvcrt')
+
+
+# Configuration.
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 10
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 30
+CACHE_TTL = 300
+CACHE_MAXSIZE = 128
+KEYRING_WORKERS = 4
+KEYRING_MIN_PARALLEL = 2
+RESPONSE_CACHE_SIZE = 32 * 2 ** 20
+CREDENTIAL_PARAMS = (
+    'access_token',
+    'client_secret',
+    'code',
+    'fb_exchange_token',
+    'input_token',
+)
+UNCACHED_PATHS = re.compile(r'/oauth/')
+ENV_PREFIX = 'PJISOCIAL_'
+SECRET_KEY_ENV = 'PJISOCIAL_SECRET_KEY'
 
 
 # Exceptions.
@@ -22,7 +84,724 @@ class SecretExists(RuntimeError):
     """The OS's secret store already contains that secret."""
 
 
+# Secret backends.
+class Backend(ABC):
+    """Where Token objects store their secrets.
+
+    Backends use the same interface as the keyring module.
+    Subclasses must implement delete_password(), get_password(), and
+    set_password(). A backend from the keyring package can be given
+    to a Token or set_backend() too, and is wrapped in a
+    KeyringBackend.
+    """
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}()'
+
+    @abstractmethod
+    def delete_password(self, service: str, user: str) -> None:
+        """Remove a secret."""
+
+    @abstractmethod
+    def get_password(self, service: str, user: str) -> Optional[str]:
+        """Return a secret, or None if it doesn't exist."""
+
+    @abstractmethod
+    def set_password(self, service: str, user: str, value: str) -> None:
+        """Store a secret."""
+
+    def get_passwords(self, keys: Sequence[tuple[str, str]]
+                      ) -> list[Optional[str]]:
+        """Return many secrets at once.
+
+        Backends that can read many secrets in one operation should
+        override this. By default, the secrets are read in parallel
+        in the keyring thread pool, unless there are fewer than
+        KEYRING_MIN_PARALLEL of them, which are read directly.
+
+        :param keys: The (service, user) pairs of the secrets.
+        :return: The secrets in the same order as the keys, with None
+            for secrets that don't exist.
+        :rtype: list
+        """
+        if len(keys) < KEYRING_MIN_PARALLEL:
+            return [self.get_password(*key) for key in keys]
+        executor = get_keyring_executor()
+        return list(executor.map(lambda k: self.get_password(*k), keys))
+
+    def set_passwords(self, items: Iterable[tuple[str, str, str]]) -> None:
+        """Store many secrets at once.
+
+        Backends that can write many secrets in one operation should
+        override this. By default, the secrets are written in
+        parallel in the keyring thread pool, unless there are fewer
+        than KEYRING_MIN_PARALLEL of them, which are written directly.
+
+        :param items: The (service, user, value) of each secret.
+        """
+        items = list(items)
+        if len(items) < KEYRING_MIN_PARALLEL:
+            for item in items:
+                self.set_password(*item)
+            return
+        executor = get_keyring_executor()
+        list(executor.map(lambda i: self.set_password(*i), items))
+
+
+class EncryptedFileBackend(Backend):
+    """Secrets stored in a local encrypted file.
+
+    The whole file is decrypted once when the backend is created and
+    secrets are served from memory after that. Changes are written
+    back to the file immediately. Before each change, the file is
+    locked and read again, so processes sharing the file don't lose
+    each other's changes. The file is encrypted with Fernet, so the
+    cryptography package must be installed.
+
+    :param path: The path to the file.
+    :param key: (Optional.) The Fernet key for the file. The default
+        is the value of the environment variable named in
+        SECRET_KEY_ENV.
+    """
+    def __init__(self, path: str, key: Union[str, bytes, None] = None) -> None:
+        fernet = _import_fernet()
+        if key is None:
+            key = os.environ.get(SECRET_KEY_ENV)
+        if not key:
+            msg = f'No key given and {SECRET_KEY_ENV} is not set.'
+            raise ValueError(msg)
+
+        self.path = path
+        self._fernet = fernet.Fernet(key)
+        self._invalid = fernet.InvalidToken
+        self._lock = Lock()
+        self._secrets: dict[str, dict[str, str]] = self._read()
+
+    def __repr__(self) -> str:
+        return f"EncryptedFileBackend('{self.path}')"
+
+    @staticmethod
+    def generate_key() -> str:
+        """Return a new key for an encrypted file. This raises a
+        RuntimeError if the cryptography package isn't installed.
+        """
+        return _import_fernet().Fernet.generate_key().decode('utf_8')
+
+    # Public methods.
+    def delete_password(self, service: str, user: str) -> None:
+        """Remove a secret."""
+        def delete(secrets: dict[str, dict[str, str]]) -> None:
+            secrets.get(service, {}).pop(user, None)
+
+        self._update(delete)
+
+    def get_password(self, service: str, user: str) -> Optional[str]:
+        """Return a secret, or None if it doesn't exist."""
+        return self._secrets.get(service, {}).get(user)
+
+    def get_passwords(self, keys: Sequence[tuple[str, str]]
+                      ) -> list[Optional[str]]:
+        """Return many secrets at once."""
+        return [self.get_password(*key) for key in keys]
+
+    def set_password(self, service: str, user: str, value: str) -> None:
+        """Store a secret."""
+        self.set_passwords([(service, user, value), ])
+
+    def set_passwords(self, items: Iterable[tuple[str, str, str]]) -> None:
+        """Store many secrets at once, writing the file only once."""
+        items = list(items)
+
+        def store(secrets: dict[str, dict[str, str]]) -> None:
+            for service, user, value in items:
+                secrets.setdefault(service, {})[user] = value
+
+        self._update(store)
+
+    # Private methods.
+    def _read(self) -> dict[str, dict[str, str]]:
+        """Decrypt the secrets in the file."""
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'rb') as fh:
+            data = fh.read()
+        try:
+            return json.loads(self._fernet.decrypt(data))
+        except self._invalid:
+            msg = f'Could not decrypt {self.path} with the given key.'
+            raise ValueError(msg)
+
+    def _update(self, change: Callable[[dict[str, dict[str, str]]], None]
+                ) -> None:
+        """Change the secrets and write them to the file while
+        holding the file's lock.
+        """
+        with self._lock, _lock_file(f'{self.path}.lock'):
+            secrets = self._read()
+            change(secrets)
+            self._secrets = secrets
+            self._write()
+
+    def _write(self) -> None:
+        """Encrypt the secrets and replace the file with them.
+
+        The secrets are written to a uniquely named file, which is
+        only readable by the user, and then moved over the file, so a
+        reader never sees a file written half way.
+        """
+        data = self._fernet.encrypt(json.dumps(self._secrets).encode())
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with NamedTemporaryFile(dir=directory, delete=False) as fh:
+            fh.write(data)
+        try:
+            os.replace(fh.name, self.path)
+        except OSError:
+            os.unlink(fh.name)
+            raise
+
+
+class EnvBackend(Backend):
+    """Secrets read from environment variables or files.
+
+    The name of a secret is the prefix followed by its service and
+    user joined by two underscores, in upper case with anything that
+    isn't a letter or digit replaced by an underscore. If a directory
+    is given, a file with that name in the directory is also checked,
+    which works with the secrets mounted into containers. Secrets set
+    through the backend only last for the current process.
+
+    :param prefix: (Optional.) The prefix for the names of secrets.
+        The default is ENV_PREFIX.
+    :param directory: (Optional.) A directory of files to read
+        secrets from when they aren't in the environment.
+    """
+    def __init__(self, prefix: str = ENV_PREFIX,
+                 directory: Optional[str] = None) -> None:
+        self.prefix = prefix
+        self.directory = directory
+
+    def __repr__(self) -> str:
+        return f"EnvBackend('{self.prefix}', {self.directory!r})"
+
+    # Public methods.
+    def delete_password(self, service: str, user: str) -> None:
+        """Remove a secret."""
+        os.environ.pop(self.name(service, user), None)
+
+    def get_password(self, service: str, user: str) -> Optional[str]:
+        """Return a secret, or None if it doesn't exist."""
+        name = self.name(service, user)
+        if name in os.environ:
+            return os.environ[name]
+        if self.directory is not None:
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path):
+                with open(path) as fh:
+                    return fh.read().rstrip('\n')
+        return None
+
+    def name(self, service: str, user: str) -> str:
+        """Return the name of a secret."""
+        name = f'{self.prefix}{service}__{user}'
+        return re.sub(r'[^A-Za-z0-9_]', '_', name).upper()
+
+    def get_passwords(self, keys: Sequence[tuple[str, str]]
+                      ) -> list[Optional[str]]:
+        """Return many secrets at once."""
+        return [self.get_password(*key) for key in keys]
+
+    def set_password(self, service: str, user: str, value: str) -> None:
+        """Store a secret."""
+        os.environ[self.name(service, user)] = value
+
+    def set_passwords(self, items: Iterable[tuple[str, str, str]]) -> None:
+        """Store many secrets at once."""
+        for item in items:
+            self.set_password(*item)
+
+
+class KeyringBackend(Backend):
+    """Secrets stored in the OS's native secret store through the
+    keyring module.
+
+    The keyring module has no call that reads many secrets at once,
+    so bulk reads and writes use the default from Backend, one call
+    for each secret in the keyring thread pool.
+
+    :param keyring: (Optional.) The backend from the keyring package
+        to use. The default is the keyring module's default backend.
+    """
+    def __init__(self, keyring: Any = None) -> None:
+        self.keyring = keyring
+
+    def __repr__(self) -> str:
+        if self.keyring is None:
+            return 'KeyringBackend()'
+        return f'KeyringBackend({self.keyring!r})'
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, KeyringBackend):
+            return NotImplemented
+        return self.keyring is other.keyring
+
+    def __hash__(self) -> int:
+        return hash((KeyringBackend, id(self.keyring)))
+
+    # Public methods.
+    def delete_password(self, service: str, user: str) -> None:
+        """Remove a secret."""
+        if self.keyring is None:
+            delete_password(service, user)
+        else:
+            self.keyring.delete_password(service, user)
+
+    def get_password(self, service: str, user: str) -> Optional[str]:
+        """Return a secret, or None if it doesn't exist."""
+        if self.keyring is None:
+            return get_password(service, user)
+        return self.keyring.get_password(service, user)
+
+    def set_password(self, service: str, user: str, value: str) -> None:
+        """Store a secret."""
+        if self.keyring is None:
+            set_password(service, user, value)
+        else:
+            self.keyring.set_password(service, user, value)
+
+
+class MemoryBackend(Backend):
+    """Secrets stored in memory, mainly for tests.
+
+    :param secrets: (Optional.) The initial secrets, keyed by
+        (service, user).
+    """
+    def __init__(self,
+                 secrets: Optional[dict[tuple[str, str], str]] = None
+                 ) -> None:
+        self.secrets = dict(secrets) if secrets else {}
+
+    def __repr__(self) -> str:
+        return f'MemoryBackend(<{len(self.secrets)} secrets>)'
+
+    # Public methods.
+    def delete_password(self, service: str, user: str) -> None:
+        """Remove a secret."""
+        self.secrets.pop((service, user), None)
+
+    def get_password(self, service: str, user: str) -> Optional[str]:
+        """Return a secret, or None if it doesn't exist."""
+        return self.secrets.get((service, user))
+
+    def get_passwords(self, keys: Sequence[tuple[str, str]]
+                      ) -> list[Optional[str]]:
+        """Return many secrets at once."""
+        return [self.secrets.get(key) for key in keys]
+
+    def set_password(self, service: str, user: str, value: str) -> None:
+        """Store a secret."""
+        self.secrets[(service, user)] = value
+
+    def set_passwords(self, items: Iterable[tuple[str, str, str]]) -> None:
+        """Store many secrets at once."""
+        for service, user, value in items:
+            self.secrets[(service, user)] = value
+
+
 # Public classes.
+class CachedResponse:
+    """A response stored in a ResponseCache.
+
+    :param etag: The ETag of the response.
+    :param content: The body of the response.
+    :param headers: The headers of the response.
+    """
+    __slots__ = ('etag', 'content', 'headers')
+
+    def __init__(self, etag: str,
+                 content: bytes,
+                 headers: Mapping[str, str]) -> None:
+        self.etag = etag
+        self.content = content
+        self.headers = dict(headers)
+
+    def __len__(self) -> int:
+        return len(self.content)
+
+    def __repr__(self) -> str:
+        return f"CachedResponse('{self.etag}', <{len(self)} bytes>)"
+
+    # Public methods.
+    def to_response(self, revalidated: Response) -> Response:
+        """Build the response to return for a 304 Not Modified.
+
+        :param revalidated: The 304 response. Its headers are kept,
+            since they carry current information such as usage.
+        :return: A :class:`requests.Response` object.
+        :rtype: requests.Response
+        """
+        resp = Response()
+        resp.status_code = 200
+        resp._content = self.content
+        resp.headers = CaseInsensitiveDict(self.headers)
+        resp.headers.update(revalidated.headers)
+        resp.url = revalidated.url
+        resp.request = revalidated.request
+        resp.encoding = revalidated.encoding
+        resp.reason = 'OK'
+        return resp
+
+
+class ResponseCache:
+    """An in-memory cache of responses with ETags.
+
+    A cached response is revalidated with If-None-Match rather than
+    downloaded again. When the cache holds more than its size, the
+    least recently used responses are evicted.
+
+    :param maxsize: (Optional.) The maximum total size of the cached
+        bodies in bytes. The default is RESPONSE_CACHE_SIZE.
+    """
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE) -> None:
+        self.maxsize = maxsize
+        self.size = 0
+        self._items: OrderedDict[str, CachedResponse] = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(maxsize={self.maxsize})'
+
+    # Public methods.
+    def clear(self) -> None:
+        """Remove all responses from the cache."""
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """Return the cached response for a key, if any."""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None:
+                self._items.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: CachedResponse) -> None:
+        """Cache a response."""
+        if len(entry) > self.maxsize:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = entry
+            self.size += len(entry)
+            while self.size > self.maxsize:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class SqliteResponseCache(ResponseCache):
+    """A cache of responses with ETags stored in a SQLite database,
+    so it can be shared by several processes and kept between runs.
+
+    :param path: The path to the database file.
+    :param maxsize: (Optional.) The maximum total size of the cached
+        bodies in bytes. The default is RESPONSE_CACHE_SIZE.
+    """
+    def __init__(self, path: str,
+                 maxsize: int = RESPONSE_CACHE_SIZE) -> None:
+        super().__init__(maxsize)
+        self.path = path
+        import sqlite3
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, etag TEXT, headers TEXT, '
+                'content BLOB, size INTEGER, used REAL)'
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            sql = 'SELECT COUNT(*) FROM responses'
+            return self._db.execute(sql).fetchone()[0]
+
+    def __repr__(self) -> str:
+        return f"SqliteResponseCache('{self.path}', maxsize={self.maxsize})"
+
+    # Public methods.
+    def clear(self) -> None:
+        """Remove all responses from the cache."""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM responses')
+
+    def close(self) -> None:
+        """Close the database."""
+        self._db.close()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """Return the cached response for a key, if any."""
+        with self._lock, self._db:
+            row = self._db.execute(
+                'SELECT etag, headers, content FROM responses '
+                'WHERE key = ?',
+                (key, )
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                'UPDATE responses SET used = ? WHERE key = ?',
+                (time(), key)
+            )
+        etag, headers, content = row
+        return CachedResponse(etag, content, json.loads(headers))
+
+    def set(self, key: str, entry: CachedResponse) -> None:
+        """Cache a response."""
+        if len(entry) > self.maxsize:
+            return
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, entry.etag, json.dumps(entry.headers),
+                 entry.content, len(entry), time())
+            )
+
+            # Evict the least recently used responses until the cache
+            # fits in its size again.
+            self._db.execute(
+                'DELETE FROM responses WHERE key IN ('
+                'SELECT key FROM ('
+                'SELECT key, SUM(size) OVER (ORDER BY used DESC) AS total '
+                'FROM responses) WHERE total > ?)',
+                (self.maxsize, )
+            )
+
+
+class SecretCache:
+    """An in-memory cache of secrets read from the OS's secret store.
+
+    Entries expire after the given number of seconds. When the cache
+    is full, the least recently used entry is evicted. Token objects
+    cache their secrets under their cache_key, which includes the
+    backend, so the same service and user in two backends don't
+    share an entry.
+
+    :param ttl: (Optional.) The number of seconds an entry is served
+        from the cache. The default is CACHE_TTL.
+    :param maxsize: (Optional.) The maximum number of entries in the
+        cache. The default is CACHE_MAXSIZE.
+    """
+    def __init__(self, ttl: float = CACHE_TTL,
+                 maxsize: int = CACHE_MAXSIZE) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._items: OrderedDict[Hashable, tuple[float, str]]
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __repr__(self) -> str:
+        return f'SecretCache(ttl={self.ttl}, maxsize={self.maxsize})'
+
+    # Public methods.
+    def clear(self) -> None:
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._items.clear()
+
+    def get(self, key: Hashable) -> Optional[str]:
+        """Return the cached value for a key, or None if it isn't
+        cached or has expired.
+        """
+        with self._lock:
+            try:
+                expires, value = self._items[key]
+            except KeyError:
+                return None
+            if expires <= monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def invalidate(self, key: Hashable) -> None:
+        """Remove a key from the cache."""
+        with self._lock:
+            self._items.pop(key, None)
+
+    def set(self, key: Hashable, value: str) -> None:
+        """Cache the value for a key."""
+        with self._lock:
+            self._items[key] = (monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+
+class Session:
+    """A pooled, keep-alive HTTP session for API calls.
+
+    Connections are kept open between calls, so repeated calls to the
+    same host don't pay for a new TCP connection and TLS handshake
+    every time.
+
+    :param pool_connections: (Optional.) The number of hosts to keep
+        connection pools for. The default is POOL_CONNECTIONS.
+    :param pool_maxsize: (Optional.) The maximum number of connections
+        kept open to each host. Calls beyond this limit wait for a
+        connection to be freed. The default is POOL_MAXSIZE.
+    :param timeout: (Optional.) The default timeout for calls, either
+        as seconds or as a (connect, read) tuple. The default is
+        (CONNECT_TIMEOUT, READ_TIMEOUT).
+    :param transport: (Optional.) A requests transport adapter to use
+        instead of the pooled HTTP adapter. This is mainly useful for
+        substituting a local stand-in for the network during tests.
+    :param cache: (Optional.) A cache for GET responses with ETags.
+        Cached responses are revalidated rather than downloaded
+        again. Responses from paths matching UNCACHED_PATHS, such as
+        OAuth token exchanges, are never cached. The default is not
+        to cache responses.
+    """
+    def __init__(self, pool_connections: int = POOL_CONNECTIONS,
+                 pool_maxsize: int = POOL_MAXSIZE,
+                 timeout: Union[float, tuple[float, float], None] = None,
+                 transport: Optional[BaseAdapter] = None,
+                 cache: Optional[ResponseCache] = None) -> None:
+        if timeout is None:
+            timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        if transport is None:
+            transport = HTTPAdapter(
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+                pool_block=True
+            )
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.transport = transport
+        self.cache = cache
+
+        self._session = _Session()
+        self._session.mount('https://', transport)
+        self._session.mount('http://', transport)
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def __repr__(self) -> str:
+        return (f'Session(pool_connections={self.pool_connections}, '
+                f'pool_maxsize={self.pool_maxsize}, '
+                f'timeout={self.timeout!r})')
+
+    def __enter__(self) -> 'Session':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    # Public methods.
+    def close(self) -> None:
+        """Close all pooled connections."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._session.close()
+
+    def get(self, url: str,
+            params: Optional[dict[str, Any]] = None,
+            **kwargs) -> Response:
+        """Make an HTTP GET request."""
+        if self.cache is None or UNCACHED_PATHS.search(urlsplit(url).path):
+            return self.request('GET', url, params=params, **kwargs)
+
+        # If the response is cached, ask the server to only send it
+        # again if it has changed.
+        key = _cache_key(url, params)
+        entry = self.cache.get(key)
+        if entry is not None:
+            headers = dict(kwargs.pop('headers', None) or {})
+            headers['If-None-Match'] = entry.etag
+            kwargs['headers'] = headers
+        resp = self.request('GET', url, params=params, **kwargs)
+
+        if resp.status_code == 304 and entry is not None:
+            metrics.count('http.cache', result='hit')
+            return entry.to_response(resp)
+        metrics.count('http.cache', result='miss')
+        if resp.status_code == 200 and resp.headers.get('ETag'):
+            entry = CachedResponse(
+                resp.headers['ETag'],
+                resp.content,
+                resp.headers
+            )
+            self.cache.set(key, entry)
+        return resp
+
+    def post(self, url: str,
+             data: Optional[dict[str, Any]] = None,
+             **kwargs) -> Response:
+        """Make an HTTP POST request."""
+        return self.request('POST', url, data=data, **kwargs)
+
+    def request(self, method: str, url: str, **kwargs) -> Response:
+        """Make an HTTP request through the connection pool."""
+        kwargs.setdefault('timeout', self.timeout)
+        if metrics.sink is None:
+            return self._session.request(method, url, **kwargs)
+
+        # The time to the response headers includes connecting and
+        # the server's time. The rest of the span is reading the body.
+        labels = {'method': method, 'endpoint': metrics.endpoint(url)}
+        with metrics.span('http.request', **labels):
+            resp = self._session.request(method, url, **kwargs)
+        elapsed = resp.elapsed.total_seconds()
+        metrics.observe('http.headers.seconds', elapsed, **labels)
+        metrics.count('http.responses', status=str(resp.status_code), **labels)
+        return resp
+
+    # Async methods.
+    async def aget(self, url: str,
+                   params: Optional[dict[str, Any]] = None,
+                   **kwargs) -> Response:
+        """Make an HTTP GET request without blocking the event loop."""
+        return await self._run(partial(self.get, url, params, **kwargs))
+
+    async def apost(self, url: str,
+                    data: Optional[dict[str, Any]] = None,
+                    **kwargs) -> Response:
+        """Make an HTTP POST request without blocking the event loop."""
+        return await self.arequest('POST', url, data=data, **kwargs)
+
+    async def arequest(self, method: str, url: str, **kwargs) -> Response:
+        """Make an HTTP request through the connection pool without
+        blocking the event loop. The calls are run in a thread pool
+        the size of the connection pool, so any number of concurrent
+        calls share the pooled connections. GET requests go through
+        get(), so they use the response cache like the blocking calls.
+        """
+        if method.upper() == 'GET':
+            return await self._run(partial(self.get, url, **kwargs))
+        return await self._run(partial(self.request, method, url, **kwargs))
+
+    # Private methods.
+    async def _run(self, func: Callable[[], Response]) -> Response:
+        """Run a blocking call in the session's thread pool."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.pool_maxsize,
+                thread_name_prefix='pjisocial_http'
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func)
+
+
 class Token:
     """A secret stored in the OS's native secret store.
 
@@ -33,15 +812,92 @@ class Token:
         changing the values of long lived secrets like API keys and
         passwords, but allow changing of short lived secrets like
         session tokens. The default is false.
+    :param backend: (Optional.) Where the secret is stored, either a
+        Backend or a backend from the keyring package. The default is
+        the backend set with set_backend(), which is the OS's secret
+        store unless changed.
     """
-    def __init__(self, service: str, user: str, temp: bool = False) -> None:
+    def __init__(self, service: str, user: str, temp: bool = False,
+                 backend: Any = None) -> None:
         self.service = service
         self.user = user
         self.temp = temp
+        self.backend = _as_backend(backend) if backend is not None else None
 
     def __repr__(self) -> str:
         return f"Token('{self.service}', '{self.user}')"
 
+    @property
+    def cache_key(self) -> tuple[Any, str, str]:
+        """The key the secret is cached under: its backend, service,
+        and user. Backends are compared by identity, except that
+        KeyringBackends wrapping the same keyring backend are equal.
+        """
+        return (self._backend(), self.service, self.user)
+
+    @property
+    def key(self) -> tuple[str, str]:
+        """The (service, user) pair that identifies the secret."""
+        return (self.service, self.user)
+
+    @staticmethod
+    def get_many(tokens: Sequence['Token']) -> list[str]:
+        """Return the values of many secrets at once.
+
+        Cached secrets are served from the cache. The rest are read
+        from each backend in one bulk call.
+
+        :param tokens: The tokens to read.
+        :return: The values of the secrets in the same order as the
+            tokens.
+        :rtype: list
+        """
+        values: list[Optional[str]] = [None for _ in tokens]
+        groups: dict[Backend, list[int]] = {}
+        for i, token in enumerate(tokens):
+            if secret_cache is not None:
+                values[i] = secret_cache.get(token.cache_key)
+            if not values[i]:
+                groups.setdefault(token._backend(), []).append(i)
+
+        for backend, indices in groups.items():
+            keys = [tokens[i].key for i in indices]
+            with metrics.span('secret.get_many', backend=_name(backend)):
+                found = backend.get_passwords(keys)
+            for i, value in zip(indices, found):
+                if not value:
+                    msg = 'Expected secret not in OS secret store.'
+                    raise SecretDoesNotExist(msg)
+                values[i] = value
+                if secret_cache is not None:
+                    secret_cache.set(tokens[i].cache_key, value)
+        return values                               # type: ignore
+
+    @staticmethod
+    def set_many(items: Sequence[tuple['Token', str]]) -> None:
+        """Store many secrets at once.
+
+        :param items: The tokens to store and the value for each.
+        """
+        # Check all the tokens before storing any of them, so a
+        # permanent token doesn't leave the others half stored.
+        if not all(token.temp for token, _ in items):
+            msg = 'Cannot create a permanent secret.'
+            raise PermanentSecret(msg)
+
+        groups: dict[Backend, list[tuple['Token', str]]] = {}
+        for token, value in items:
+            groups.setdefault(token._backend(), []).append((token, value))
+
+        for backend, group in groups.items():
+            with metrics.span('secret.set_many', backend=_name(backend)):
+                backend.set_passwords(
+                    (t.service, t.user, value) for t, value in group
+                )
+            if secret_cache is not None:
+                for token, value in group:
+                    secret_cache.set(token.cache_key, value)
+
     # Public methods.
     def clear(self) -> None:
         """Remove the secret from the store."""
@@ -51,14 +907,29 @@ class Token:
         if not self.temp:
             raise PermanentSecret('Cannot clear a permanent secret.')
 
-        delete_password(self.service, self.user)
+        backend = self._backend()
+        with metrics.span('secret.delete', backend=_name(backend)):
+            backend.delete_password(self.service, self.user)
+        if secret_cache is not None:
+            secret_cache.invalidate(self.cache_key)
 
     def get(self) -> str:
         """Return the value of the secret."""
-        secret = get_password(self.service, self.user)
+        if secret_cache is not None:
+            secret = secret_cache.get(self.cache_key)
+            if secret:
+                metrics.count('secret.cache', result='hit')
+                return secret
+            metrics.count('secret.cache', result='miss')
+
+        backend = self._backend()
+        with metrics.span('secret.get', backend=_name(backend)):
+            secret = backend.get_password(self.service, self.user)
         if not secret:
             msg = 'Expected secret not in OS secret store.'
             raise SecretDoesNotExist(msg)
+        if secret_cache is not None:
+            secret_cache.set(self.cache_key, secret)
         return secret
 
     def set(self, value: str) -> None:
@@ -70,7 +941,7 @@ class Token:
             msg = 'Cannot create a permanent secret.'
             raise PermanentSecret(msg)
 
-        set_password(self.service, self.user, value)
+        self._store(value)
 
     def set_random(self, length: int, urlsafe: bool = False) -> None:
         if not urlsafe:
@@ -78,4 +949,250 @@ class Token:
             value = str(raw, encoding='utf_8')
         else:
             value = secrets.token_urlsafe(length)
-        set_password(self.service, self.user, value)
+        self._store(value)
+
+    # Async methods.
+    async def aclear(self) -> None:
+        """Remove the secret from the store without blocking the
+        event loop.
+        """
+        await _run_keyring(self.clear)
+
+    async def aget(self) -> str:
+        """Return the value of the secret without blocking the event
+        loop.
+        """
+        if secret_cache is not None:
+            secret = secret_cache.get(self.cache_key)
+            if secret:
+                return secret
+        return await _run_keyring(self.get)
+
+    async def aset(self, value: str) -> None:
+        """Store a secret without blocking the event loop."""
+        await _run_keyring(self.set, value)
+
+    async def aset_random(self, length: int, urlsafe: bool = False) -> None:
+        """Store a random secret without blocking the event loop."""
+        await _run_keyring(self.set_random, length, urlsafe)
+
+    # Private methods.
+    def _backend(self) -> Backend:
+        """Return the backend the secret is stored in."""
+        return self.backend if self.backend is not None else default_backend
+
+    def _store(self, value: str) -> None:
+        """Write the secret to the store and the cache."""
+        backend = self._backend()
+        with metrics.span('secret.set', backend=_name(backend)):
+            backend.set_password(self.service, self.user, value)
+        if secret_cache is not None:
+            secret_cache.set(self.cache_key, value)
+
+
+# Secret backend selection.
+default_backend: Backend = KeyringBackend()
+
+
+def set_backend(backend: Any) -> None:
+    """Change where Token objects that weren't given a backend store
+    their secrets. This can be a Backend or a backend from the
+    keyring package. Passing None goes back to the OS's secret store.
+    """
+    global default_backend
+    if backend is None:
+        backend = KeyringBackend()
+    default_backend = _as_backend(backend)
+
+
+# Secret caching.
+secret_cache: Optional[SecretCache] = None
+
+
+def enable_cache(ttl: float = CACHE_TTL,
+                 maxsize: int = CACHE_MAXSIZE) -> SecretCache:
+    """Serve Token.get() from an in-memory cache, so repeated reads
+    of a secret don't go back to the OS's secret store.
+    """
+    global secret_cache
+    secret_cache = SecretCache(ttl, maxsize)
+    return secret_cache
+
+
+def disable_cache() -> None:
+    """Stop caching secrets and drop any cached values."""
+    global secret_cache
+    if secret_cache is not None:
+        secret_cache.clear()
+    secret_cache = None
+
+
+# Keyring thread pool.
+_keyring_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_keyring_executor() -> ThreadPoolExecutor:
+    """Return the bounded thread pool used to access the OS's secret
+    store from async code, creating it if needed.
+    """
+    global _keyring_executor
+    if _keyring_executor is None:
+        _keyring_executor = ThreadPoolExecutor(
+            KEYRING_WORKERS,
+            thread_name_prefix='pjisocial_keyring'
+        )
+    return _keyring_executor
+
+
+async def _run_keyring(func, *args) -> Any:
+    """Run a blocking secret store call in the keyring thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_keyring_executor(), func, *args)
+
+
+# JSON decoding.
+Content = Union[bytes, bytearray, memoryview, str]
+
+
+def _json_decode(content: Content) -> Any:
+    """Decode JSON with the standard library, which needs a copy of
+    a memoryview as bytes.
+    """
+    if isinstance(content, memoryview):
+        content = content.tobytes()
+    return json.loads(content)
+
+
+def _msgspec_decode(content: Content) -> Any:
+    """Decode JSON with msgspec, raising ValueError like the other
+    decoders if it is invalid.
+    """
+    assert msgspec is not None
+    try:
+        return msgspec.json.decode(content)
+    except msgspec.DecodeError as ex:
+        raise ValueError(str(ex))
+
+
+Decoder = Callable[[Content], Any]
+DECODERS: dict[str, Decoder] = {'json': _json_decode, }
+if msgspec is not None:
+    DECODERS['msgspec'] = _msgspec_decode
+if orjson is not None:
+    DECODERS['orjson'] = orjson.loads
+decoder_name: str = next(
+    name for name in ('orjson', 'msgspec', 'json')
+    if name in DECODERS
+)
+
+
+def decode(content: Content) -> Any:
+    """Decode a JSON response body.
+
+    The body is decoded straight from bytes by the fastest decoder
+    installed: orjson, then msgspec, then the standard library. A
+    memoryview is read in place by orjson and msgspec. Invalid JSON
+    raises a ValueError whichever decoder is used.
+    """
+    if metrics.sink is None:
+        return DECODERS[decoder_name](content)
+    with metrics.span('json.decode', decoder=decoder_name):
+        return DECODERS[decoder_name](content)
+
+
+def set_decoder(name: str) -> None:
+    """Choose the decoder used by decode().
+
+    :param name: The name of the decoder: 'orjson', 'msgspec', or
+        'json'. The decoder must be installed.
+    """
+    global decoder_name
+    if name not in DECODERS:
+        msg = f'JSON decoder {name} is not available.'
+        raise ValueError(msg)
+    decoder_name = name
+
+
+# Shared session.
+_session: Optional[Session] = None
+
+
+def get_session() -> Session:
+    """Return the session shared by pjisocial API calls, creating it
+    if needed.
+    """
+    global _session
+    if _session is None:
+        _session = Session()
+    return _session
+
+
+def set_session(session: Optional[Session]) -> None:
+    """Replace the session shared by pjisocial API calls. Passing
+    None causes a new default session to be created on next use.
+    """
+    global _session
+    if _session is not None and _session is not session:
+        _session.close()
+    _session = session
+
+
+# Utility functions.
+def _cache_key(url: str, params: Optional[Mapping[str, Any]]) -> str:
+    """Return the key for a response in a ResponseCache.
+
+    The key is the URL and parameters plus a hash of the credentials
+    used, such as the access token, so responses are never served to
+    a caller with a different access scope. The parameters named in
+    CREDENTIAL_PARAMS aren't stored in the key.
+    """
+    q = dict(params) if params else {}
+    creds = [str(q.pop(name, '')) for name in CREDENTIAL_PARAMS]
+    scope = sha256('\0'.join(creds).encode('utf_8')).hexdigest()[:16]
+    return f'{scope}:{url}?{urlencode(sorted(q.items()))}'
+
+
+def _import_fernet() -> Any:
+    """Import the Fernet module from cryptography, which is only
+    needed by the encrypted secret store and is slow to import.
+    """
+    try:
+        from cryptography import fernet  # type: ignore
+    except ImportError:
+        msg = 'The cryptography package is needed to encrypt secrets.'
+        raise RuntimeError(msg)
+    return fernet
+
+
+@contextmanager
+def _lock_file(path: str) -> Iterator[None]:
+    """Hold an exclusive lock on a file, waiting for other processes
+    to release it.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        elif msvcrt is not None:
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    finally:
+        os.close(fd)
+
+
+def _as_backend(backend: Any) -> Backend:
+    """Wrap a backend from the keyring package in a KeyringBackend."""
+    if isinstance(backend, Backend):
+        return backend
+    return KeyringBackend(backend)
+
+
+def _name(backend: Backend) -> str:
+    """Return the name of a backend's class for metric labels."""
+    return type(backend).__name__
@@ -0,0 +1,420 @@
+"""
+export
+~~~~~~
+
+Export Graph API edges to files for analytics.
+
+The items of an edge are flattened into columns and written in parts
+of a bounded size, so memory use doesn't grow with the edge. After
+each part is written, the cursor of its last page is saved, so an
+export that stops part way can pick up where it left off. For the
+columnar formats, the column types are saved too, so every part of an
+export is written with the same types.
+"""
+from datetime import datetime
+import json
+import os
+from queue import Empty, Full, Queue
+import re
+from threading import Event, Thread
+from typing import Any, Iterable, Iterator, Mapping, Optional, Sequence
+
+from pjisocial import facebook as fb
+from pjisocial import metrics
+from pjisocial.connect import Token
+
+
+# Configuration.
+CHUNK_ROWS = 10_000
+QUEUE_PAGES = 8
+QUEUE_TIMEOUT = 0.1
+STATE_FILE = '_state.json'
+FORMATS = ('arrow', 'ndjson', 'parquet')
+GRAPH_TIME = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d[+-]\d{4}$')
+
+
+# Public classes.
+class Checkpoint:
+    """How far an export has got.
+
+    :param path: The path of the edge being exported.
+    :param fmt: The format of the files.
+    :param after: (Optional.) The cursor of the last page written.
+    :param parts: (Optional.) The number of parts written.
+    :param rows: (Optional.) The number of rows written.
+    :param done: (Optional.) Whether the whole edge was written.
+    :param next_query: (Optional.) The next page query of the last
+        page written, for an edge that isn't paged by cursor.
+    :param columns: (Optional.) The types of the columns written so
+        far, for the columnar formats.
+    """
+    __slots__ = ('path', 'fmt', 'after', 'parts', 'rows', 'done',
+                 'next_query', 'columns')
+
+    def __init__(self, path: str,
+                 fmt: str,
+                 after: Optional[str] = None,
+                 parts: int = 0,
+                 rows: int = 0,
+                 done: bool = False,
+                 next_query: Optional[str] = None,
+                 columns: Optional[dict[str, str]] = None) -> None:
+        self.path = path
+        self.fmt = fmt
+        self.after = after
+        self.parts = parts
+        self.rows = rows
+        self.done = done
+        self.next_query = next_query
+        self.columns = columns
+
+    def __repr__(self) -> str:
+        return (f"Checkpoint('{self.path}', '{self.fmt}', "
+                f'after={self.after!r}, parts={self.parts}, '
+                f'rows={self.rows}, done={self.done})')
+
+    @classmethod
+    def load(cls, directory: str) -> Optional['Checkpoint']:
+        """Read the checkpoint in an export directory, if there is
+        one.
+        """
+        filename = os.path.join(directory, STATE_FILE)
+        if not os.path.exists(filename):
+            return None
+        with open(filename) as fh:
+            return cls(**json.load(fh))
+
+    # Public methods.
+    def save(self, directory: str) -> None:
+        """Write the checkpoint to an export directory, replacing the
+        old one in a single step.
+        """
+        filename = os.path.join(directory, STATE_FILE)
+        data = {name: getattr(self, name) for name in self.__slots__}
+        _write_atomic(filename, json.dumps(data).encode('utf_8'))
+
+
+# Export functions.
+def export(path: str,
+           access_token: Token,
+           directory: str,
+           fmt: str = 'ndjson',
+           fields: Any = fb.DEFAULT_FIELDS,
+           limit: int = fb.PAGE_LIMIT,
+           params: Optional[dict[str, Any]] = None,
+           account: Optional[str] = None,
+           since: Any = None,
+           until: Any = None,
+           chunk_rows: int = CHUNK_ROWS) -> Checkpoint:
+    """Export the items of a Graph API edge to files.
+
+    Pages are fetched and decoded in a background thread while the
+    rows of earlier pages are flattened and written, with a bounded
+    queue between them. Rows are written in parts of about chunk_rows
+    rows each, named part-00000.ndjson and so on. If the directory
+    holds a checkpoint from an export that didn't finish, the export
+    starts again after the last part written.
+
+    The column types of Parquet and Arrow files are carried from each
+    part to the next, so a column keeps its type in every part unless
+    a later value doesn't fit it, as described in column_types().
+
+    Parquet and Arrow IPC files need the pyarrow package.
+
+    :param path: The path of the edge, such as '/me/posts'.
+    :param access_token: The access token for the calls.
+    :param directory: The directory to write the files to.
+    :param fmt: (Optional.) The format of the files: 'ndjson',
+        'parquet', or 'arrow'. The default is 'ndjson'.
+    :param fields: (Optional.) The fields to return for each item.
+        The default is DEFAULT_FIELDS from the facebook module.
+    :param limit: (Optional.) The number of items in each page. The
+        default is PAGE_LIMIT from the facebook module.
+    :param params: (Optional.) Any other parameters for the call.
+    :param account: (Optional.) The business account the calls are
+        made for.
+    :param since: (Optional.) Only return items after this time.
+    :param until: (Optional.) Only return items before this time.
+    :param chunk_rows: (Optional.) The number of rows that starts a
+        new part. The default is CHUNK_ROWS.
+    :return: The checkpoint of the finished export.
+    :rtype: pjisocial.export.Checkpoint
+    """
+    if fmt not in FORMATS:
+        msg = f'Unknown export format {fmt}.'
+        raise ValueError(msg)
+    if fmt != 'ndjson':
+        _import_pyarrow()
+
+    os.makedirs(directory, exist_ok=True)
+    checkpoint = Checkpoint.load(directory)
+    if checkpoint is None:
+        checkpoint = Checkpoint(path, fmt)
+    elif (checkpoint.path, checkpoint.fmt) != (path, fmt):
+        msg = (f'{directory} holds an export of {checkpoint.path} as '
+               f'{checkpoint.fmt}.')
+        raise ValueError(msg)
+    if checkpoint.done:
+        return checkpoint
+
+    pages = fb.iter_pages(
+        path,
+        access_token,
+        fields,
+        limit,
+        params,
+        account,
+        since,
+        until,
+        checkpoint.after,
+        checkpoint.next_query
+    )
+    rows: list[dict[str, Any]] = []
+    for page in _prefetch(pages, QUEUE_PAGES):
+        rows.extend(flatten(item) for item in page.data)
+        more = page.next_params() is not None
+        if len(rows) >= chunk_rows or not more:
+            if rows:
+                name = f'part-{checkpoint.parts:05d}.{fmt}'
+                if fmt != 'ndjson':
+                    checkpoint.columns = column_types(
+                        rows,
+                        checkpoint.columns
+                    )
+                with metrics.span('export.write', fmt=fmt):
+                    write_part(
+                        rows,
+                        os.path.join(directory, name),
+                        fmt,
+                        checkpoint.columns
+                    )
+                checkpoint.parts += 1
+                checkpoint.rows += len(rows)
+                rows = []
+            checkpoint.after = page.after
+            checkpoint.next_query = None if page.after else page.next_query
+            checkpoint.done = not more
+            checkpoint.save(directory)
+    return checkpoint
+
+
+def flatten(item: Mapping[str, Any], prefix: str = '') -> dict[str, Any]:
+    """Flatten a Graph API object into columns.
+
+    Nested objects become columns named with dots. Lists, such as the
+    data of a nested edge, are kept as JSON text.
+
+        >>> flatten({'id': '1', 'from': {'id': '2', 'name': 'Spam'}})
+        {'id': '1', 'from.id': '2', 'from.name': 'Spam'}
+        >>> flatten({'id': '1', 'likes': {'data': [{'id': '3'}]}})
+        {'id': '1', 'likes.data': '[{"id": "3"}]'}
+    """
+    row = {}
+    for key, value in item.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, Mapping):
+            row.update(flatten(value, f'{name}.'))
+        elif isinstance(value, list):
+            row[name] = json.dumps(value)
+        else:
+            row[name] = value
+    return row
+
+
+def column_types(rows: Sequence[Mapping[str, Any]],
+                 types: Optional[Mapping[str, str]] = None
+                 ) -> dict[str, str]:
+    """Choose a type for each column of some rows.
+
+    The types are 'bool', 'int', 'float', 'timestamp', and 'string',
+    plus 'null' for a column that was only ever empty. Missing values
+    don't affect the type. Columns that mix ints and floats become
+    floats, and columns that mix other types become strings.
+
+        >>> column_types([{'a': 1, 'b': '2021-01-01T00:00:00+0000'},
+        ...               {'a': 1.5, 'c': None}])
+        {'a': 'float', 'b': 'timestamp', 'c': 'null'}
+
+    :param rows: The flattened rows.
+    :param types: (Optional.) The types chosen for earlier rows,
+        which the types for these rows start from. Columns in them
+        that aren't in these rows are kept.
+    :return: The type of each column.
+    :rtype: dict
+    """
+    merged = dict(types) if types is not None else {}
+    for row in rows:
+        for key, value in row.items():
+            kind = 'null' if value is None else _value_type(value)
+            merged[key] = _widen(merged.get(key, 'null'), kind)
+    return merged
+
+
+def write_part(rows: Sequence[Mapping[str, Any]],
+               filename: str,
+               fmt: str = 'ndjson',
+               types: Optional[Mapping[str, str]] = None) -> None:
+    """Write rows to one file, replacing it in a single step so a
+    reader never sees a part written half way.
+
+    :param rows: The flattened rows.
+    :param filename: The path of the file.
+    :param fmt: (Optional.) The format of the file: 'ndjson',
+        'parquet', or 'arrow'. The default is 'ndjson'.
+    :param types: (Optional.) The column types for the columnar
+        formats, from column_types(). The default is the types of
+        the given rows.
+    """
+    tmp = f'{filename}.tmp'
+    if fmt == 'ndjson':
+        with open(tmp, 'w', encoding='utf_8') as fh:
+            for row in rows:
+                fh.write(json.dumps(row))
+                fh.write('\n')
+    else:
+        table = _to_table(rows, types)
+        pa = _import_pyarrow()
+        if fmt == 'parquet':
+            from pyarrow import parquet             # type: ignore
+            parquet.write_table(table, tmp)
+        else:
+            with pa.OSFile(tmp, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+    os.replace(tmp, filename)
+
+
+# Utility functions.
+def _import_pyarrow() -> Any:
+    """Import pyarrow, which is only needed for the columnar formats."""
+    try:
+        import pyarrow                              # type: ignore
+    except ImportError:
+        msg = 'The pyarrow package is needed for Parquet and Arrow files.'
+        raise RuntimeError(msg)
+    return pyarrow
+
+
+def _parse_time(value: Any) -> Optional[datetime]:
+    """Parse a Graph API time."""
+    if value is None:
+        return None
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z')
+
+
+def _prefetch(items: Iterable[Any], size: int) -> Iterator[Any]:
+    """Consume an iterable in a background thread, holding at most
+    size items that haven't been used yet.
+    """
+    queue: Queue = Queue(size)
+    stop = Event()
+    end = object()
+
+    def produce() -> None:
+        try:
+            for item in items:
+                _put(queue, (item, None), stop)
+                if stop.is_set():
+                    return
+            _put(queue, (end, None), stop)
+        except BaseException as ex:
+            _put(queue, (end, ex), stop)
+        finally:
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+
+    thread = Thread(target=produce, name='pjisocial_export', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+
+    # Clean up.
+    finally:
+        stop.set()
+        while thread.is_alive():
+            try:
+                queue.get(timeout=QUEUE_TIMEOUT)
+            except Empty:
+                pass
+        thread.join()
+
+
+def _put(queue: Queue, item: Any, stop: Event) -> None:
+    """Put an item in a queue, giving up if the consumer stops."""
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=QUEUE_TIMEOUT)
+            return
+        except Full:
+            pass
+
+
+def _to_table(rows: Sequence[Mapping[str, Any]],
+              types: Optional[Mapping[str, str]] = None) -> Any:
+    """Build a typed Arrow table from flattened rows."""
+    pa = _import_pyarrow()
+    if types is None:
+        types = column_types(rows)
+    arrow_types = {
+        'null': pa.null(),
+        'bool': pa.bool_(),
+        'int': pa.int64(),
+        'float': pa.float64(),
+        'timestamp': pa.timestamp('s', tz='UTC'),
+        'string': pa.string(),
+    }
+    columns = {}
+    for key, kind in types.items():
+        values = [row.get(key) for row in rows]
+        if kind == 'timestamp':
+            values = [_parse_time(value) for value in values]
+        elif kind == 'string':
+            values = [_to_string(value) for value in values]
+        columns[key] = pa.array(values, type=arrow_types[kind])
+    return pa.table(columns)
+
+
+def _to_string(value: Any) -> Optional[str]:
+    """Convert a value in a string column to a string."""
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def _value_type(value: Any) -> str:
+    """Return the column type of one value."""
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, str) and GRAPH_TIME.match(value):
+        return 'timestamp'
+    return 'string'
+
+
+def _widen(old: str, kind: str) -> str:
+    """Return the column type that fits values of two types."""
+    if old == kind or kind == 'null':
+        return old
+    if old == 'null':
+        return kind
+    if {old, kind} == {'int', 'float'}:
+        return 'float'
+    return 'string'
+
+
+def _write_atomic(filename: str, data: bytes) -> None:
+    """Replace a file with new contents in a single step."""
+    tmp = f'{filename}.tmp'
+    with open(tmp, 'wb') as fh:
+        fh.write(data)
+    os.replace(tmp, filename)
@@ -4,16 +4,37 @@ facebook
 
 A module for automating Facebook.
 """
-from json import loads
-import multiprocessing as mp
-from time import sleep
-from typing import Any
-import webbrowser
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures import wait as wait_futures
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from itertools import repeat
+from json import dumps, loads
+import logging
+import os
+from random import uniform
+from threading import Lock, Timer
+from time import monotonic, sleep, time
+from typing import (TYPE_CHECKING, Any, Iterable, Iterator, Mapping,
+                    Optional, Sequence, Union)
+from urllib.parse import parse_qsl, urlencode, urlsplit
 
-from requests import get                                # type: ignore
+from requests import Response                           # type: ignore
+from requests.exceptions import RequestException, Timeout  # type: ignore
+from requests.exceptions import ConnectionError as RequestsConnectionError
 
-from pjisocial import httplistener as hl
-from pjisocial.connect import Token
+from pjisocial import connect as cx
+from pjisocial import metrics
+from pjisocial.connect import Token, decode, get_session
+
+# The listener needs Flask and Werkzeug, which are slow to import and
+# not needed to call the Graph API, so it is imported at login.
+if TYPE_CHECKING:
+    from pjisocial.httplistener import Listener
+
+logger = logging.getLogger(__name__)
 
 
 # Configuration.
@@ -25,60 +46,850 @@ APP_ID_LOCATION = 'pjisocial_fb_app_id'
 APP_ID_ACCOUNT = 'pjisocial'
 APP_SECRET_LOCATION = 'pjisocial_fb_app_secret'
 APP_SECRET_ACCOUNT = 'pjisocial'
+ACCESS_TOKEN_LOCATION = 'pjisocial_fb_access_token'
+HOST = '127.0.0.1'
+PORT = 5002
 TIMEOUT = 30
+BATCH_SIZE = 50
+BATCH_WORKERS = 4
+EXCHANGE_WORKERS = 8
+HEDGE_WORKERS = 8
+REFRESH_MARGIN = 3600
+REFRESH_RETRY = 60
+REFRESH_RETRY_CAP = 3600
+RATE = 10
+BURST = 10
+USAGE_THRESHOLD = 75
+MIN_RATE_FRACTION = 0.05
+THROTTLE_PAUSE = 60
+PAGE_LIMIT = 100
+DEFAULT_FIELDS = ('id', )
+RETRY_ATTEMPTS = 3
+RETRY_BASE = 0.5
+RETRY_CAP = 30
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+BREAKER_THRESHOLD = 5
+BREAKER_RESET = 30
+SYNC_FIELDS = ('id', 'created_time')
+SYNC_OVERLAP = 300
+SYNC_PATH = os.path.join(
+    os.path.expanduser('~'),
+    '.cache',
+    'pjisocial',
+    'sync.sqlite3'
+)
+
+
+# Exceptions.
+class CircuitOpen(RuntimeError):
+    """Calls to the endpoint are failing, so they are not being made."""
+
+
+class GraphError(RuntimeError):
+    """The Graph API returned an error.
+
+    :param msg: The error message.
+    :param code: (Optional.) The Graph API error code.
+    :param subcode: (Optional.) The Graph API error subcode.
+    :param status: (Optional.) The HTTP status of the response.
+    """
+    def __init__(self, msg: str,
+                 code: Optional[int] = None,
+                 subcode: Optional[int] = None,
+                 status: Optional[int] = None) -> None:
+        super().__init__(msg)
+        self.code = code
+        self.subcode = subcode
+        self.status = status
+
+
+class LoginTimeout(RuntimeError):
+    """The login redirect wasn't received in time."""
+
+
+class TokenExpired(RuntimeError):
+    """The stored access token has expired."""
+
+
+# Response classes.
+class AccessToken:
+    """An access token response from Graph API.
+
+    The access token functions return the decoded response as a dict.
+    Callers that want it typed can opt in by passing it to
+    from_dict().
+
+    :param access_token: The access token.
+    :param token_type: (Optional.) The type of the token.
+    :param expires_in: (Optional.) The number of seconds until the
+        token expires.
+    """
+    __slots__ = ('access_token', 'token_type', 'expires_in')
+
+    def __init__(self, access_token: str,
+                 token_type: Optional[str] = None,
+                 expires_in: Optional[int] = None) -> None:
+        self.access_token = access_token
+        self.token_type = token_type
+        self.expires_in = expires_in
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, AccessToken):
+            return NotImplemented
+        return all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__
+        )
+
+    def __repr__(self) -> str:
+        return (f"AccessToken('{self.access_token}', "
+                f"'{self.token_type}', {self.expires_in})")
+
+    @classmethod
+    def from_dict(cls, body: Mapping[str, Any]) -> 'AccessToken':
+        """Build an AccessToken from a decoded response."""
+        return cls(
+            body['access_token'],
+            body.get('token_type'),
+            body.get('expires_in')
+        )
+
+
+class Page:
+    """One page of an edge from Graph API.
+
+    :param data: The items in the page.
+    :param before: (Optional.) The cursor for the previous page.
+    :param after: (Optional.) The cursor for the next page.
+    :param has_next: (Optional.) Whether there is a next page.
+    :param next_query: (Optional.) The query of the next page's URL,
+        without the access token. Edges paged by time or offset
+        rather than by cursor are followed with it.
+    """
+    __slots__ = ('data', 'before', 'after', 'has_next', 'next_query')
+
+    def __init__(self, data: list[Any],
+                 before: Optional[str] = None,
+                 after: Optional[str] = None,
+                 has_next: bool = False,
+                 next_query: Optional[str] = None) -> None:
+        self.data = data
+        self.before = before
+        self.after = after
+        self.has_next = has_next
+        self.next_query = next_query
+
+    def __repr__(self) -> str:
+        return (f'Page(<{len(self.data)} items>, before={self.before!r}, '
+                f'after={self.after!r}, has_next={self.has_next})')
+
+    @classmethod
+    def from_dict(cls, body: Mapping[str, Any]) -> 'Page':
+        """Build a Page from a decoded response."""
+        paging = body.get('paging', {})
+        cursors = paging.get('cursors', {})
+        next_query = None
+        if paging.get('next'):
+            query = parse_qsl(urlsplit(paging['next']).query, True)
+            next_query = urlencode(
+                [(k, v) for k, v in query if k != 'access_token']
+            )
+        return cls(
+            body.get('data', []),
+            cursors.get('before'),
+            cursors.get('after'),
+            'next' in paging,
+            next_query
+        )
+
+    # Public methods.
+    def next_params(self) -> Optional[dict[str, Any]]:
+        """Return the parameters that fetch the next page, without
+        the access token, or None if there is no next page.
+        """
+        if not self.has_next:
+            return None
+        if self.after:
+            return {'after': self.after, }
+        if self.next_query is not None:
+            return dict(parse_qsl(self.next_query, True))
+        return None
+
+
+# Public classes.
+class CircuitBreaker:
+    """Stop calling an endpoint that keeps failing.
+
+    After the given number of failures in a row, the circuit opens
+    and calls are refused. Once the reset time has passed, one call
+    is let through. If it succeeds the circuit closes, otherwise it
+    opens again.
+
+    :param threshold: (Optional.) The number of failures in a row
+        that opens the circuit. The default is BREAKER_THRESHOLD.
+    :param reset: (Optional.) The number of seconds the circuit stays
+        open. The default is BREAKER_RESET.
+    """
+    def __init__(self, threshold: int = BREAKER_THRESHOLD,
+                 reset: float = BREAKER_RESET) -> None:
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self._opened: Optional[float] = None
+        self._lock = Lock()
+
+    def __repr__(self) -> str:
+        return (f'CircuitBreaker(threshold={self.threshold}, '
+                f'reset={self.reset})')
+
+    @property
+    def is_open(self) -> bool:
+        """Whether calls are being refused."""
+        with self._lock:
+            return (self._opened is not None
+                    and monotonic() - self._opened < self.reset)
+
+    # Public methods.
+    def allow(self) -> bool:
+        """Whether a call can be made now."""
+        with self._lock:
+            if self._opened is None:
+                return True
+            if monotonic() - self._opened < self.reset:
+                return False
+
+            # Let one trial call through and hold the rest until it
+            # reports back.
+            self._opened = monotonic()
+            return True
+
+    def record_failure(self) -> None:
+        """Record a failed call."""
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self._opened = monotonic()
+
+    def record_success(self) -> None:
+        """Record a successful call."""
+        with self._lock:
+            self.failures = 0
+            self._opened = None
+
+
+class RetryPolicy:
+    """How to retry idempotent Graph API calls that fail.
+
+    Delays grow exponentially up to a cap with full jitter, so a
+    fleet of clients retrying after the same failure spreads out
+    rather than retrying in step. A Retry-After header from the
+    server is used instead when one is given.
+
+    :param attempts: (Optional.) The total number of times to try a
+        call. The default is RETRY_ATTEMPTS.
+    :param base: (Optional.) The delay in seconds before the first
+        retry. The default is RETRY_BASE.
+    :param cap: (Optional.) The maximum delay in seconds. The default
+        is RETRY_CAP.
+    :param statuses: (Optional.) The HTTP statuses that are retried.
+        The default is RETRY_STATUSES.
+    :param hedge_after: (Optional.) If set, a read that hasn't
+        returned after this many seconds is sent a second time, and
+        the first response to arrive is used. The default is None.
+    """
+    def __init__(self, attempts: int = RETRY_ATTEMPTS,
+                 base: float = RETRY_BASE,
+                 cap: float = RETRY_CAP,
+                 statuses: Sequence[int] = RETRY_STATUSES,
+                 hedge_after: Optional[float] = None) -> None:
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.statuses = frozenset(statuses)
+        self.hedge_after = hedge_after
+
+    def __repr__(self) -> str:
+        return (f'RetryPolicy(attempts={self.attempts}, '
+                f'base={self.base}, cap={self.cap})')
+
+    # Public methods.
+    def delay(self, attempt: int,
+              headers: Optional[Mapping[str, str]] = None) -> float:
+        """Return how long to wait before the next try.
+
+        :param attempt: The number of the try that failed, starting
+            at zero.
+        :param headers: (Optional.) The headers of the failed
+            response.
+        :return: The number of seconds to wait.
+        :rtype: float
+        """
+        if headers and headers.get('Retry-After'):
+            retry_after = _parse_retry_after(headers['Retry-After'])
+            if retry_after is not None:
+                return min(self.cap, retry_after)
+        return uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+class Scheduler:
+    """Pace Graph API calls to stay under the usage limits.
+
+    Graph API reports how much of the app's and each business
+    account's quota has been used in the X-App-Usage and
+    X-Business-Use-Case-Usage response headers. The scheduler keeps a
+    token bucket for the app and for each account. Calls are allowed
+    at the full rate while usage is low. Once usage passes the
+    threshold, the rate is scaled down smoothly as usage approaches
+    the limit. If the limit is reached, calls are held until Graph
+    API says access is regained. Information on rate limits:
+
+        https://developers.facebook.com/docs/graph-api/overview/rate-limiting
+
+    :param rate: (Optional.) The calls per second allowed while usage
+        is low. The default is RATE.
+    :param burst: (Optional.) The number of calls that can be made at
+        once before pacing starts. The default is BURST.
+    :param threshold: (Optional.) The usage percentage where pacing
+        starts to slow. The default is USAGE_THRESHOLD.
+    """
+    def __init__(self, rate: float = RATE,
+                 burst: int = BURST,
+                 threshold: float = USAGE_THRESHOLD) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.threshold = threshold
+        self.app = TokenBucket(rate, burst)
+        self.accounts: dict[str, TokenBucket] = {}
+        self._lock = Lock()
+
+    def __repr__(self) -> str:
+        return (f'Scheduler(rate={self.rate}, burst={self.burst}, '
+                f'threshold={self.threshold})')
+
+    # Public methods.
+    def reserve(self, account: Optional[str] = None) -> float:
+        """Reserve a call.
+
+        :param account: (Optional.) The business account the call is
+            made for.
+        :return: The number of seconds to wait before making the call.
+        :rtype: float
+        """
+        delay = self.app.reserve()
+        if account is not None:
+            delay = max(delay, self._bucket(account).reserve())
+        return delay
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        """Adjust the pace from the usage headers of a response.
+
+        A header that can't be read is logged and ignored, so it
+        doesn't fail a call that otherwise succeeded.
+        """
+        app_usage = headers.get('X-App-Usage')
+        if app_usage:
+            try:
+                self._update_app(app_usage)
+            except (AttributeError, TypeError, ValueError):
+                logger.warning('Ignored bad X-App-Usage: %r', app_usage)
+
+        buc_usage = headers.get('X-Business-Use-Case-Usage')
+        if buc_usage:
+            try:
+                self._update_accounts(buc_usage)
+            except (AttributeError, TypeError, ValueError):
+                logger.warning(
+                    'Ignored bad X-Business-Use-Case-Usage: %r',
+                    buc_usage
+                )
+
+    def wait(self, account: Optional[str] = None) -> None:
+        """Block until a call can be made."""
+        delay = self.reserve(account)
+        if delay > 0:
+            metrics.observe('graph.throttle.seconds', delay)
+            sleep(delay)
+
+    # Private methods.
+    def _adjust(self, bucket: 'TokenBucket',
+                usage: float,
+                regain: float) -> None:
+        """Set the rate of a bucket from its usage."""
+        if usage >= 100:
+            bucket.pause(regain if regain else THROTTLE_PAUSE)
+        if usage <= self.threshold:
+            bucket.rate = self.rate
+            return
+        fraction = (100 - usage) / (100 - self.threshold)
+        bucket.rate = self.rate * max(MIN_RATE_FRACTION, fraction)
+
+    def _bucket(self, account: str) -> 'TokenBucket':
+        """Return the bucket for an account, creating it if needed."""
+        with self._lock:
+            if account not in self.accounts:
+                self.accounts[account] = TokenBucket(self.rate, self.burst)
+            return self.accounts[account]
+
+    def _update_accounts(self, value: str) -> None:
+        """Adjust the account buckets from a
+        X-Business-Use-Case-Usage header.
+        """
+        for account, entries in loads(value).items():
+            for entry in entries:
+                regain = entry.get('estimated_time_to_regain_access', 0)
+                self._adjust(
+                    self._bucket(account),
+                    _max_usage(entry),
+                    int(regain) * 60
+                )
+
+    def _update_app(self, value: str) -> None:
+        """Adjust the app bucket from a X-App-Usage header."""
+        self._adjust(self.app, _max_usage(loads(value)), 0)
+
+
+class SyncState:
+    """How far the incremental syncs of Graph API edges have got,
+    stored in a SQLite database so it is kept between runs.
+
+    For each account and edge, it keeps the high-water mark, which is
+    the newest time seen by the last finished sync, where a sync that
+    hasn't finished got to, and the IDs of the objects already
+    returned, so they aren't returned again.
+
+    :param path: (Optional.) The path to the database file. The
+        default is SYNC_PATH.
+    """
+    def __init__(self, path: str = SYNC_PATH) -> None:
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        import sqlite3
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = Lock()
+        with self._lock, self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS marks ('
+                'account TEXT, edge TEXT, since REAL, after TEXT, '
+                'pending REAL, next_query TEXT, '
+                'PRIMARY KEY (account, edge))'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS seen ('
+                'account TEXT, edge TEXT, id TEXT, time REAL, '
+                'PRIMARY KEY (account, edge, id)) WITHOUT ROWID'
+            )
+            self._db.execute(
+                'UPDATE seen SET time = ? WHERE time IS NULL',
+                (time(),)
+            )
+
+    def __repr__(self) -> str:
+        return f"SyncState('{self.path}')"
+
+    def __enter__(self) -> 'SyncState':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    # Public methods.
+    def close(self) -> None:
+        """Close the database."""
+        self._db.close()
+
+    def get(self, account: str, edge: str
+            ) -> tuple[Optional[float], Optional[str], Optional[float],
+                       Optional[str]]:
+        """Return the high-water mark, the cursor of an unfinished
+        sync, the newest time the unfinished sync has seen, and the
+        next page query of an unfinished sync of an edge that isn't
+        paged by cursor.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT since, after, pending, next_query FROM marks '
+                'WHERE account = ? AND edge = ?',
+                (account, edge)
+            ).fetchone()
+        if row is None:
+            return None, None, None, None
+        return row
+
+    def record(self, account: str,
+               edge: str,
+               seen: Iterable[tuple[str, Optional[float]]],
+               since: Optional[float],
+               after: Optional[str],
+               pending: Optional[float] = None,
+               next_query: Optional[str] = None) -> None:
+        """Store the progress of a sync and the objects it returned
+        in one transaction.
+
+        :param account: The account synced.
+        :param edge: The edge synced.
+        :param seen: The ID and time of each object returned. An
+            object without a time is stored with the time it was
+            recorded, so it is pruned once syncs get past that.
+        :param since: The high-water mark.
+        :param after: The cursor to continue from, or None if the
+            sync finished.
+        :param pending: (Optional.) The newest time seen by a sync
+            that hasn't finished.
+        :param next_query: (Optional.) The next page query to continue
+            from, for an edge that isn't paged by cursor.
+        """
+        now = time()
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO seen VALUES (?, ?, ?, ?)',
+                (
+                    (account, edge, id_, now if when is None else when)
+                    for id_, when in seen
+                )
+            )
+            self._db.execute(
+                'INSERT OR REPLACE INTO marks VALUES (?, ?, ?, ?, ?, ?)',
+                (account, edge, since, after, pending, next_query)
+            )
+
+    def prune(self, account: str, edge: str, before: float) -> None:
+        """Forget the objects older than a time. Syncs don't ask for
+        objects that old, so they can't be returned again.
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                'DELETE FROM seen '
+                'WHERE account = ? AND edge = ? AND time < ?',
+                (account, edge, before)
+            )
+
+    def reset(self, account: str, edge: str) -> None:
+        """Forget an edge, so the next sync fetches all of it."""
+        with self._lock, self._db:
+            for table in ('marks', 'seen'):
+                self._db.execute(
+                    f'DELETE FROM {table} WHERE account = ? AND edge = ?',
+                    (account, edge)
+                )
+
+    def unseen(self, account: str,
+               edge: str,
+               ids: Sequence[str]) -> set[str]:
+        """Return the IDs that haven't been returned before."""
+        found: set[str] = set()
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                chunk = list(ids[i:i + 500])
+                marks = ', '.join('?' for _ in chunk)
+                rows = self._db.execute(
+                    'SELECT id FROM seen WHERE account = ? AND edge = ? '
+                    f'AND id IN ({marks})',
+                    (account, edge, *chunk)
+                )
+                found.update(row[0] for row in rows)
+        return set(ids) - found
+
+
+class TokenBucket:
+    """A token bucket for pacing calls.
+
+    :param rate: The number of calls per second.
+    :param capacity: The number of calls that can be made at once.
+    """
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = monotonic()
+        self._paused_until = 0.0
+        self._lock = Lock()
+
+    def __repr__(self) -> str:
+        return f'TokenBucket(rate={self.rate}, capacity={self.capacity})'
+
+    # Public methods.
+    def pause(self, seconds: float) -> None:
+        """Hold all calls for the given number of seconds."""
+        with self._lock:
+            until = monotonic() + seconds
+            self._paused_until = max(self._paused_until, until)
+
+    def reserve(self) -> float:
+        """Take a token from the bucket.
+
+        :return: The number of seconds to wait before the token can
+            be used.
+        :rtype: float
+        """
+        with self._lock:
+            now = monotonic()
+            elapsed = now - self._updated
+            self._tokens = min(
+                self.capacity,
+                self._tokens + elapsed * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            delay = 0.0
+            if self._tokens < 0:
+                delay = -self._tokens / self.rate
+            return max(delay, self._paused_until - now)
+
+
+class TokenManager:
+    """Store a Facebook access token and keep it fresh.
+
+    The access token is stored in the OS's secret store as a
+    temporary :class:`pjisocial.connect.Token`, along with when it
+    expires, so it can be reused across runs. Once started, the
+    manager exchanges the token for a new long-lived token in the
+    background before it expires, so get() never waits on Facebook.
+
+    :param app_id: The app ID for the Facebook app.
+    :param app_secret: The app secret for the Facebook app.
+    :param account: (Optional.) The account the access token is
+        stored under. The default is the app ID's user.
+    :param refresh_margin: (Optional.) How many seconds before the
+        token expires to refresh it. The default is REFRESH_MARGIN.
+    """
+    def __init__(self, app_id: Token,
+                 app_secret: Token,
+                 account: Optional[str] = None,
+                 refresh_margin: float = REFRESH_MARGIN) -> None:
+        if account is None:
+            account = app_id.user
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.refresh_margin = refresh_margin
+        self.store = Token(ACCESS_TOKEN_LOCATION, account, temp=True)
+
+        self._lock = Lock()
+        self._timer: Optional[Timer] = None
+        self._value: Optional[str] = None
+        self._expires: Optional[float] = None
+        self._failures = 0
+        self._stopped = False
+
+    def __repr__(self) -> str:
+        return f'TokenManager({self.app_id!r}, {self.app_secret!r})'
+
+    @property
+    def expires(self) -> Optional[float]:
+        """When the token expires as a UNIX timestamp, or None if it
+        doesn't expire.
+        """
+        self._load()
+        return self._expires
+
+    # Public methods.
+    def get(self) -> str:
+        """Return the current access token."""
+        self._load()
+        if self._expires is not None and self._expires <= time():
+            raise TokenExpired('The access token has expired.')
+        return self._value                          # type: ignore
+
+    def refresh(self) -> None:
+        """Exchange the current token for a new long-lived token."""
+        resp = exchange_token(self.app_id, self.app_secret, self.get())
+        self.set(resp)
+
+    def set(self, resp: dict[str, Any]) -> None:
+        """Store the access token from a Graph API access token
+        response, such as the one returned by get_access_token().
+        """
+        expires: Optional[float] = None
+        if resp.get('expires_in'):
+            expires = time() + int(resp['expires_in'])
+        value = {
+            'access_token': resp['access_token'],
+            'expires': expires,
+        }
+        with self._lock:
+            self.store.set(dumps(value))
+            self._value = resp['access_token']
+            self._expires = expires
+        if self._timer is not None:
+            self._schedule()
+
+    def start(self) -> None:
+        """Start refreshing the token in the background."""
+        with self._lock:
+            self._stopped = False
+        self._schedule()
+
+    def stop(self) -> None:
+        """Stop refreshing the token in the background."""
+        with self._lock:
+            self._stopped = True
+            self._cancel()
+
+    # Private methods.
+    def _cancel(self) -> None:
+        """Cancel the timer. The lock must be held."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _load(self) -> None:
+        """Read the stored token if it hasn't been read yet."""
+        with self._lock:
+            if self._value is None:
+                value = loads(self.store.get())
+                self._value = value['access_token']
+                self._expires = value['expires']
+
+    def _refresh_in_background(self) -> None:
+        """Refresh the token from the timer thread."""
+        try:
+            self.refresh()
+
+        # Nothing is waiting on the result, so any failure would stop
+        # the refreshes for good without a trace. Log it and try again
+        # later, backing off while the failures continue.
+        except Exception:
+            self._failures += 1
+            delay = min(
+                REFRESH_RETRY * 2 ** (self._failures - 1),
+                REFRESH_RETRY_CAP
+            )
+            logger.exception(
+                'Refreshing the access token failed. Retrying in %s '
+                'seconds.',
+                delay
+            )
+            self._schedule(delay=delay)
+        else:
+            self._failures = 0
+
+    def _schedule(self, delay: Optional[float] = None) -> None:
+        """Set the timer for the next background refresh, unless the
+        manager has been stopped.
+        """
+        if delay is None:
+            expires = self.expires
+            if expires is not None:
+                delay = max(0, expires - self.refresh_margin - time())
+
+        # stop() may be called from another thread while a refresh
+        # is running, so it is checked under the lock stop() takes.
+        with self._lock:
+            if self._stopped:
+                return
+            self._cancel()
+            if delay is None:
+                return
+            self._timer = Timer(delay, self._refresh_in_background)
+            self._timer.daemon = True
+            self._timer.start()
 
 
 # Login functions.
-def login(app_id: Token) -> str:
+def login(app_id: Token, listener: Optional['Listener'] = None) -> str:
     """Log into Facebook.
 
     Information on Facebook access tokens:
 
         https://developers.facebook.com/docs/facebook-login/access-tokens
+
+    :param app_id: The app ID for the Facebook app.
+    :param listener: (Optional.) The listener that receives the
+        login redirect. The default is the shared listener for HOST
+        and PORT, which is started the first time it is needed.
+    :return: The code from the login. If the login redirect carries
+        an error instead, such as when the user denies the login, a
+        :class:`pjisocial.httplistener.LoginError` is raised.
+    :rtype: str
     """
     # Create the anti-CSRF token.
     anticsrf = Token('pjisocial_fb_login_anticsrf', app_id.user, temp=True)
     anticsrf.set_random(32, urlsafe=True)
-    hl.anticsrf = anticsrf.get()
+    state = anticsrf.get()
 
     # Facebook redirects the user to the redirect URI after login
-    # is successful. This server receives that redirect.
-    ctx = mp.get_context('fork')
-    queue = ctx.Queue()
-    hl.queue = queue
-    kwargs = {
-        'port': '5002',
-        'ssl_context': 'adhoc',
-    }
-    P_redirect = hl.ctx.Process(target=hl.app.run, kwargs=kwargs)
-    P_redirect.start()
-    sleep(.01)
+    # is successful. The listener receives that redirect.
+    if listener is None:
+        from pjisocial.httplistener import get_listener
+        with metrics.span('login.listener'):
+            listener = get_listener(HOST, PORT)
+    flow = listener.register(state)
 
     # Configure call.
     try:
-        # Configure the manual auth flow.
-        redirect_uri = f'https://127.0.0.1:{kwargs["port"]}/facebook_login'
+        # Call the manual auth flow.
+        with metrics.span('login.browser'):
+            get_dialog_oauth(app_id, listener.redirect_uri, anticsrf)
+
+        # Wait for the data from the Facebook login redirect.
+        with metrics.span('login.wait'):
+            code = _wait_for_code(flow)
+
+    # Clean up.
+    finally:
+        listener.unregister(state)
+
+    return code
+
+
+async def alogin(app_id: Token,
+                 listener: Optional['Listener'] = None) -> str:
+    """Log into Facebook without blocking the event loop.
+
+    Information on Facebook access tokens:
 
+        https://developers.facebook.com/docs/facebook-login/access-tokens
+
+    :param app_id: The app ID for the Facebook app.
+    :param listener: (Optional.) The listener that receives the
+        login redirect. The default is the shared listener for HOST
+        and PORT, which is started the first time it is needed.
+    :return: The code from the login. If the login redirect carries
+        an error instead, a :class:`pjisocial.httplistener.LoginError`
+        is raised.
+    :rtype: str
+    """
+    # Create the anti-CSRF token.
+    anticsrf = Token('pjisocial_fb_login_anticsrf', app_id.user, temp=True)
+    await anticsrf.aset_random(32, urlsafe=True)
+    state, client_id = await asyncio.gather(anticsrf.aget(), app_id.aget())
+
+    # Facebook redirects the user to the redirect URI after login
+    # is successful. The listener receives that redirect.
+    loop = asyncio.get_running_loop()
+    if listener is None:
+        from pjisocial.httplistener import get_listener
+        with metrics.span('login.listener'):
+            listener = await loop.run_in_executor(
+                None,
+                get_listener,
+                HOST,
+                PORT
+            )
+    flow = listener.register(state)
+
+    # Configure call.
+    try:
         # Call the manual auth flow.
-        get_dialog_oauth(app_id, redirect_uri, anticsrf)
-
-        # Poll the local server for the data from the Facebook login
-        # redirect.
-        count = 0
-        while count < TIMEOUT * 10:
-            code = hl.queue.get()
-            if code:
-                break
-            count += 1
-            sleep(0.1)
-
-        # Ensure the anticsrf token was passed.
-        if isinstance(code, hl.Csrf):
-            raise code
+        import webbrowser
+        url = _dialog_oauth_url(client_id, listener.redirect_uri, state)
+        with metrics.span('login.browser'):
+            await loop.run_in_executor(None, webbrowser.open, url)
+
+        # Wait for the data from the Facebook login redirect.
+        try:
+            with metrics.span('login.wait'):
+                code = await asyncio.wait_for(
+                    asyncio.wrap_future(flow),
+                    TIMEOUT
+                )
+        except asyncio.TimeoutError:
+            msg = f'No login redirect received in {TIMEOUT} seconds.'
+            raise LoginTimeout(msg)
 
     # Clean up.
     finally:
-        P_redirect.terminate()
+        listener.unregister(state)
 
     return code
 
@@ -88,14 +899,8 @@ def get_dialog_oauth(app_id: Token,
                      redirect_uri: str,
                      state: Token) -> None:
     """Starts the manual authentication flow."""
-    # Configure call.
-    path = '/dialog/oauth'
-
-    # Make call.
-    url = (f'{SCHEME}://{FB_DOMAIN}{API}{path}'
-           f'?client_id={app_id.get()}'
-           f'&redirect_uri={redirect_uri}'
-           f'&state={state.get()}')
+    import webbrowser
+    url = _dialog_oauth_url(app_id.get(), redirect_uri, state.get())
     webbrowser.open(url)
 
 
@@ -104,22 +909,765 @@ def get_access_token(app_id: Token,
                      redirect_uri: str,
                      app_secret: Token,
                      code: str) -> dict[str, Any]:
-    """Get an access token for a code."""
+    """Get an access token for a code. Pass the response to
+    AccessToken.from_dict() for a typed response.
+    """
+    # Configure call.
+    path = '/oauth/access_token'
+    client_id, client_secret = Token.get_many([app_id, app_secret])
+    q = {
+        'client_id': client_id,
+        'redirect_uri': redirect_uri,
+        'client_secret': client_secret,
+        'code': code,
+    }
+
+    # Make the call. A code can only be used once, so the call is
+    # never retried or hedged.
+    url = f'{SCHEME}://{DOMAIN}{API}{path}'
+    resp = _get(url, q, idempotent=False)
+
+    # Translate the response.
+    return decode(resp.content)
+
+
+def get_access_tokens(exchanges: Sequence[tuple[Token, str, Token, str]],
+                      workers: int = EXCHANGE_WORKERS
+                      ) -> list[Union[dict[str, Any], Exception]]:
+    """Get access tokens for many codes at once.
+
+    If the secret cache is enabled, the secrets for all the exchanges
+    are read first in one Token.get_many() call, so they are already
+    cached when the exchanges start. The exchanges then run concurrently over
+    the shared session's pooled connections.
+
+    :param exchanges: The exchanges to make, each given as the
+        arguments for get_access_token(): the app ID, the redirect
+        URI, the app secret, and the code.
+    :param workers: (Optional.) The maximum number of exchanges made
+        at the same time. The default is EXCHANGE_WORKERS.
+    :return: The access token response for each exchange, in the
+        same order as the exchanges. An exchange that failed is given
+        as the exception it raised instead.
+    :rtype: list
+    """
+    # Warm the secret cache. A missing secret only fails the
+    # exchanges that use it, which find it missing when they run.
+    if cx.secret_cache is not None:
+        tokens = {
+            t.cache_key: t for e in exchanges for t in (e[0], e[2])
+        }
+        try:
+            Token.get_many(list(tokens.values()))
+        except cx.SecretDoesNotExist:
+            pass
+
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(_try_exchange, exchanges))
+
+
+def exchange_token(app_id: Token,
+                   app_secret: Token,
+                   access_token: str) -> dict[str, Any]:
+    """Exchange an access token for a long-lived access token. Pass
+    the response to AccessToken.from_dict() for a typed response.
+    """
+    # Configure call.
+    path = '/oauth/access_token'
+    client_id, client_secret = Token.get_many([app_id, app_secret])
+    q = {
+        'grant_type': 'fb_exchange_token',
+        'client_id': client_id,
+        'client_secret': client_secret,
+        'fb_exchange_token': access_token,
+    }
+
+    # Make the call. The exchange isn't retried or hedged, since
+    # sending it twice could issue two tokens.
+    url = f'{SCHEME}://{DOMAIN}{API}{path}'
+    resp = _get(url, q, idempotent=False)
+
+    # Translate the response.
+    return _decode(resp)
+
+
+async def aget_access_token(app_id: Token,
+                            redirect_uri: str,
+                            app_secret: Token,
+                            code: str) -> dict[str, Any]:
+    """Get an access token for a code without blocking the event
+    loop. Pass the response to AccessToken.from_dict() for a typed
+    response.
+    """
     # Configure call.
     path = '/oauth/access_token'
+    client_id, client_secret = await asyncio.gather(
+        app_id.aget(),
+        app_secret.aget()
+    )
     q = {
-        'client_id': app_id.get(),
+        'client_id': client_id,
         'redirect_uri': redirect_uri,
-        'client_secret': app_secret.get(),
+        'client_secret': client_secret,
         'code': code,
     }
 
-    # Make the call.
+    # Make the call. A code can only be used once, so the call is
+    # never retried.
     url = f'{SCHEME}://{DOMAIN}{API}{path}'
-    resp = get(url, q)
+    resp = await _aget(url, q, idempotent=False)
 
     # Translate the response.
-    return loads(resp.text)
+    return decode(resp.content)
+
+
+# Batch API calls.
+def batch(requests: Sequence[dict[str, Any]],
+          access_token: Token,
+          account: Optional[str] = None) -> list[Union[Any, GraphError]]:
+    """Make many Graph API calls with as few round trips as possible.
+
+    The calls are packed into batches of BATCH_SIZE, and up to
+    BATCH_WORKERS batches are sent at the same time. Information on
+    batch requests:
+
+        https://developers.facebook.com/docs/graph-api/batch-requests
+
+    :param requests: The calls to make. Each call is a dictionary in
+        the format Graph API expects for a batch item, for example
+        `{'method': 'GET', 'relative_url': 'me?fields=id'}`.
+    :param access_token: The access token for the calls.
+    :param account: (Optional.) The business account the calls are
+        made for. This is used to pace the calls when a scheduler
+        is set.
+    :return: The decoded body of each response, in the same order as
+        the calls. A call that failed is given as a
+        :class:`GraphError` instead.
+    :rtype: list
+    """
+    token = access_token.get()
+    chunks = [
+        requests[i:i + BATCH_SIZE]
+        for i in range(0, len(requests), BATCH_SIZE)
+    ]
+    with ThreadPoolExecutor(BATCH_WORKERS) as executor:
+        results = executor.map(
+            _post_batch,
+            chunks,
+            repeat(token),
+            repeat(account)
+        )
+        return [item for result in results for item in result]
+
+
+# Query building.
+def build_query(fields: Any = DEFAULT_FIELDS,
+                limit: Optional[int] = None,
+                since: Any = None,
+                until: Any = None,
+                **params: Any) -> dict[str, Any]:
+    """Build the parameters for a Graph API read.
+
+    Asking only for the fields that are needed keeps responses small,
+    so the defaults ask for as little as possible.
+
+        >>> build_query(['id', {'comments': ['id', 'message']}], 25)
+        {'fields': 'id,comments{id,message}', 'limit': 25}
+
+    :param fields: (Optional.) The fields to return, in any form
+        format_fields() accepts. Passing None leaves the fields out of
+        the query. The default is DEFAULT_FIELDS.
+    :param limit: (Optional.) The maximum number of items returned.
+    :param since: (Optional.) Only return items after this time, as
+        a datetime, a UNIX timestamp, or a string Graph API accepts.
+    :param until: (Optional.) Only return items before this time, in
+        the same forms as since.
+    :return: The query parameters.
+    :rtype: dict
+    """
+    q: dict[str, Any] = {}
+    if fields:
+        q['fields'] = format_fields(fields)
+    if limit is not None:
+        q['limit'] = limit
+    if since is not None:
+        q['since'] = _format_time(since)
+    if until is not None:
+        q['until'] = _format_time(until)
+    q.update(params)
+    return q
+
+
+def format_fields(fields: Any) -> str:
+    """Format a field selection for the fields parameter of a Graph
+    API read.
+
+    The fields can be given as a string, which is used as is, or as a
+    sequence of field names. Fields of a connected object are given
+    as a mapping from the name of the connection to its fields, which
+    can be nested further.
+
+        >>> format_fields(['id', {'from': ['name'], 'comments': None}])
+        'id,from{name},comments'
+
+    :param fields: The fields to select.
+    :return: The value for the fields parameter.
+    :rtype: str
+    """
+    if isinstance(fields, str):
+        return fields
+    if isinstance(fields, Mapping):
+        parts = []
+        for name, sub in fields.items():
+            if sub:
+                parts.append(f'{name}{{{format_fields(sub)}}}')
+            else:
+                parts.append(name)
+        return ','.join(parts)
+    return ','.join(format_fields(field) for field in fields)
+
+
+# Paging API calls.
+def iter_pages(path: str,
+               access_token: Token,
+               fields: Any = DEFAULT_FIELDS,
+               limit: int = PAGE_LIMIT,
+               params: Optional[dict[str, Any]] = None,
+               account: Optional[str] = None,
+               since: Any = None,
+               until: Any = None,
+               after: Optional[str] = None,
+               next_query: Optional[str] = None) -> Iterator[Page]:
+    """Stream the pages of a Graph API edge.
+
+    This works like paginate(), but hands back each page with its
+    cursors, so a caller can record where it got to and start again
+    from there later. Edges paged by cursor are followed with the
+    after cursor. Edges paged by time or offset, such as feeds and
+    insights, have no cursor and are followed with the query of the
+    next page's URL instead.
+
+    :param path: The path of the edge, such as '/me/posts'.
+    :param access_token: The access token for the calls.
+    :param fields: (Optional.) The fields to return for each item.
+        The default is DEFAULT_FIELDS.
+    :param limit: (Optional.) The number of items in each page. The
+        default is PAGE_LIMIT.
+    :param params: (Optional.) Any other parameters for the call.
+    :param account: (Optional.) The business account the calls are
+        made for.
+    :param since: (Optional.) Only return items after this time.
+    :param until: (Optional.) Only return items before this time.
+    :param after: (Optional.) The cursor to start after. The default
+        is to start at the first page.
+    :param next_query: (Optional.) The next_query of a page, to start
+        at the page after it. This is used instead of after for
+        edges that aren't paged by cursor.
+    :return: A generator of :class:`pjisocial.facebook.Page` objects.
+    :rtype: Iterator
+    """
+    url = f'{SCHEME}://{DOMAIN}{API}{path}'
+    token = access_token.get()
+    q = build_query(fields, limit, since, until, **(params or {}))
+    if after:
+        q['after'] = after
+    elif next_query is not None:
+        q = dict(parse_qsl(next_query, True))
+    q['access_token'] = token
+
+    executor = ThreadPoolExecutor(1, thread_name_prefix='pjisocial_page')
+    try:
+        page: Optional[Future[Page]]
+        page = executor.submit(_get_page, url, dict(q), account)
+        while page is not None:
+            current = page.result()
+
+            # Start fetching the next page before this page is
+            # handed back. The next page's URL keeps every parameter
+            # of the call, so when the edge isn't paged by cursor its
+            # query replaces the one used so far.
+            page = None
+            next_params = current.next_params()
+            if next_params is not None:
+                if not current.after:
+                    q = {'access_token': token, }
+                q.update(next_params)
+                page = executor.submit(_get_page, url, dict(q), account)
+
+            yield current
+
+    # Clean up.
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def paginate(path: str,
+             access_token: Token,
+             fields: Any = DEFAULT_FIELDS,
+             limit: int = PAGE_LIMIT,
+             params: Optional[dict[str, Any]] = None,
+             account: Optional[str] = None,
+             since: Any = None,
+             until: Any = None) -> Iterator[Any]:
+    """Stream the items of a Graph API edge, such as a page's posts.
+
+    Pages are fetched one at a time as the items are consumed, so
+    memory use doesn't grow with the size of the edge. While the
+    items of one page are being consumed, the next page is already
+    being fetched. Information on paging:
+
+        https://developers.facebook.com/docs/graph-api/results
+
+    :param path: The path of the edge, such as '/me/posts'.
+    :param access_token: The access token for the calls.
+    :param fields: (Optional.) The fields to return for each item,
+        in any form format_fields() accepts. Passing None returns
+        the fields Graph API returns by default. The default is
+        DEFAULT_FIELDS.
+    :param limit: (Optional.) The number of items in each page. The
+        default is PAGE_LIMIT.
+    :param params: (Optional.) Any other parameters for the call.
+    :param account: (Optional.) The business account the calls are
+        made for. This is used to pace the calls when a scheduler
+        is set.
+    :param since: (Optional.) Only return items after this time.
+    :param until: (Optional.) Only return items before this time.
+    :return: A generator of the items of the edge.
+    :rtype: Iterator
+    """
+    pages = iter_pages(
+        path,
+        access_token,
+        fields,
+        limit,
+        params,
+        account,
+        since,
+        until
+    )
+    for page in pages:
+        yield from page.data
+
+
+# Incremental sync.
+def sync(path: str,
+         access_token: Token,
+         state: Optional[SyncState] = None,
+         account: Optional[str] = None,
+         fields: Any = SYNC_FIELDS,
+         time_field: str = 'created_time',
+         limit: int = PAGE_LIMIT,
+         params: Optional[dict[str, Any]] = None) -> Iterator[Any]:
+    """Stream the items of a Graph API edge that are new since the
+    last sync.
+
+    Only items after the high-water mark of the last finished sync
+    are fetched, less SYNC_OVERLAP seconds to catch items that were
+    late to appear. Items that were already returned are skipped by
+    their ID. Progress is stored after each page has been consumed,
+    so a sync that stops part way continues from its cursor the next
+    time, and no item is lost if the caller fails while handling it.
+
+    :param path: The path of the edge, such as '/me/posts'.
+    :param access_token: The access token for the calls.
+    :param state: (Optional.) Where the progress is stored. The
+        default is a SyncState at SYNC_PATH.
+    :param account: (Optional.) The business account the calls are
+        made for. Each account's progress is stored separately.
+    :param fields: (Optional.) The fields to return for each item.
+        They should include id and the time field. The default is
+        SYNC_FIELDS.
+    :param time_field: (Optional.) The field that holds the time of
+        each item. The default is 'created_time'.
+    :param limit: (Optional.) The number of items in each page. The
+        default is PAGE_LIMIT.
+    :param params: (Optional.) Any other parameters for the call.
+    :return: A generator of the new items of the edge.
+    :rtype: Iterator
+    """
+    if state is None:
+        with SyncState() as state:
+            yield from sync(path, access_token, state, account, fields,
+                            time_field, limit, params)
+        return
+
+    key = account or ''
+    since, after, high, next_query = state.get(key, path)
+    if high is None:
+        high = since
+    start = None if since is None else int(since - SYNC_OVERLAP)
+
+    pages = iter_pages(
+        path,
+        access_token,
+        fields,
+        limit,
+        params,
+        account,
+        since=start,
+        after=after,
+        next_query=next_query
+    )
+    for page in pages:
+        ids = [str(item['id']) for item in page.data if 'id' in item]
+        new = state.unseen(key, path, ids)
+        seen = []
+        for item in page.data:
+            when = _parse_graph_time(item.get(time_field))
+            if when is not None and (high is None or when > high):
+                high = when
+            id_ = str(item['id']) if 'id' in item else None
+            if id_ is not None:
+                if id_ not in new:
+                    continue
+                new.discard(id_)
+                seen.append((id_, when))
+            yield item
+
+        # The high-water mark only moves once the whole edge has been
+        # synced, so a sync that stops part way still asks for every
+        # item it hasn't returned yet.
+        if page.next_params() is not None:
+            state.record(key, path, seen, since, page.after, high,
+                         None if page.after else page.next_query)
+        else:
+            state.record(key, path, seen, high, None)
+    if high is not None:
+        state.prune(key, path, high - SYNC_OVERLAP)
+
+
+# Scheduling.
+scheduler: Optional[Scheduler] = None
+
+
+def set_scheduler(new: Optional[Scheduler]) -> None:
+    """Pace all Graph API calls with the given scheduler. Passing
+    None stops pacing calls.
+    """
+    global scheduler
+    scheduler = new
+
+
+# Retrying.
+retry_policy: Optional[RetryPolicy] = RetryPolicy()
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = Lock()
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_breaker(url: str) -> CircuitBreaker:
+    """Return the circuit breaker for an endpoint."""
+    with _breakers_lock:
+        if url not in _breakers:
+            _breakers[url] = CircuitBreaker()
+        return _breakers[url]
+
+
+def set_retry_policy(new: Optional[RetryPolicy]) -> None:
+    """Retry failed idempotent Graph API calls with the given policy.
+    Passing None stops retrying calls.
+    """
+    global retry_policy
+    retry_policy = new
+
+
+# Utility functions.
+async def _aget(url: str,
+                params: dict[str, Any],
+                account: Optional[str] = None,
+                idempotent: bool = True) -> Response:
+    """Make a paced GET call to Graph API without blocking the event
+    loop, retrying it if it fails and is idempotent.
+    """
+    attempt = 0
+    while True:
+        _check_circuit(url)
+        if scheduler is not None:
+            delay = scheduler.reserve(account)
+            if delay > 0:
+                metrics.observe('graph.throttle.seconds', delay)
+                await asyncio.sleep(delay)
+        try:
+            resp = await get_session().aget(url, params)
+        except (RequestsConnectionError, Timeout):
+            retry = _retry_delay(url, attempt, idempotent=idempotent)
+            if retry is None:
+                raise
+        else:
+            if scheduler is not None:
+                scheduler.update(resp.headers)
+            retry = _retry_delay(url, attempt, resp, idempotent)
+            if retry is None:
+                return resp
+        metrics.count('graph.retries', endpoint=metrics.endpoint(url))
+        await asyncio.sleep(retry)
+        attempt += 1
+
+
+def _check_circuit(url: str) -> None:
+    """Refuse the call if the endpoint's circuit is open."""
+    if retry_policy is not None and not get_breaker(url).allow():
+        metrics.count('graph.circuit_open', endpoint=metrics.endpoint(url))
+        msg = f'Circuit open for {url}.'
+        raise CircuitOpen(msg)
+
+
+def _decode(resp: Response) -> Any:
+    """Decode a Graph API response, raising any error it returns."""
+    body = decode(resp.content)
+    if isinstance(body, dict) and 'error' in body:
+        raise _graph_error(body, resp.status_code)
+    return body
+
+
+def _decode_batch_item(item: Optional[dict[str, Any]]
+                       ) -> Union[Any, GraphError]:
+    """Decode one response from a batch request."""
+    # Graph API returns null for items that didn't complete before
+    # the batch timed out.
+    if item is None:
+        return GraphError('Batch item did not complete.')
+
+    body = decode(item['body']) if item.get('body') else None
+    if item['code'] >= 400:
+        return _graph_error(body, item['code'])
+    return body
+
+
+def _dialog_oauth_url(client_id: str, redirect_uri: str, state: str) -> str:
+    """Build the URL that starts the manual authentication flow."""
+    path = '/dialog/oauth'
+    return (f'{SCHEME}://{FB_DOMAIN}{API}{path}'
+            f'?client_id={client_id}'
+            f'&redirect_uri={redirect_uri}'
+            f'&state={state}')
+
+
+def _format_time(value: Any) -> Any:
+    """Convert a time to a form Graph API accepts for since and
+    until.
+    """
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    return value
+
+
+def _get(url: str,
+         params: dict[str, Any],
+         account: Optional[str] = None,
+         idempotent: bool = True) -> Response:
+    """Make a paced GET call to Graph API, retrying it if it fails.
+
+    Calls that aren't idempotent, such as exchanging a code for a
+    token, are never retried or hedged.
+    """
+    attempt = 0
+    while True:
+        _check_circuit(url)
+        if scheduler is not None:
+            scheduler.wait(account)
+        try:
+            if idempotent:
+                resp = _hedged_get(url, params)
+            else:
+                resp = get_session().get(url, params)
+        except (RequestsConnectionError, Timeout):
+            retry = _retry_delay(url, attempt, idempotent=idempotent)
+            if retry is None:
+                raise
+        else:
+            if scheduler is not None:
+                scheduler.update(resp.headers)
+            retry = _retry_delay(url, attempt, resp, idempotent)
+            if retry is None:
+                return resp
+        metrics.count('graph.retries', endpoint=metrics.endpoint(url))
+        sleep(retry)
+        attempt += 1
+
+
+def _get_hedge_executor() -> ThreadPoolExecutor:
+    """Return the thread pool that hedged calls run in, creating it
+    if needed.
+    """
+    global _hedge_executor
+    if _hedge_executor is None:
+        _hedge_executor = ThreadPoolExecutor(
+            HEDGE_WORKERS,
+            thread_name_prefix='pjisocial_hedge'
+        )
+    return _hedge_executor
+
+
+def _get_page(url: str,
+              params: dict[str, Any],
+              account: Optional[str] = None) -> Page:
+    """Fetch and decode one page of an edge."""
+    return Page.from_dict(_decode(_get(url, params, account)))
+
+
+def _graph_error(body: Any, status: Optional[int] = None) -> GraphError:
+    """Build a GraphError from a Graph API error response."""
+    try:
+        error = body['error']
+    except (KeyError, TypeError):
+        metrics.count('graph.errors', code='')
+        return GraphError(f'Graph API returned status {status}.',
+                          status=status)
+    metrics.count('graph.errors', code=str(error.get('code', '')))
+    return GraphError(
+        error.get('message', ''),
+        error.get('code'),
+        error.get('error_subcode'),
+        status
+    )
+
+
+def _hedged_get(url: str, params: dict[str, Any]) -> Response:
+    """Make a GET call, sending it a second time if the first is slow
+    and the retry policy asks for hedging.
+    """
+    session = get_session()
+    if retry_policy is None or retry_policy.hedge_after is None:
+        return session.get(url, params)
+
+    # The calls run in a long-lived pool, so returning doesn't wait
+    # for the slower call. Its response is dropped when it arrives.
+    executor = _get_hedge_executor()
+    first = executor.submit(session.get, url, params)
+    done, _ = wait_futures([first, ], retry_policy.hedge_after)
+    if done:
+        return first.result()
+    metrics.count('graph.hedges', endpoint=metrics.endpoint(url))
+    second = executor.submit(session.get, url, params)
+
+    # If the first call to finish failed, the other may still succeed.
+    for future in as_completed([first, second]):
+        if future.exception() is None:
+            break
+    return future.result()
+
+
+def _max_usage(usage: Mapping[str, Any]) -> float:
+    """Return the highest usage percentage from a usage header."""
+    keys = ('call_count', 'total_cputime', 'total_time')
+    return max(float(usage.get(key, 0)) for key in keys)
+
+
+def _parse_retry_after(value: str) -> Optional[float]:
+    """Return the seconds to wait from a Retry-After header."""
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, when.timestamp() - time())
+
+
+def _parse_graph_time(value: Any) -> Optional[float]:
+    """Return a time from Graph API as a Unix timestamp."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z').timestamp()
+    except ValueError:
+        return None
+
+
+def _post(url: str,
+          data: dict[str, Any],
+          account: Optional[str] = None) -> Response:
+    """Make a paced POST call to Graph API."""
+    if scheduler is not None:
+        scheduler.wait(account)
+    resp = get_session().post(url, data)
+    if scheduler is not None:
+        scheduler.update(resp.headers)
+    return resp
+
+
+def _post_batch(chunk: Sequence[dict[str, Any]],
+                token: str,
+                account: Optional[str] = None
+                ) -> list[Union[Any, GraphError]]:
+    """Send one batch request and split out the responses."""
+    url = f'{SCHEME}://{DOMAIN}{API}'
+    data = {
+        'access_token': token,
+        'batch': dumps(list(chunk)),
+        'include_headers': 'false',
+    }
+    try:
+        resp = _post(url, data, account)
+        body = decode(resp.content)
+    except (RequestException, ValueError) as ex:
+        return [GraphError(str(ex)) for _ in chunk]
+
+    if resp.status_code >= 400 or not isinstance(body, list):
+        error = _graph_error(body, resp.status_code)
+        return [error for _ in chunk]
+    return [_decode_batch_item(item) for item in body]
+
+
+def _retry_delay(url: str,
+                 attempt: int,
+                 resp: Optional[Response] = None,
+                 idempotent: bool = True) -> Optional[float]:
+    """Record the result of a call with the endpoint's circuit
+    breaker and decide whether to retry it.
+
+    :param url: The endpoint called.
+    :param attempt: The number of the try, starting at zero.
+    :param resp: (Optional.) The response, or None if the call raised
+        a connection error or timed out.
+    :param idempotent: (Optional.) Whether the call can be retried.
+        The default is True.
+    :return: The seconds to wait before retrying, or None if the call
+        should not be retried.
+    :rtype: float or None
+    """
+    if retry_policy is None:
+        return None
+    breaker = get_breaker(url)
+    if resp is not None and resp.status_code not in retry_policy.statuses:
+        breaker.record_success()
+        return None
+    breaker.record_failure()
+    if not idempotent:
+        return None
+    if attempt + 1 >= retry_policy.attempts or breaker.is_open:
+        return None
+    headers = resp.headers if resp is not None else None
+    return retry_policy.delay(attempt, headers)
+
+
+def _try_exchange(exchange: tuple[Token, str, Token, str]
+                  ) -> Union[dict[str, Any], Exception]:
+    """Get an access token for one exchange of a bulk exchange,
+    returning any error rather than raising it.
+    """
+    try:
+        body = get_access_token(*exchange)
+        if 'error' in body:
+            raise _graph_error(body)
+        return body
+    except (cx.SecretDoesNotExist, CircuitOpen, GraphError,
+            RequestException, ValueError) as ex:
+        return ex
+
+
+def _wait_for_code(flow: Future) -> str:
+    """Wait for the code from the Facebook login redirect."""
+    try:
+        return flow.result(timeout=TIMEOUT)
+    except FutureTimeout:
+        msg = f'No login redirect received in {TIMEOUT} seconds.'
+        raise LoginTimeout(msg)
 
 
 if __name__ == '__main__':
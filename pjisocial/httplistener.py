@@ -3,60 +3,833 @@ httplistener
 ~~~~~~~~~~~~
 
 A webserver for interacting with social media API calls.
+
+The servers here are built on Werkzeug's development server. That is
+enough for the login redirects and a modest webhook load. To serve
+the application with a production WSGI server instead, point it at
+pjisocial.httplistener:app, such as::
+
+    waitress-serve --port 5002 pjisocial.httplistener:app
 """
-import click                                    # type: ignore
+import argparse
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from datetime import datetime, timezone
+import hashlib
+import hmac
 import logging
-import multiprocessing as mp
-from typing import Optional
+import os
+from queue import Full, Queue
+import signal
+import socket
+from tempfile import NamedTemporaryFile
+from threading import Lock, Thread, current_thread, main_thread
+from time import monotonic
+from typing import TYPE_CHECKING, Any, Callable, Optional, Sequence
 
-from flask import Flask, make_response, request
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.serving import make_server as _make_server
+from werkzeug.serving import generate_adhoc_ssl_pair
 
 from pjisocial import connect as cx
+from pjisocial import metrics
+
+# Flask is slow to import, so it is only imported once the web
+# application is needed.
+if TYPE_CHECKING:
+    from flask import Flask
+
+
+# Configuration.
+HOST = '127.0.0.1'
+PORT = 5002
+FLOW_TTL = 600
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_WORKERS = 4
+WEBHOOK_PUT_TIMEOUT = 1
+WORKERS = 8
+REQUEST_TIMEOUT = 30
+CERT_PATH = os.path.join(
+    os.path.expanduser('~'),
+    '.cache',
+    'pjisocial',
+    'listener'
+)
+CERT_RENEW_MARGIN = 7 * 24 * 60 * 60
 
 
 # Exceptions.
-class Csrf(RuntimeError):
-    """The anti-CSRF token was not in the request."""
+class LoginError(RuntimeError):
+    """The login redirect returned an error instead of a code."""
+
+
+# Logging.
+logger = logging.getLogger(__name__)
+
+
+# Public classes.
+class FlowRegistry:
+    """Logins waiting for a redirect, keyed by their state.
+
+    The state of a login is its anti-CSRF token, so a redirect is
+    only routed to a login if it carries a state that was registered.
+    Logins that are never completed are dropped after they expire.
+
+    :param ttl: (Optional.) The number of seconds a login waits for
+        its redirect before it is dropped. The default is FLOW_TTL.
+    """
+    def __init__(self, ttl: float = FLOW_TTL) -> None:
+        self.ttl = ttl
+        self._flows: dict[str, tuple[float, Future]] = {}
+        self._lock = Lock()
+        self._next_sweep = monotonic() + ttl
+
+    def __contains__(self, state: str) -> bool:
+        return state in self._flows
+
+    def __len__(self) -> int:
+        return len(self._flows)
+
+    def __repr__(self) -> str:
+        return f'FlowRegistry(ttl={self.ttl})'
+
+    # Public methods.
+    def expire(self) -> int:
+        """Drop the logins that have expired.
+
+        :return: The number of logins dropped.
+        :rtype: int
+        """
+        now = monotonic()
+        with self._lock:
+            states = [k for k, v in self._flows.items() if v[0] <= now]
+            expired = [self._flows.pop(state)[1] for state in states]
+            self._next_sweep = now + self.ttl
+        for flow in expired:
+            flow.cancel()
+        return len(expired)
+
+    def register(self, state: str) -> Future:
+        """Wait for the redirect for a login.
+
+        :param state: The anti-CSRF token sent with the login.
+        :return: A :class:`concurrent.futures.Future` that gets the
+            code when the redirect is received.
+        :rtype: concurrent.futures.Future
+        """
+        # Abandoned logins are swept at most once per TTL, so the cost
+        # of registering stays constant.
+        if monotonic() >= self._next_sweep:
+            self.expire()
+
+        flow: Future = Future()
+        with self._lock:
+            self._flows[state] = (monotonic() + self.ttl, flow)
+        return flow
+
+    def reject(self, state: str, ex: BaseException) -> bool:
+        """Fail the login waiting for a redirect with an error.
+
+        :param state: The state returned with the redirect.
+        :param ex: The exception the login raises.
+        :return: Whether a login was waiting for the state.
+        :rtype: bool
+        """
+        flow = self._pop(state)
+        if flow is None:
+            return False
+        try:
+            flow.set_exception(ex)
+        except InvalidStateError:
+            return False
+        return True
+
+    def resolve(self, state: str, code: str) -> bool:
+        """Pass the code from a redirect to the login waiting for it.
+
+        :param state: The state returned with the redirect.
+        :param code: The code returned with the redirect.
+        :return: Whether a login was waiting for the state.
+        :rtype: bool
+        """
+        flow = self._pop(state)
+        if flow is None:
+            return False
+        try:
+            flow.set_result(code)
+        except InvalidStateError:
+            return False
+        return True
+
+    def unregister(self, state: str) -> None:
+        """Stop waiting for the redirect for a login."""
+        with self._lock:
+            _, flow = self._flows.pop(state, (0, None))
+        if flow is not None:
+            flow.cancel()
+
+    # Private methods.
+    def _pop(self, state: str) -> Optional[Future]:
+        """Remove the login waiting for a state, if it hasn't
+        expired.
+        """
+        with self._lock:
+            deadline, flow = self._flows.pop(state, (0, None))
+        if flow is None or deadline <= monotonic():
+            return None
+        return flow
+
+
+class Listener:
+    """A long-lived server for login redirects.
+
+    The server runs in a background thread of the current process and
+    uses a cached certificate, so it is only set up once no matter
+    how many logins it serves. Each login registers its anti-CSRF
+    token as its state, and the redirect for that state is routed
+    back to it. Any number of logins can be waiting at once.
+
+    :param host: (Optional.) The address to listen on. The default
+        is HOST.
+    :param port: (Optional.) The port to listen on. The default is
+        PORT.
+    :param ssl_context: (Optional.) The SSL context for the server.
+        The default is the cached certificate from get_ssl_context().
+    """
+    def __init__(self, host: str = HOST,
+                 port: int = PORT,
+                 ssl_context: Any = None) -> None:
+        self.host = host
+        self.port = int(port)
+        self.ssl_context = ssl_context
+        self._server: Optional[BaseWSGIServer] = None
+        self._thread: Optional[Thread] = None
+
+    def __repr__(self) -> str:
+        return f"Listener('{self.host}', {self.port})"
+
+    @property
+    def is_alive(self) -> bool:
+        """Whether the server is running."""
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def redirect_uri(self) -> str:
+        """The URI Facebook should redirect logins to."""
+        return f'https://{self.host}:{self.port}/facebook_login'
+
+    # Public methods.
+    def register(self, state: str) -> Future:
+        """Wait for the redirect for a login.
+
+        :param state: The anti-CSRF token sent with the login.
+        :return: A :class:`concurrent.futures.Future` that gets the
+            code when the redirect is received.
+        :rtype: concurrent.futures.Future
+        """
+        return flows.register(state)
+
+    def start(self) -> None:
+        """Start the server."""
+        if self.is_alive:
+            return
+        ssl_context = self.ssl_context
+        if ssl_context is None:
+            ssl_context = get_ssl_context()
+        self._server = make_server(
+            self.host,
+            self.port,
+            ssl_context,
+            threaded=True
+        )
+        self._thread = Thread(
+            target=self._server.serve_forever,
+            name='pjisocial_listener',
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the server."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+        self._server = None
+        self._thread = None
+
+    def unregister(self, state: str) -> None:
+        """Stop waiting for the redirect for a login."""
+        flows.unregister(state)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """A WSGI server that handles requests in a fixed pool of worker
+    threads, so a burst of requests can't start an unbounded number
+    of threads. Closing the server waits for requests in progress to
+    finish.
+
+    The TLS handshake is done in the worker thread rather than when
+    the connection is accepted, and each connection times out after
+    REQUEST_TIMEOUT seconds, so a client that connects and then sends
+    nothing can't hold up the server. This is still Werkzeug's
+    development server underneath. See the module's documentation
+    for running the application in a production WSGI server.
+
+    :param host: The address to listen on.
+    :param port: The port to listen on.
+    :param app: The WSGI application to serve.
+    :param workers: (Optional.) The number of worker threads. The
+        default is WORKERS.
+    :param ssl_context: (Optional.) The SSL context for the server.
+        This can be anything the Werkzeug server accepts, such as
+        'adhoc' or a (cert, key) tuple.
+    """
+    def __init__(self, host: str,
+                 port: int,
+                 app: Any,
+                 workers: int = WORKERS,
+                 ssl_context: Any = None) -> None:
+        super().__init__(
+            host,
+            int(port),
+            app,
+            handler=_QuietRequestHandler,
+            ssl_context=ssl_context
+        )
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(
+            workers,
+            thread_name_prefix='pjisocial_http'
+        )
+
+    # Public methods.
+    def get_request(self) -> tuple[Any, Any]:
+        """Accept a connection, leaving the TLS handshake to the
+        worker thread.
+        """
+        if self.ssl_context is None:
+            return super().get_request()
+        return socket.socket.accept(self.socket)
+
+    def process_request(self, request: Any, client_address: Any) -> None:
+        """Hand the request to a worker thread."""
+        self._executor.submit(self._handle, request, client_address)
+
+    def server_close(self) -> None:
+        """Stop listening and wait for requests in progress."""
+        super().server_close()
+        self._executor.shutdown(wait=True)
+
+    # Private methods.
+    def _handle(self, request: Any, client_address: Any) -> None:
+        """Handle a request in a worker thread."""
+        request.settimeout(REQUEST_TIMEOUT)
+        if self.ssl_context is not None:
+            try:
+                request = self.ssl_context.wrap_socket(
+                    request,
+                    server_side=True
+                )
+
+            # SSL errors and timeouts are both kinds of OSError.
+            except OSError as ex:
+                logger.debug('TLS handshake with %s failed: %s',
+                             client_address, ex)
+                self.shutdown_request(request)
+                return
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class WebhookProcessor:
+    """Process the payloads Facebook pushes to the webhook endpoint.
+
+    Payloads are acknowledged as soon as they are verified and put in
+    a bounded queue, and worker threads hand them to the handler.
+    When the queue is full, new payloads are refused so Facebook
+    delivers them again later, rather than the listener running out
+    of memory. Information on webhooks:
+
+        https://developers.facebook.com/docs/graph-api/webhooks
+
+    :param handler: The function called with each decoded payload.
+    :param app_secret: The app secret, used to verify payloads came
+        from Facebook.
+    :param verify_token: The token given to Facebook when the webhook
+        was set up, used to verify the subscription.
+    :param maxsize: (Optional.) The maximum number of payloads waiting
+        to be handled. The default is WEBHOOK_QUEUE_SIZE.
+    :param workers: (Optional.) The number of threads handling
+        payloads. The default is WEBHOOK_WORKERS.
+    """
+    def __init__(self, handler: Callable[[Any], Any],
+                 app_secret: cx.Token,
+                 verify_token: cx.Token,
+                 maxsize: int = WEBHOOK_QUEUE_SIZE,
+                 workers: int = WEBHOOK_WORKERS) -> None:
+        self.handler = handler
+        self.app_secret = app_secret
+        self.verify_token = verify_token
+        self.maxsize = maxsize
+        self.workers = workers
+        self.queue: Queue = Queue(maxsize)
+        self._key: Optional[bytes] = None
+        self._threads: list[Thread] = []
+
+    def __repr__(self) -> str:
+        return (f'WebhookProcessor({self.handler!r}, {self.app_secret!r}, '
+                f'{self.verify_token!r})')
+
+    # Public methods.
+    def start(self) -> None:
+        """Start the worker threads."""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = Thread(
+                target=self._work,
+                name=f'pjisocial_webhook_{i}',
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        """Stop the worker threads once the queued payloads have been
+        handled.
+        """
+        for _ in self._threads:
+            self.queue.put((monotonic(), None))
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
 
+    def submit(self, payload: Any) -> bool:
+        """Queue a payload to be handled.
 
-# Silence the logger since this is just to grab http redirects.
-def silence(text, file=None, nl=None, err=None, color=None, **styles):
-    """Dummy function to silence screen output from flask."""
+        :param payload: The decoded payload.
+        :return: Whether the payload was accepted.
+        :rtype: bool
+        """
+        try:
+            self.queue.put((monotonic(), payload), timeout=WEBHOOK_PUT_TIMEOUT)
+        except Full:
+            metrics.count('webhook.payloads', result='refused')
+            return False
+        metrics.count('webhook.payloads', result='queued')
+        return True
 
+    def verify_challenge(self, mode: str, token: str) -> bool:
+        """Whether a subscription request has the right token."""
+        # compare_digest() only takes ASCII strings, and the token
+        # comes from the query string, so compare the bytes.
+        expected = self.verify_token.get().encode('utf_8')
+        return (
+            mode == 'subscribe'
+            and hmac.compare_digest(token.encode('utf_8'), expected)
+        )
 
-log = logging.getLogger('werkzeug')
-log.setLevel(logging.ERROR)
-click.echo = silence                            # type: ignore
-click.secho = silence                           # type: ignore
+    def verify_signature(self, body: bytes, signature: str) -> bool:
+        """Whether the X-Hub-Signature-256 header of a payload matches
+        its body.
+        """
+        if self._key is None:
+            self._key = self.app_secret.get().encode('utf_8')
+        digest = hmac.new(self._key, body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(
+            f'sha256={digest}'.encode('utf_8'),
+            signature.encode('utf_8')
+        )
 
+    # Private methods.
+    def _work(self) -> None:
+        """Hand queued payloads to the handler until stopped."""
+        while True:
+            queued, payload = self.queue.get()
+            try:
+                if payload is None:
+                    return
+                wait = monotonic() - queued
+                metrics.observe('webhook.queue_wait.seconds', wait)
+                with metrics.span('webhook.handler'):
+                    self.handler(payload)
 
-# Multiprocessing configuration.
-ctx = mp.get_context('fork')
-queue = ctx.Queue()
+            # One bad payload shouldn't stop the worker.
+            except Exception:
+                logger.exception('Webhook handler failed.')
+            finally:
+                self.queue.task_done()
 
-# Create an anti-CSRF token to prevent cross-site request forgery.
-anticsrf: Optional[str] = None
 
-# Create the web application.
-app = Flask(__name__)
+# Logins waiting for a redirect.
+flows = FlowRegistry()
+
+# Webhook payloads are ignored until a processor is set.
+webhooks: Optional[WebhookProcessor] = None
+
+# The web application is created the first time it is needed.
+_app: Optional['Flask'] = None
+_app_lock = Lock()
+
+
+# Server functions.
+_listeners: dict[tuple[str, int], Listener] = {}
+_listeners_lock = Lock()
+
+
+def get_app() -> 'Flask':
+    """Return the web application, creating it the first time it is
+    needed.
+    """
+    global _app
+    with _app_lock:
+        if _app is None:
+            from flask import Flask
+            app = Flask(__name__)
+            for rule, view, method in _ROUTES:
+                app.add_url_rule(rule, view_func=view, methods=[method, ])
+            _app = app
+    return _app
+
+
+def get_listener(host: str = HOST, port: int = PORT) -> Listener:
+    """Return the running listener for an address, starting it if
+    needed.
+    """
+    key = (host, int(port))
+    with _listeners_lock:
+        listener = _listeners.get(key)
+        if listener is None:
+            listener = Listener(host, port)
+            _listeners[key] = listener
+        listener.start()
+    return listener
+
+
+def set_webhooks(processor: Optional[WebhookProcessor]) -> None:
+    """Hand webhook payloads to the given processor, starting it.
+    Passing None stops accepting webhook payloads.
+    """
+    global webhooks
+    old = webhooks
+    webhooks = processor
+    if processor is not None:
+        processor.start()
+    if old is not None and old is not processor:
+        old.stop()
+
+
+def get_ssl_context(base_path: Optional[str] = None) -> tuple[str, str]:
+    """Return the paths to the listener's certificate and key,
+    creating a self-signed certificate the first time it is needed.
+    Reusing the certificate avoids generating a new key every time a
+    listener starts. A new certificate is created when the cached one
+    expires within CERT_RENEW_MARGIN seconds.
+
+    The files are only readable by the user from the moment they are
+    created, since the key isn't encrypted.
+
+    :param base_path: (Optional.) The path of the certificate and key
+        files without their extensions. The default is CERT_PATH.
+    :return: The paths to the certificate and the key.
+    :rtype: tuple
+    """
+    if base_path is None:
+        base_path = CERT_PATH
+    cert = f'{base_path}.crt'
+    key = f'{base_path}.key'
+    if (
+        os.path.exists(cert)
+        and os.path.exists(key)
+        and not _expiring(cert)
+    ):
+        return cert, key
+
+    from cryptography.hazmat.primitives import serialization
+    os.makedirs(os.path.dirname(base_path), exist_ok=True)
+    cert_obj, pkey = generate_adhoc_ssl_pair(cn=HOST)
+
+    # The key is written first, so if writing the certificate fails,
+    # the old certificate is still expiring and both are replaced
+    # next time.
+    _write_private(key, pkey.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption()
+    ))
+    _write_private(cert, cert_obj.public_bytes(serialization.Encoding.PEM))
+    return cert, key
+
+
+def make_server(host: str = HOST,
+                port: int = PORT,
+                ssl_context: Any = None,
+                threaded: bool = False) -> BaseWSGIServer:
+    """Create a server for the application that is already bound to
+    its port. Since the socket is listening before this returns, a
+    process started to run the server's serve_forever() method is
+    ready for requests as soon as it starts, with no need to wait.
+
+    :param host: (Optional.) The address to listen on.
+    :param port: (Optional.) The port to listen on.
+    :param ssl_context: (Optional.) The SSL context for the server.
+        This can be anything the Werkzeug server accepts, such as
+        'adhoc' or a (cert, key) tuple.
+    :param threaded: (Optional.) Whether to handle each request in
+        its own thread. The default is false.
+    :return: A :class:`werkzeug.serving.BaseWSGIServer` object.
+    :rtype: werkzeug.serving.BaseWSGIServer
+    """
+    return _make_server(
+        host,
+        int(port),
+        get_app(),
+        threaded=threaded,
+        request_handler=_QuietRequestHandler,
+        ssl_context=ssl_context
+    )
+
+
+def serve(host: str = HOST,
+          port: int = PORT,
+          ssl_context: Any = None,
+          workers: int = WORKERS) -> None:
+    """Serve the application until interrupted or terminated.
+
+    On SIGINT or SIGTERM the server stops accepting requests, lets
+    the requests in progress finish, and then lets the webhook
+    processor finish the payloads it has queued.
+
+    :param host: (Optional.) The address to listen on. The default
+        is HOST.
+    :param port: (Optional.) The port to listen on. The default is
+        PORT.
+    :param ssl_context: (Optional.) The SSL context for the server,
+        such as a (cert, key) tuple. The default is to serve HTTP.
+    :param workers: (Optional.) The number of worker threads. The
+        default is WORKERS.
+    """
+    server = PooledWSGIServer(host, port, get_app(), workers, ssl_context)
+
+    # shutdown() waits for serve_forever() to return, so it can't be
+    # called from the signal handler in the same thread.
+    def stop(signum: int, frame: Any) -> None:
+        Thread(target=server.shutdown).start()
+
+    previous = {}
+    if current_thread() is main_thread():
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            previous[signum] = signal.signal(signum, stop)
+
+    try:
+        server.serve_forever()
+
+    # Clean up.
+    finally:
+        server.server_close()
+        set_webhooks(None)
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+
+# Utility classes.
+class _QuietRequestHandler(WSGIRequestHandler):
+    """A request handler that doesn't log every request. Errors are
+    still logged.
+    """
+    def log_request(self, *args, **kwargs) -> None:
+        """Don't log successful requests."""
+
+
+# Utility functions.
+def _expiring(cert: str) -> bool:
+    """Whether a certificate expires within CERT_RENEW_MARGIN
+    seconds. A certificate that can't be read counts as expiring.
+    """
+    from cryptography import x509
+    try:
+        with open(cert, 'rb') as fh:
+            loaded = x509.load_pem_x509_certificate(fh.read())
+    except ValueError:
+        return True
+    remaining = loaded.not_valid_after_utc - datetime.now(timezone.utc)
+    return remaining.total_seconds() < CERT_RENEW_MARGIN
+
+
+def _write_private(filename: str, data: bytes) -> None:
+    """Replace a file with data only the user can read. The data is
+    written to a new file created with mode 0600 and moved into place.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    with NamedTemporaryFile(dir=directory, delete=False) as fh:
+        fh.write(data)
+    try:
+        os.replace(fh.name, filename)
+    except OSError:
+        os.unlink(fh.name)
+        raise
 
 
 # HTTP Responders.
-@app.route('/facebook_login', methods=['GET', ])
 def facebook_login() -> tuple[str, int]:
     """Get the code value from a facebook login."""
-    # If the anticsrf token wasn't returned, the request probably
-    # didn't come from Facebook.
-    if anticsrf != request.args['state']:
-        queue.put(Csrf('Token was not returned'))
-        return('Forbidden', 403)
+    from flask import request
+    state = request.args.get('state', '')
+    code = request.args.get('code', '')
+
+    # If the user denied the login or it otherwise failed, Facebook
+    # sends the OAuth error instead of a code. The waiting login
+    # raises it rather than getting an empty code.
+    if not code:
+        error = request.args.get('error', 'no_code')
+        reason = request.args.get('error_description', error)
+        ex = LoginError(f'Login failed: {reason}')
+        if not flows.reject(state, ex):
+            metrics.count('login.redirects', result='forbidden')
+            return ('Forbidden', 403)
+        metrics.count('login.redirects', result='error')
+        return ('Login failed', 400)
+
+    # If the state isn't the anticsrf token of a waiting login, the
+    # request probably didn't come from Facebook.
+    if not flows.resolve(state, code):
+        metrics.count('login.redirects', result='forbidden')
+        return ('Forbidden', 403)
+    metrics.count('login.redirects', result='success')
 
     # If the anticsrf token was returned, it was from Facebook.
-    queue.put(request.args['code'])
-    return('Success', 200)
+    return ('Success', 200)
 
 
-@app.route('/health', methods=['GET', ])
 def running() -> tuple[str, int]:
     """Return OK to prove the server is running."""
-    return('OK', 200)
+    return ('OK', 200)
+
+
+def metrics_text() -> Any:
+    """Return the metrics in the Prometheus text format, if they are
+    being kept by a PrometheusSink.
+    """
+    from flask import make_response
+    if not isinstance(metrics.sink, metrics.PrometheusSink):
+        return ('Not Found', 404)
+    resp = make_response(metrics.sink.render(), 200)
+    resp.mimetype = 'text/plain'
+    resp.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return resp
+
+
+def webhook_challenge() -> tuple[str, int]:
+    """Answer the verification request sent when a webhook is
+    subscribed.
+    """
+    from flask import request
+    mode = request.args.get('hub.mode', '')
+    token = request.args.get('hub.verify_token', '')
+    if webhooks is None or not webhooks.verify_challenge(mode, token):
+        return ('Forbidden', 403)
+    return (request.args.get('hub.challenge', ''), 200)
+
+
+def webhook() -> tuple[str, int]:
+    """Accept a payload pushed by Facebook."""
+    from flask import request
+    if webhooks is None:
+        return ('Not Found', 404)
+
+    # Payloads are only accepted if they were signed with the app
+    # secret, so they must have come from Facebook.
+    body = request.get_data()
+    signature = request.headers.get('X-Hub-Signature-256', '')
+    if not webhooks.verify_signature(body, signature):
+        return ('Forbidden', 403)
+    try:
+        payload = cx.decode(body)
+    except ValueError:
+        return ('Bad Request', 400)
+
+    # A full queue means the workers are behind, so ask Facebook to
+    # deliver the payload again later.
+    if not webhooks.submit(payload):
+        return ('Service Unavailable', 503)
+    return ('OK', 200)
+
+
+# The routes of the web application.
+_ROUTES = (
+    ('/facebook_login', facebook_login, 'GET'),
+    ('/health', running, 'GET'),
+    ('/metrics', metrics_text, 'GET'),
+    ('/webhook', webhook_challenge, 'GET'),
+    ('/webhook', webhook, 'POST'),
+)
+
+
+def __getattr__(name: str) -> Any:
+    """Create the web application when it is first used as app."""
+    if name == 'app':
+        return get_app()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+# Command line interface.
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    """Parse the command line arguments for serving the listener."""
+    p = argparse.ArgumentParser(
+        prog='pjisocial.httplistener',
+        description='Serve the pjisocial listener.'
+    )
+    p.add_argument(
+        '--host',
+        default=HOST,
+        help=f'The address to listen on. Default: {HOST}.'
+    )
+    p.add_argument(
+        '--port',
+        default=PORT,
+        type=int,
+        help=f'The port to listen on. Default: {PORT}.'
+    )
+    p.add_argument(
+        '--cert',
+        help='The path to the TLS certificate.'
+    )
+    p.add_argument(
+        '--key',
+        help='The path to the TLS key.'
+    )
+    p.add_argument(
+        '--dev-cert',
+        action='store_true',
+        help='Use the cached self-signed certificate.'
+    )
+    p.add_argument(
+        '--workers',
+        default=WORKERS,
+        type=int,
+        help=f'The number of worker threads. Default: {WORKERS}.'
+    )
+    args = p.parse_args(argv)
+    if bool(args.cert) != bool(args.key):
+        p.error('--cert and --key must be given together.')
+    return args
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """Serve the listener from the command line."""
+    args = parse_args(argv)
+    ssl_context: Any = None
+    if args.cert:
+        ssl_context = (args.cert, args.key)
+    elif args.dev_cert:
+        ssl_context = get_ssl_context()
+    serve(args.host, args.port, ssl_context, args.workers)
+
+
+if __name__ == '__main__':
+    main()
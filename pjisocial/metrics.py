@@ -0,0 +1,361 @@
+"""
+metrics
+~~~~~~~
+
+Timings, counters, and spans for pjisocial calls.
+
+Nothing is recorded until a sink is set with set_sink(). Until then
+each hook is a single check of the sink, so the instrumentation costs
+close to nothing when it isn't used.
+"""
+from bisect import bisect_left
+import logging
+import re
+from threading import Lock
+from time import perf_counter
+from typing import Any, Mapping, Optional
+from urllib.parse import urlsplit
+
+
+# Configuration.
+PREFIX = 'pjisocial'
+BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60
+)
+ID_SEGMENT = re.compile(r'^[0-9_]+$')
+
+
+# Logging.
+_logger = logging.getLogger(__name__)
+
+
+# Public classes.
+class Sink:
+    """Receives the metrics recorded by pjisocial.
+
+    Subclasses override count() and observe(). Spans are timed and
+    recorded as an observation of their duration in seconds plus a
+    count of the errors raised in them, unless span() is overridden
+    to hand them to a tracer.
+    """
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}()'
+
+    # Public methods.
+    def count(self, name: str, value: float,
+              labels: Mapping[str, str]) -> None:
+        """Add to a counter."""
+
+    def observe(self, name: str, value: float,
+                labels: Mapping[str, str]) -> None:
+        """Record a value in a histogram."""
+
+    def span(self, name: str, labels: Mapping[str, str]) -> Any:
+        """Return a context manager that times a phase of a call."""
+        return _Span(self, name, labels)
+
+
+class LoggingSink(Sink):
+    """A sink that logs every metric.
+
+    :param logger: (Optional.) The logger to write to. The default
+        is the logger for this module.
+    :param level: (Optional.) The level to log at. The default is
+        DEBUG.
+    """
+    def __init__(self, logger: Optional[logging.Logger] = None,
+                 level: int = logging.DEBUG) -> None:
+        self.logger = logger if logger is not None else _logger
+        self.level = level
+
+    def __repr__(self) -> str:
+        return f'LoggingSink(level={self.level})'
+
+    # Public methods.
+    def count(self, name: str, value: float,
+              labels: Mapping[str, str]) -> None:
+        """Log an addition to a counter."""
+        self.logger.log(self.level, '%s +%s %s', name, value, dict(labels))
+
+    def observe(self, name: str, value: float,
+                labels: Mapping[str, str]) -> None:
+        """Log a value for a histogram."""
+        self.logger.log(self.level, '%s %.6f %s', name, value, dict(labels))
+
+
+class PrometheusSink(Sink):
+    """A sink that keeps totals in memory and renders them in the
+    Prometheus text format.
+
+    :param buckets: (Optional.) The upper bounds of the histogram
+        buckets. The default is BUCKETS.
+    :param prefix: (Optional.) The prefix of the metric names. The
+        default is PREFIX.
+    """
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS,
+                 prefix: str = PREFIX) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], list[float]] = {}
+        self._lock = Lock()
+
+    def __repr__(self) -> str:
+        return f'PrometheusSink(prefix={self.prefix!r})'
+
+    # Public methods.
+    def count(self, name: str, value: float,
+              labels: Mapping[str, str]) -> None:
+        """Add to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float,
+                labels: Mapping[str, str]) -> None:
+        """Record a value in a histogram.
+
+        Each histogram is stored as the count for each bucket, then
+        the count above the last bucket, then the sum and the count.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = [0.0 for _ in range(len(self.buckets) + 3)]
+                self.histograms[key] = hist
+            hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def render(self) -> str:
+        """Return the metrics in the Prometheus text format."""
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            metric = f'{self._metric_name(name)}_total'
+            lines.append(f'# TYPE {metric} counter')
+            for (key, labels), value in sorted(counters.items()):
+                if key == name:
+                    fmt = _format_labels(labels)
+                    lines.append(f'{metric}{fmt} {value:g}')
+
+        bounds = [f'{b:g}' for b in self.buckets] + ['+Inf', ]
+        for name in sorted({name for name, _ in histograms}):
+            metric = self._metric_name(name)
+            lines.append(f'# TYPE {metric} histogram')
+            for (key, labels), hist in sorted(histograms.items()):
+                if key != name:
+                    continue
+                total = 0.0
+                for bound, n in zip(bounds, hist):
+                    total += n
+                    le = labels + (('le', bound), )
+                    lines.append(
+                        f'{metric}_bucket{_format_labels(le)} {total:g}'
+                    )
+                fmt = _format_labels(labels)
+                lines.append(f'{metric}_sum{fmt} {hist[-2]:g}')
+                lines.append(f'{metric}_count{fmt} {hist[-1]:g}')
+        return '\n'.join(lines) + '\n'
+
+    # Private methods.
+    def _metric_name(self, name: str) -> str:
+        """Return the Prometheus name for a metric."""
+        name = re.sub(r'[^a-zA-Z0-9_]', '_', name)
+        return f'{self.prefix}_{name}' if self.prefix else name
+
+
+class OpenTelemetrySink(Sink):
+    """A sink that sends spans to an OpenTelemetry tracer and the
+    counters and histograms to an OpenTelemetry meter. The
+    opentelemetry-api package must be installed.
+
+    :param tracer: (Optional.) The tracer for the spans. The default
+        is the tracer for pjisocial from the global tracer provider.
+    :param meter: (Optional.) The meter for the counters and
+        histograms. The default is the meter for pjisocial from the
+        global meter provider.
+    """
+    def __init__(self, tracer: Any = None, meter: Any = None) -> None:
+        if tracer is None or meter is None:
+            try:
+                from opentelemetry import metrics, trace  # type: ignore
+            except ImportError:
+                msg = 'The opentelemetry-api package is needed for tracing.'
+                raise RuntimeError(msg)
+            if tracer is None:
+                tracer = trace.get_tracer(PREFIX)
+            if meter is None:
+                meter = metrics.get_meter(PREFIX)
+        self.tracer = tracer
+        self.meter = meter
+        self._instruments: dict[str, Any] = {}
+        self._lock = Lock()
+
+    # Public methods.
+    def count(self, name: str, value: float,
+              labels: Mapping[str, str]) -> None:
+        """Add to an OpenTelemetry counter."""
+        counter = self._instrument(name, self.meter.create_counter)
+        counter.add(value, attributes=dict(labels))
+
+    def observe(self, name: str, value: float,
+                labels: Mapping[str, str]) -> None:
+        """Record a value in an OpenTelemetry histogram."""
+        histogram = self._instrument(name, self.meter.create_histogram)
+        histogram.record(value, attributes=dict(labels))
+
+    def span(self, name: str, labels: Mapping[str, str]) -> Any:
+        """Return a context manager that runs a phase of a call in an
+        OpenTelemetry span, as well as timing it.
+        """
+        return _Span(self, name, labels, self.tracer)
+
+    # Private methods.
+    def _instrument(self, name: str, create: Any) -> Any:
+        """Return the instrument for a metric, creating it if needed."""
+        instrument = self._instruments.get(name)
+        if instrument is None:
+            with self._lock:
+                instrument = self._instruments.get(name)
+                if instrument is None:
+                    instrument = create(f'{PREFIX}.{name}')
+                    self._instruments[name] = instrument
+        return instrument
+
+
+# Utility classes.
+class _NullSpan:
+    """A span that does nothing, used when no sink is set."""
+    def __enter__(self) -> '_NullSpan':
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+
+class _Span:
+    """Times a phase of a call and records it with a sink."""
+    __slots__ = ('sink', 'name', 'labels', 'start', '_span', '_tracer')
+
+    def __init__(self, sink: Sink, name: str,
+                 labels: Mapping[str, str],
+                 tracer: Any = None) -> None:
+        self.sink = sink
+        self.name = name
+        self.labels = labels
+        self.start = 0.0
+        self._span: Any = None
+        self._tracer = tracer
+
+    def __enter__(self) -> '_Span':
+        if self._tracer is not None:
+            self._span = self._tracer.start_as_current_span(
+                self.name,
+                attributes=dict(self.labels)
+            )
+            self._span.__enter__()
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        elapsed = perf_counter() - self.start
+        self.sink.observe(f'{self.name}.seconds', elapsed, self.labels)
+        if exc_type is not None:
+            self.sink.count(f'{self.name}.errors', 1, self.labels)
+        if self._span is not None:
+            self._span.__exit__(exc_type, exc, tb)
+
+
+_NULL_SPAN = _NullSpan()
+
+
+# The sink metrics are sent to.
+sink: Optional[Sink] = None
+
+
+def set_sink(new_sink: Optional[Sink]) -> None:
+    """Send metrics to the given sink. Passing None stops recording
+    metrics.
+    """
+    global sink
+    sink = new_sink
+
+
+# Hooks.
+def count(name: str, value: float = 1, /, **labels: str) -> None:
+    """Add to a counter.
+
+    The name and value are positional only, so any label name can be
+    used, including 'name' and 'value'.
+
+    :param name: The name of the counter.
+    :param value: (Optional.) The amount to add. The default is one.
+    :param labels: (Optional.) The labels of the counter.
+    """
+    if sink is not None:
+        sink.count(name, value, labels)
+
+
+def observe(name: str, value: float, /, **labels: str) -> None:
+    """Record a value in a histogram. As with count(), the name and
+    value are positional only.
+
+    :param name: The name of the histogram.
+    :param value: The value to record.
+    :param labels: (Optional.) The labels of the histogram.
+    """
+    if sink is not None:
+        sink.observe(name, value, labels)
+
+
+def span(name: str, /, **labels: str) -> Any:
+    """Time a phase of a call. As with count(), the name is
+    positional only.
+
+    Use the return value as a context manager around the phase. Its
+    duration in seconds is recorded in the histogram named for the
+    span with '.seconds' added, and errors raised in it are counted
+    in the counter named for the span with '.errors' added.
+
+    :param name: The name of the phase.
+    :param labels: (Optional.) The labels of the phase.
+    :return: A context manager.
+    :rtype: object
+    """
+    if sink is None:
+        return _NULL_SPAN
+    return sink.span(name, labels)
+
+
+def endpoint(url: str) -> str:
+    """Return the path of a URL with any object IDs replaced, so the
+    calls to an endpoint share labels no matter which object they
+    were for.
+
+        >>> endpoint('https://graph.facebook.com/v12.0/1234/feed?a=1')
+        '/v12.0/{id}/feed'
+    """
+    path = urlsplit(url).path
+    return '/'.join(
+        '{id}' if ID_SEGMENT.match(part) else part
+        for part in path.split('/')
+    )
+
+
+# Utility functions.
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    """Format labels for the Prometheus text format."""
+    if not labels:
+        return ''
+    items = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\')
+        value = value.replace('"', '\\"').replace('\n', '\\n')
+        items.append(f'{key}="{value}"')
+    return '{' + ','.join(items) + '}'
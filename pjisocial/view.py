@@ -1,18 +1,17 @@
-import webview                                      # type: ignore
-
-
 def get_redirect_html(filename: str) -> str:
     with open(filename) as fh:
         doc = fh.read()
     return doc
 
 
-filename = 'pjisocial/html/redirect.html'
-redirect = 'https://google.com'
-html = get_redirect_html(filename)
-redirect_html = html.format(redirect)
-webview.create_window('Redirect', html=redirect_html)
-webview.start()
+def main(filename: str = 'pjisocial/html/redirect.html',
+         redirect: str = 'https://google.com') -> None:
+    """Show the redirect page in a webview window."""
+    import webview                                  # type: ignore
+    html = get_redirect_html(filename)
+    redirect_html = html.format(redirect)
+    webview.create_window('Redirect', html=redirect_html)
+    webview.start()
 
 
 # Create Flask page with the needed JS
@@ -26,3 +25,7 @@ webview.start()
 # See:
 # https://developers.facebook.com/docs/facebook-login/manually-build-a-login-flow
 # https://developers.facebook.com/docs/facebook-login/manually-build-a-login-flow#confirm
+
+
+if __name__ == '__main__':
+    main()
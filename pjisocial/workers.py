@@ -0,0 +1,250 @@
+"""
+workers
+~~~~~~~
+
+Spread CPU-heavy processing of Graph API responses across cores.
+
+Decoding and flattening large responses holds the GIL, so threads
+don't speed it up. A ProcessPool hands raw response bodies to worker
+processes in batches and gives back the results in order. Large
+batches are passed through shared memory rather than being pickled
+through a pipe, so the workers read the bodies in place. Each batch
+carries the name of the JSON decoder chosen in this process, so the
+workers decode with it too.
+"""
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+import os
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence, Union
+
+from pjisocial import connect as cx
+from pjisocial.export import flatten
+
+
+# Configuration.
+WORKERS = os.cpu_count() or 1
+BATCH_SIZE = 64
+SHARED_THRESHOLD = 1024 * 1024
+MP_CONTEXT = 'spawn'
+
+
+# Public classes.
+class ProcessPool:
+    """A pool of processes that run a function on response bodies.
+
+    The function is called in a worker process with each body and
+    should return a small result, since results are pickled back to
+    this process. It must be defined at the top level of a module so
+    the workers can import it. Bodies in shared memory are passed to
+    it as memoryview objects, so it should accept any bytes-like
+    object, as decode_body() does.
+
+    The workers are started with the spawn method by default. Forking
+    a process that has other threads running, such as the listener
+    or the keyring pool, can leave locks held in the child.
+
+    :param func: The function to call with each body.
+    :param workers: (Optional.) The number of worker processes. The
+        default is WORKERS.
+    :param batch_size: (Optional.) The number of bodies sent to a
+        worker at once. The default is BATCH_SIZE.
+    :param threshold: (Optional.) The size in bytes at which a batch
+        is passed through shared memory. The default is
+        SHARED_THRESHOLD.
+    """
+    def __init__(self, func: Callable[[Any], Any],
+                 workers: int = WORKERS,
+                 batch_size: int = BATCH_SIZE,
+                 threshold: int = SHARED_THRESHOLD) -> None:
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.threshold = threshold
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def __repr__(self) -> str:
+        return (f'ProcessPool({self.func!r}, workers={self.workers}, '
+                f'batch_size={self.batch_size})')
+
+    def __enter__(self) -> 'ProcessPool':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    # Public methods.
+    def close(self) -> None:
+        """Stop the worker processes."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def map(self, bodies: Iterable[bytes]) -> Iterator[Any]:
+        """Process response bodies across the worker processes.
+
+        The bodies are read as they are needed, and at most two
+        batches for each worker are in flight, so memory use stays
+        bounded however many bodies there are.
+
+        :param bodies: The raw response bodies.
+        :return: A generator of the results, in the order of the
+            bodies.
+        :rtype: Iterator
+        """
+        pending: deque[tuple[Future, Optional[SharedMemory]]] = deque()
+        try:
+            for batch in _batches(bodies, self.batch_size):
+                pending.append(self._submit(batch))
+                if len(pending) >= self.workers * 2:
+                    yield from _collect(pending.popleft())
+            while pending:
+                yield from _collect(pending.popleft())
+
+        # Clean up.
+        finally:
+            for future, shm in pending:
+                future.cancel()
+                if shm is not None:
+                    _release(future, shm)
+
+    # Private methods.
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """Return the executor, starting the workers if needed."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                self.workers,
+                mp_context=mp.get_context(MP_CONTEXT)
+            )
+        return self._executor
+
+    def _submit(self, batch: Sequence[bytes]
+                ) -> tuple[Future, Optional[SharedMemory]]:
+        """Send a batch to the workers."""
+        executor = self._get_executor()
+        size = sum(len(body) for body in batch)
+        decoder = cx.decoder_name
+        if size < self.threshold:
+            future = executor.submit(_run_batch, self.func, batch, decoder)
+            return future, None
+
+        shm, offsets = _pack(batch, size)
+        future = executor.submit(
+            _run_shared,
+            self.func,
+            shm.name,
+            offsets,
+            decoder
+        )
+        return future, shm
+
+
+# Processing functions.
+def decode_body(body: Union[bytes, memoryview]) -> Any:
+    """Decode a JSON response body from bytes or a memoryview.
+
+    orjson and msgspec read a memoryview in place. The standard
+    library decoder needs bytes, so the body is copied for it.
+    """
+    return cx.decode(body)
+
+
+def flatten_page(body: Union[bytes, memoryview]) -> list[dict[str, Any]]:
+    """Decode a page of an edge and flatten its items into rows."""
+    page = decode_body(body)
+    return [flatten(item) for item in page.get('data', [])]
+
+
+# Utility functions.
+def _batches(bodies: Iterable[bytes], size: int) -> Iterator[list[bytes]]:
+    """Group bodies into batches."""
+    batch: list[bytes] = []
+    for body in bodies:
+        batch.append(body)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _collect(item: tuple[Future, Optional[SharedMemory]]) -> list[Any]:
+    """Wait for a batch and free its shared memory."""
+    future, shm = item
+    try:
+        return future.result()
+    finally:
+        if shm is not None:
+            _release(future, shm)
+
+
+def _pack(batch: Sequence[bytes],
+          size: int) -> tuple[SharedMemory, list[tuple[int, int]]]:
+    """Copy a batch into a block of shared memory.
+
+    :return: The block and the offset and length of each body in it.
+    :rtype: tuple
+    """
+    shm = SharedMemory(create=True, size=max(size, 1))
+    assert shm.buf is not None
+    offsets = []
+    pos = 0
+    for body in batch:
+        end = pos + len(body)
+        shm.buf[pos:end] = body
+        offsets.append((pos, len(body)))
+        pos = end
+    return shm, offsets
+
+
+def _release(future: Future, shm: SharedMemory) -> None:
+    """Free a block of shared memory once no worker is reading it."""
+    if not future.done():
+        try:
+            future.exception()
+        except BaseException:
+            pass
+    shm.close()
+    shm.unlink()
+
+
+def _run_batch(func: Callable[[Any], Any],
+               batch: Sequence[bytes],
+               decoder: str) -> list[Any]:
+    """Process a batch in a worker."""
+    _use_decoder(decoder)
+    return [func(body) for body in batch]
+
+
+def _run_shared(func: Callable[[Any], Any],
+                name: str,
+                offsets: Sequence[tuple[int, int]],
+                decoder: str) -> list[Any]:
+    """Process a batch in shared memory in a worker, reading each
+    body in place.
+    """
+    _use_decoder(decoder)
+    shm = SharedMemory(name=name)
+    buf = shm.buf
+    assert buf is not None
+    try:
+        results = []
+        for start, length in offsets:
+            view = buf[start:start + length]
+            try:
+                results.append(func(view))
+            finally:
+                view.release()
+        return results
+
+    # Clean up.
+    finally:
+        del buf
+        shm.close()
+
+
+def _use_decoder(name: str) -> None:
+    """Switch a worker to the decoder the batch was sent with."""
+    if cx.decoder_name != name:
+        cx.set_decoder(name)
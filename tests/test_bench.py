@@ -0,0 +1,207 @@
+"""
+test_bench
+~~~~~~~~~~
+
+Unit tests for the pjisocial.bench module.
+"""
+import json
+import os
+from tempfile import TemporaryDirectory
+import unittest as ut
+
+from pjisocial import bench
+from pjisocial import connect as cx
+from pjisocial import facebook as fb
+
+
+# Test cases.
+class FakeGraphTestCase(ut.TestCase):
+    def setUp(self):
+        backend = cx.MemoryBackend({
+            ('app_id', 'u'): 'spam',
+            ('app_secret', 'u'): 'eggs',
+        })
+        self.app_id = cx.Token('app_id', 'u', backend=backend)
+        self.app_secret = cx.Token('app_secret', 'u', backend=backend)
+
+    def tearDown(self):
+        cx.set_session(None)
+
+    def test_exchange_token(self):
+        """While the facebook module is pointed at the stand-in, token
+        exchanges should get an access token and the rate limit
+        headers from it.
+        """
+        # Expected values.
+        exp_token = 'token1'
+        exp_usage = {'call_count': 40, 'total_cputime': 40, 'total_time': 40}
+        exp_domain = fb.DOMAIN
+
+        # Test data and state.
+        graph = bench.FakeGraph(usage=40)
+
+        # Run test.
+        with graph, bench.graph_api(graph):
+            act = fb.exchange_token(self.app_id, self.app_secret, 'bacon')
+            url = f'http://{graph.domain}{fb.API}/me'
+            resp = cx.get_session().get(url)
+
+        # Determine test result.
+        self.assertEqual(exp_token, act['access_token'])
+        self.assertEqual(exp_usage, json.loads(resp.headers['X-App-Usage']))
+        self.assertEqual(exp_domain, fb.DOMAIN)
+
+    def test_usage_paced(self):
+        """When the stand-in reports usage, calls sent to it should be
+        paced by a scheduler, and otherwise not paced.
+        """
+        # Expected value.
+        exp_saved = fb.scheduler
+
+        # Run test.
+        with bench.FakeGraph(usage=90) as graph, bench.graph_api(graph):
+            act_usage = fb.scheduler
+        with bench.FakeGraph() as graph, bench.graph_api(graph):
+            act_idle = fb.scheduler
+
+        # Determine test result.
+        self.assertIsInstance(act_usage, fb.Scheduler)
+        self.assertIsNone(act_idle)
+        self.assertIs(exp_saved, fb.scheduler)
+
+    def test_parse_args(self):
+        """The status of failed calls should be settable from the
+        command line.
+        """
+        # Expected value.
+        exp = 503
+
+        # Run test.
+        args = bench.parse_args(['--error-rate', '1', '--error-status', '503'])
+
+        # Determine test result.
+        self.assertEqual(exp, args.error_status)
+
+    def test_errors(self):
+        """When the stand-in is set to fail every call, the calls
+        should raise the Graph API error.
+        """
+        # Expected values.
+        exp_ex = fb.GraphError
+        exp_status = 503
+
+        # Test data and state.
+        graph = bench.FakeGraph(error_rate=1, error_status=503)
+
+        # Run test.
+        with graph, bench.graph_api(graph):
+            with self.assertRaises(exp_ex) as cm:
+                fb.exchange_token(self.app_id, self.app_secret, 'bacon')
+
+        # Determine test result.
+        self.assertEqual(exp_status, cm.exception.status)
+
+
+class BaselineTestCase(ut.TestCase):
+    def test_compare(self):
+        """Given results and a baseline, compare() should report the
+        latencies that grew by more than the tolerance.
+        """
+        # Expected values.
+        exp = ['spam p99 is 4.000 ms, over the limit of 3.000 ms.', ]
+
+        # Test data and state.
+        latencies = [.001 for _ in range(98)] + [.004, .004]
+        results = {
+            'spam': bench.Result('spam', latencies, 1),
+            'eggs': bench.Result('eggs', [.001, ], 1),
+        }
+        baseline = {'spam': {'p50': .001, 'p99': .002}, }
+
+        # Run test.
+        act = bench.compare(results, baseline, tolerance=.5)
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+
+    def test_compare_unit(self):
+        """Given a baseline in multiples of a unit, compare() should
+        scale it by the unit measured on this machine.
+        """
+        # Expected values.
+        exp = ['spam p50 is 3.000 ms, over the limit of 1.500 ms.', ]
+
+        # Test data and state.
+        results = {'spam': bench.Result('spam', [.003, .003, .009], 1), }
+        baseline = {'spam': {'p50': .5, 'p99': 2}, }
+
+        # Run test.
+        act = bench.compare(results, baseline, tolerance=0, unit=.003)
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+
+    def test_compare_short_run(self):
+        """When a benchmark has fewer than MIN_P99_ITERATIONS calls,
+        compare() should only check its median.
+        """
+        # Expected value.
+        exp = []
+
+        # Test data and state.
+        results = {'spam': bench.Result('spam', [.001, .001, .004], 1), }
+        baseline = {'spam': {'p50': .001, 'p99': .002}, }
+
+        # Run test.
+        act = bench.compare(results, baseline, tolerance=.5)
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+
+    def test_calibrate(self):
+        """calibrate() should return the time the loop took."""
+        # Run test.
+        act = bench.calibrate(loops=1000, repeat=2)
+
+        # Determine test result.
+        self.assertGreater(act, 0)
+
+    def test_save_and_load(self):
+        """Saved results should load as the baseline, with the
+        latencies in multiples of the unit.
+        """
+        # Expected values.
+        exp = {'spam': {'p50': 2, 'p99': 4, 'errors': 1}, }
+
+        # Test data and state.
+        results = {'spam': bench.Result('spam', [2, 1, 1], 2, errors=1), }
+
+        # Run test.
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'benchmarks', 'baseline.json')
+            bench.save_baseline(results, path, unit=.5)
+            act = bench.load_baseline(path)
+            act_missing = bench.load_baseline(os.path.join(tmp, 'none'))
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+        self.assertEqual({}, act_missing)
+
+
+class RunTestCase(ut.TestCase):
+    def tearDown(self):
+        cx.set_session(None)
+
+    def test_run(self):
+        """run() should time every benchmark."""
+        # Expected values.
+        exp = ['exchange_token', 'login_callback', 'token_get', 'token_set']
+
+        # Run test.
+        results = bench.run(iterations=5)
+
+        # Determine test result.
+        self.assertEqual(exp, sorted(results))
+        for result in results.values():
+            self.assertEqual(5, len(result.latencies))
+            self.assertLessEqual(result.p50, result.p99)
@@ -4,15 +4,880 @@ test_connect
 
 Unit tests for the pjisocial.connect module.
 """
+import asyncio
+import os
+import sys
+from tempfile import TemporaryDirectory
 import unittest as ut
 from unittest.mock import call, patch
 
 import keyring
+import keyring.backend
+from requests import Response
+from requests.adapters import BaseAdapter
 
 from pjisocial import connect as cx
+from pjisocial import metrics
+
+
+# Utility classes.
+class DictKeyring(keyring.backend.KeyringBackend):
+    """A keyring backend that keeps secrets in a dict. Its priority is
+    too low for keyring to ever choose it.
+    """
+    priority = -1
+
+    def __init__(self, secrets=None):
+        super().__init__()
+        self.secrets = dict(secrets) if secrets else {}
+
+    def delete_password(self, service, user):
+        del self.secrets[(service, user)]
+
+    def get_password(self, service, user):
+        return self.secrets.get((service, user))
+
+    def set_password(self, service, user, password):
+        self.secrets[(service, user)] = password
+
+
+class Transport(BaseAdapter):
+    """A local stand-in for the network."""
+    def __init__(self, body=b'', status_code=200, etag=None):
+        super().__init__()
+        self.body = body
+        self.status_code = status_code
+        self.etag = etag
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append((request, kwargs))
+        resp = Response()
+        resp.status_code = self.status_code
+        resp._content = self.body
+        if self.etag:
+            resp.headers['ETag'] = self.etag
+            if request.headers.get('If-None-Match') == self.etag:
+                resp.status_code = 304
+                resp._content = b''
+        resp.request = request
+        resp.url = request.url
+        return resp
+
+    def close(self):
+        pass
 
 
 # Test classes.
+class BackendTestCase(ut.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_encrypted_file(self):
+        """Secrets set in an EncryptedFileBackend should be encrypted
+        on disk and readable by a new backend with the same key.
+        """
+        # Expected values.
+        exp = 'spam'
+        exp_ex = ValueError
+
+        # Test data and state.
+        path = os.path.join(self.tmp.name, 'secrets')
+        key = cx.EncryptedFileBackend.generate_key()
+        backend = cx.EncryptedFileBackend(path, key)
+        token = cx.Token('eggs', 'bacon', temp=True, backend=backend)
+
+        # Run test.
+        token.set(exp)
+        other = cx.EncryptedFileBackend(path, key)
+        act = cx.Token('eggs', 'bacon', backend=other).get()
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+        with open(path, 'rb') as fh:
+            self.assertNotIn(exp.encode(), fh.read())
+        wrong_key = cx.EncryptedFileBackend.generate_key()
+        with self.assertRaises(exp_ex):
+            cx.EncryptedFileBackend(path, wrong_key)
+
+    def test_keyring_backend(self):
+        """Given a backend from the keyring package, a Token should
+        store and read its secret there, and tokens sharing it should
+        share cache entries.
+        """
+        # Expected values.
+        exp = 'spam'
+        exp_secrets = {('eggs', 'bacon'): 'spam', }
+
+        # Test data and state.
+        store = DictKeyring()
+        token = cx.Token('eggs', 'bacon', temp=True, backend=store)
+        other = cx.Token('eggs', 'bacon', backend=store)
+
+        # Run test.
+        token.set(exp)
+        act = other.get()
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+        self.assertEqual(exp_secrets, store.secrets)
+        self.assertIsInstance(token.backend, cx.KeyringBackend)
+        self.assertEqual(token.cache_key, other.cache_key)
+        token.clear()
+        self.assertEqual({}, store.secrets)
+
+    def test_encrypted_file_shared(self):
+        """When two backends share a file, as two processes would,
+        neither should lose the secrets the other stored.
+        """
+        # Expected value.
+        exp = {'spam': {'u': '1'}, 'eggs': {'u': '2'}, }
+
+        # Test data and state.
+        path = os.path.join(self.tmp.name, 'secrets')
+        key = cx.EncryptedFileBackend.generate_key()
+        first = cx.EncryptedFileBackend(path, key)
+        second = cx.EncryptedFileBackend(path, key)
+
+        # Run test.
+        first.set_password('spam', 'u', '1')
+        second.set_password('eggs', 'u', '2')
+        act = cx.EncryptedFileBackend(path, key)._secrets
+
+        # Determine test result.
+        self.assertDictEqual(exp, act)
+        self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+        self.assertEqual(
+            ['secrets', 'secrets.lock'],
+            sorted(os.listdir(self.tmp.name))
+        )
+
+    @patch.dict(sys.modules, {'cryptography': None, })
+    def test_encrypted_file_needs_cryptography(self):
+        """If cryptography isn't installed, generating a key should
+        raise a RuntimeError that says so.
+        """
+        # Expected values.
+        exp_ex = RuntimeError
+        exp_msg = 'cryptography package is needed'
+
+        # Run test and determine result.
+        with self.assertRaisesRegex(exp_ex, exp_msg):
+            cx.EncryptedFileBackend.generate_key()
+
+    def test_env(self):
+        """An EnvBackend should read secrets from the environment,
+        and then from files in its directory.
+        """
+        # Expected values.
+        exp_env = 'spam'
+        exp_file = 'eggs'
+
+        # Test data and state.
+        backend = cx.EnvBackend(directory=self.tmp.name)
+        env_name = backend.name('fb.app', 'one')
+        file_name = backend.name('fb.app', 'two')
+        with open(os.path.join(self.tmp.name, file_name), 'w') as fh:
+            fh.write(exp_file + '\n')
+
+        # Run test.
+        with patch.dict(os.environ, {env_name: exp_env}):
+            act_env = cx.Token('fb.app', 'one', backend=backend).get()
+        act_file = cx.Token('fb.app', 'two', backend=backend).get()
+
+        # Determine test result.
+        self.assertEqual('PJISOCIAL_FB_APP__ONE', env_name)
+        self.assertEqual(exp_env, act_env)
+        self.assertEqual(exp_file, act_file)
+
+    def test_abstract(self):
+        """A backend that doesn't implement the secret store methods
+        should not be created.
+        """
+        # Expected value.
+        exp_ex = TypeError
+
+        # Test data and state.
+        class Backend(cx.Backend):
+            def get_password(self, service, user):
+                return None
+
+        # Run test and determine result.
+        with self.assertRaises(exp_ex):
+            Backend()
+
+    def test_set_backend(self):
+        """Tokens without a backend should use the backend given to
+        set_backend().
+        """
+        # Expected value.
+        exp = 'spam'
+
+        # Test data and state.
+        backend = cx.MemoryBackend({('eggs', 'bacon'): exp})
+
+        # Run test.
+        cx.set_backend(backend)
+        try:
+            act = cx.Token('eggs', 'bacon').get()
+
+        # Clean up.
+        finally:
+            cx.set_backend(None)
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+        self.assertIsInstance(cx.default_backend, cx.KeyringBackend)
+
+
+class BulkTestCase(ut.TestCase):
+    def test_get_many(self):
+        """Given tokens from several backends, get_many() should read
+        each backend in one bulk call and return the values in the
+        order of the tokens.
+        """
+        # Expected values.
+        exp = ['spam', 'eggs', 'bacon']
+        exp_calls = [call([('a', 'u'), ('c', 'u')]), call([('b', 'u')])]
+
+        # Test data and state.
+        one = cx.MemoryBackend({('a', 'u'): 'spam', ('c', 'u'): 'bacon'})
+        two = cx.MemoryBackend({('b', 'u'): 'eggs'})
+        tokens = [
+            cx.Token('a', 'u', backend=one),
+            cx.Token('b', 'u', backend=two),
+            cx.Token('c', 'u', backend=one),
+        ]
+
+        # Run test.
+        with patch.object(cx.MemoryBackend, 'get_passwords',
+                          autospec=True,
+                          side_effect=cx.MemoryBackend.get_passwords
+                          ) as mock_get:
+            act = cx.Token.get_many(tokens)
+
+        # Determine test result.
+        act_calls = [call(c[0][1]) for c in mock_get.call_args_list]
+        self.assertEqual(exp, act)
+        self.assertEqual(exp_calls, act_calls)
+
+    def test_get_many_default_backend(self):
+        """Backends without a bulk read should be read in parallel
+        through their get_password() method.
+        """
+        # Expected value.
+        exp = ['spam', 'eggs']
+
+        # Test data and state.
+        class Backend(cx.Backend):
+            def delete_password(self, service, user):
+                pass
+
+            def get_password(self, service, user):
+                return {'a': 'spam', 'b': 'eggs'}.get(service)
+
+            def set_password(self, service, user, value):
+                pass
+
+        backend = Backend()
+        tokens = [cx.Token(s, 'u', backend=backend) for s in 'ab']
+
+        # Run test.
+        act = cx.Token.get_many(tokens)
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+
+    def test_get_many_keyring(self):
+        """Given tokens stored in a backend from the keyring package,
+        either given to the tokens or set as the default, get_many()
+        should read them through its get_password() method.
+        """
+        # Expected value.
+        exp = ['spam', 'eggs']
+
+        # Test data and state.
+        store = DictKeyring({('a', 'u'): 'spam', ('b', 'u'): 'eggs'})
+        tokens = [cx.Token(s, 'u', backend=store) for s in 'ab']
+        default_tokens = [cx.Token(s, 'u') for s in 'ab']
+
+        # Run test.
+        act = cx.Token.get_many(tokens)
+        cx.set_backend(store)
+        try:
+            act_default = cx.Token.get_many(default_tokens)
+
+        # Clean up.
+        finally:
+            cx.set_backend(None)
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+        self.assertEqual(exp, act_default)
+
+    def test_get_many_one_token(self):
+        """When a backend without a bulk read has only one secret to
+        read, get_many() should read it directly instead of handing it
+        to the thread pool.
+        """
+        # Expected value.
+        exp = ['spam', ]
+
+        # Test data and state.
+        class Backend(cx.Backend):
+            def delete_password(self, service, user):
+                pass
+
+            def get_password(self, service, user):
+                return 'spam'
+
+            def set_password(self, service, user, value):
+                pass
+
+        tokens = [cx.Token('a', 'u', backend=Backend()), ]
+
+        # Run test.
+        with patch('pjisocial.connect.get_keyring_executor') as mock_pool:
+            act = cx.Token.get_many(tokens)
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+        mock_pool.assert_not_called()
+
+    def test_set_many_permanent(self):
+        """If any of the tokens is permanent, set_many() should raise
+        PermanentSecret without storing any of them.
+        """
+        # Expected values.
+        exp_ex = cx.PermanentSecret
+        exp_secrets = {}
+
+        # Test data and state.
+        backend = cx.MemoryBackend()
+        items = [
+            (cx.Token('a', 'u', temp=True, backend=backend), 'spam'),
+            (cx.Token('b', 'u', backend=backend), 'eggs'),
+        ]
+
+        # Run test and determine result.
+        with self.assertRaises(exp_ex):
+            cx.Token.set_many(items)
+        self.assertDictEqual(exp_secrets, backend.secrets)
+
+    def test_set_many_encrypted_file(self):
+        """Storing many secrets in an encrypted file should write the
+        file once.
+        """
+        # Expected values.
+        exp = ['spam', 'eggs']
+        exp_writes = 1
+
+        # Test data and state.
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'secrets')
+            key = cx.EncryptedFileBackend.generate_key()
+            backend = cx.EncryptedFileBackend(path, key)
+            tokens = [
+                cx.Token(s, 'u', temp=True, backend=backend) for s in 'ab'
+            ]
+
+            # Run test.
+            with patch.object(backend, '_write',
+                              wraps=backend._write) as mock_write:
+                cx.Token.set_many(list(zip(tokens, exp)))
+            other = cx.EncryptedFileBackend(path, key)
+            act = [other.get_password(s, 'u') for s in 'ab']
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+        self.assertEqual(exp_writes, mock_write.call_count)
+
+
+class DecodeTestCase(ut.TestCase):
+    def setUp(self):
+        self.name = cx.decoder_name
+
+    def tearDown(self):
+        cx.set_decoder(self.name)
+
+    def test_decode(self):
+        """Given a JSON body as bytes, each available decoder should
+        return the decoded value.
+        """
+        # Expected value.
+        exp = {'spam': [1, 2, 'eggs'], 'bacon': None, }
+
+        # Test data and state.
+        content = b'{"spam": [1, 2, "eggs"], "bacon": null}'
+
+        # Run test and determine result.
+        for name in cx.DECODERS:
+            cx.set_decoder(name)
+            act = cx.decode(content)
+            self.assertEqual(exp, act)
+
+    def test_decode_invalid(self):
+        """Given invalid JSON, each available decoder should raise a
+        ValueError.
+        """
+        # Expected value.
+        exp_ex = ValueError
+
+        # Test data and state.
+        content = b'{"spam": '
+
+        # Run test and determine result.
+        for name in cx.DECODERS:
+            cx.set_decoder(name)
+            with self.assertRaises(exp_ex):
+                cx.decode(content)
+
+    @patch('pjisocial.connect.msgspec')
+    def test_decode_msgspec_invalid(self, mock_msgspec):
+        """When msgspec can't decode the body, its DecodeError should
+        be raised as a ValueError.
+        """
+        # Expected value.
+        exp_ex = ValueError
+
+        # Test data and state.
+        class DecodeError(Exception):
+            pass
+
+        mock_msgspec.DecodeError = DecodeError
+        mock_msgspec.json.decode.side_effect = DecodeError('spam')
+
+        # Run test and determine result.
+        with self.assertRaises(exp_ex):
+            cx._msgspec_decode(b'{"spam": ')
+
+    def test_set_decoder_unavailable(self):
+        """If the decoder isn't available, raise a ValueError."""
+        # Expected value.
+        exp_ex = ValueError
+        exp_msg = 'JSON decoder spam is not available.'
+
+        # Run test and determine result.
+        with self.assertRaisesRegex(exp_ex, exp_msg):
+            cx.set_decoder('spam')
+
+
+class ResponseCacheTestCase(ut.TestCase):
+    def test_evict_by_size(self):
+        """When the cached bodies are larger than the size of the
+        cache, the least recently used should be evicted.
+        """
+        # Expected values.
+        exp = {'spam': True, 'eggs': False, 'bacon': True, }
+
+        # Test data and state.
+        cache = cx.ResponseCache(maxsize=10)
+        cache.set('spam', cx.CachedResponse('1', b'1234', {}))
+        cache.set('eggs', cx.CachedResponse('2', b'1234', {}))
+        cache.get('spam')
+
+        # Run test.
+        cache.set('bacon', cx.CachedResponse('3', b'1234', {}))
+
+        # Determine test result.
+        act = {key: cache.get(key) is not None for key in exp}
+        self.assertDictEqual(exp, act)
+        self.assertEqual(8, cache.size)
+
+    def test_sqlite(self):
+        """Responses stored in a SqliteResponseCache should be readable
+        from another connection to the same file, and the least
+        recently used should be evicted when it is full.
+        """
+        # Expected values.
+        exp_content = b'1234'
+        exp_headers = {'ETag': '"3"', }
+
+        # Test data and state.
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cache.db')
+            cache = cx.SqliteResponseCache(path, maxsize=10)
+
+            # Run test.
+            try:
+                cache.set('spam', cx.CachedResponse('1', b'1234', {}))
+                cache.set('eggs', cx.CachedResponse('2', b'1234', {}))
+                entry = cx.CachedResponse('"3"', exp_content, exp_headers)
+                cache.set('bacon', entry)
+                other = cx.SqliteResponseCache(path, maxsize=10)
+                act = other.get('bacon')
+                act_evicted = other.get('spam')
+                other.close()
+
+            # Clean up.
+            finally:
+                cache.close()
+
+        # Determine test result.
+        self.assertEqual(exp_content, act.content)
+        self.assertDictEqual(exp_headers, act.headers)
+        self.assertIsNone(act_evicted)
+
+
+class SecretCacheTestCase(ut.TestCase):
+    @patch('pjisocial.connect.monotonic')
+    def test_expire(self, mock_time):
+        """Entries older than the TTL should not be returned."""
+        # Expected values.
+        exp_before = 'spam'
+        exp_after = None
+
+        # Test data and state.
+        key = ('eggs', 'bacon')
+        cache = cx.SecretCache(ttl=10)
+        mock_time.return_value = 100
+        cache.set(key, exp_before)
+
+        # Run test.
+        mock_time.return_value = 109
+        act_before = cache.get(key)
+        mock_time.return_value = 110
+        act_after = cache.get(key)
+
+        # Determine test result.
+        self.assertEqual(exp_before, act_before)
+        self.assertEqual(exp_after, act_after)
+
+    def test_evict_least_recently_used(self):
+        """When the cache is full, the least recently used entry
+        should be evicted.
+        """
+        # Expected values.
+        exp = {
+            'spam': 'one',
+            'eggs': None,
+            'bacon': 'three',
+        }
+
+        # Test data and state.
+        cache = cx.SecretCache(maxsize=2)
+        cache.set(('spam', 'u'), 'one')
+        cache.set(('eggs', 'u'), 'two')
+        cache.get(('spam', 'u'))
+
+        # Run test.
+        cache.set(('bacon', 'u'), 'three')
+
+        # Determine test result.
+        act = {key: cache.get((key, 'u')) for key in exp}
+        self.assertDictEqual(exp, act)
+
+
+class TokenCacheTestCase(ut.TestCase):
+    def setUp(self):
+        self.service = '__TokenCacheTestCase'
+        self.user = '_pjisocial'
+        self.cache = cx.enable_cache()
+
+    def tearDown(self):
+        cx.disable_cache()
+        if keyring.get_password(self.service, self.user):
+            keyring.delete_password(self.service, self.user)
+
+    @patch('pjisocial.connect.get_password')
+    def test_get_cached(self, mock_get):
+        """When the cache is enabled, repeated calls to get() should
+        only read the OS's secret store once.
+        """
+        # Expected values.
+        exp_value = 'spam'
+        exp_calls = 1
+
+        # Test data and state.
+        mock_get.return_value = exp_value
+        token = cx.Token(self.service, self.user)
+
+        # Run test.
+        token.get()
+        act_value = token.get()
+
+        # Determine test result.
+        self.assertEqual(exp_value, act_value)
+        self.assertEqual(exp_calls, mock_get.call_count)
+
+    def test_set_and_clear_update_cache(self):
+        """Setting or clearing a token should update the cache, so
+        stale values are never served.
+        """
+        # Expected values.
+        exp_set = 'eggs'
+        exp_cleared = cx.SecretDoesNotExist
+
+        # Test data and state.
+        token = cx.Token(self.service, self.user, temp=True)
+        token.set('spam')
+        token.get()
+
+        # Run test and determine result.
+        token.set(exp_set)
+        self.assertEqual(exp_set, token.get())
+        token.clear()
+        with self.assertRaises(exp_cleared):
+            token.get()
+
+    def test_cached_by_backend(self):
+        """Tokens with the same service and user in different
+        backends should not read each other's cached secrets.
+        """
+        # Expected values.
+        exp_memory = 'spam'
+        exp_other = 'eggs'
+
+        # Test data and state.
+        key = (self.service, self.user)
+        memory = cx.Token(*key, backend=cx.MemoryBackend({key: exp_memory}))
+        other = cx.Token(*key, backend=cx.MemoryBackend({key: exp_other}))
+
+        # Run test.
+        act_memory = memory.get()
+        act_other = other.get()
+        act_many = cx.Token.get_many([memory, other])
+
+        # Determine test result.
+        self.assertEqual(exp_memory, act_memory)
+        self.assertEqual(exp_other, act_other)
+        self.assertEqual([exp_memory, exp_other], act_many)
+
+
+class SessionTestCase(ut.TestCase):
+    def tearDown(self):
+        cx.set_session(None)
+
+    def test_get(self):
+        """Given a URL and parameters, get() should send the request
+        through the session's transport using the default timeout.
+        """
+        # Expected values.
+        exp_url = 'https://graph.facebook.com/spam?eggs=bacon'
+        exp_timeout = (cx.CONNECT_TIMEOUT, cx.READ_TIMEOUT)
+        exp_body = b'tomato'
+
+        # Test data and state.
+        transport = Transport(exp_body)
+        session = cx.Session(transport=transport)
+        url = 'https://graph.facebook.com/spam'
+        params = {'eggs': 'bacon', }
+
+        # Run test.
+        resp = session.get(url, params)
+
+        # Determine test result.
+        request, kwargs = transport.requests[-1]
+        self.assertEqual(exp_url, request.url)
+        self.assertEqual(exp_timeout, kwargs['timeout'])
+        self.assertEqual(exp_body, resp.content)
+
+    def test_request_metrics(self):
+        """When a metrics sink is set, request() should record the
+        duration of the request and its status by endpoint.
+        """
+        # Expected values.
+        exp_key = (
+            'http.responses',
+            (('endpoint', '/v12.0/{id}/feed'), ('method', 'GET'),
+             ('status', '200')),
+        )
+        exp_count = 1
+
+        # Test data and state.
+        sink = metrics.PrometheusSink()
+        metrics.set_sink(sink)
+        self.addCleanup(metrics.set_sink, None)
+        session = cx.Session(transport=Transport(b'{}'))
+        url = 'https://graph.facebook.com/v12.0/1234/feed'
+
+        # Run test.
+        session.request('GET', url)
+
+        # Determine test result.
+        self.assertEqual(exp_count, sink.counters[exp_key])
+        act_names = [name for name, _ in sink.histograms]
+        self.assertIn('http.request.seconds', act_names)
+        self.assertIn('http.headers.seconds', act_names)
+
+    def test_aget(self):
+        """Given a URL and parameters, aget() should send the request
+        through the session's transport without blocking the event
+        loop.
+        """
+        # Expected values.
+        exp_url = 'https://graph.facebook.com/spam?eggs=bacon'
+        exp_body = b'tomato'
+
+        # Test data and state.
+        transport = Transport(exp_body)
+        session = cx.Session(transport=transport)
+        url = 'https://graph.facebook.com/spam'
+        params = {'eggs': 'bacon', }
+
+        # Run test.
+        try:
+            resp = asyncio.run(session.aget(url, params))
+
+        # Clean up.
+        finally:
+            session.close()
+
+        # Determine test result.
+        request, _ = transport.requests[-1]
+        self.assertEqual(exp_url, request.url)
+        self.assertEqual(exp_body, resp.content)
+
+    def test_get_cached(self):
+        """When the session has a cache, a response with an ETag
+        should be revalidated with If-None-Match and served from the
+        cache when the server returns 304.
+        """
+        # Expected values.
+        exp_etag = '"spam"'
+        exp_body = b'{"eggs": "bacon"}'
+        exp_status = 200
+
+        # Test data and state.
+        transport = Transport(exp_body, etag=exp_etag)
+        session = cx.Session(transport=transport, cache=cx.ResponseCache())
+        url = 'https://graph.facebook.com/spam'
+        params = {'access_token': 'tomato', }
+        session.get(url, params)
+
+        # Run test.
+        resp = session.get(url, params)
+
+        # Determine test result.
+        request, _ = transport.requests[-1]
+        self.assertEqual(exp_etag, request.headers['If-None-Match'])
+        self.assertEqual(exp_status, resp.status_code)
+        self.assertEqual(exp_body, resp.content)
+
+    def test_get_cached_by_scope(self):
+        """Cached responses should not be served to a different access
+        token.
+        """
+        # Test data and state.
+        transport = Transport(b'spam', etag='"spam"')
+        session = cx.Session(transport=transport, cache=cx.ResponseCache())
+        url = 'https://graph.facebook.com/spam'
+        session.get(url, {'access_token': 'tomato', })
+
+        # Run test.
+        session.get(url, {'access_token': 'potato', })
+
+        # Determine test result.
+        request, _ = transport.requests[-1]
+        self.assertNotIn('If-None-Match', request.headers)
+
+    def test_get_not_cached_oauth(self):
+        """Responses from OAuth endpoints, such as token exchanges,
+        should never be cached.
+        """
+        # Test data and state.
+        transport = Transport(b'spam', etag='"spam"')
+        cache = cx.ResponseCache()
+        session = cx.Session(transport=transport, cache=cache)
+        url = 'https://graph.facebook.com/v12.0/oauth/access_token'
+
+        # Run test.
+        session.get(url, {'client_secret': 'eggs', 'code': 'bacon', })
+
+        # Determine test result.
+        self.assertEqual(0, len(cache))
+
+    def test_cache_key_credentials(self):
+        """The cache key should hold none of the credentials passed
+        as parameters, but still tell their scopes apart.
+        """
+        # Test data and state.
+        url = 'https://graph.facebook.com/spam'
+        params = {
+            'client_id': '1',
+            'client_secret': 'SECRET',
+            'code': 'CODE',
+            'access_token': 'TOKEN',
+            'fb_exchange_token': 'EXCHANGE',
+        }
+        other = dict(params, client_secret='OTHER')
+
+        # Run test.
+        act = cx._cache_key(url, params)
+        act_other = cx._cache_key(url, other)
+
+        # Determine test result.
+        for value in ('SECRET', 'CODE', 'TOKEN', 'EXCHANGE'):
+            self.assertNotIn(value, act)
+        self.assertIn('client_id=1', act)
+        self.assertNotEqual(act, act_other)
+
+    def test_aget_cached(self):
+        """aget() should revalidate and serve cached responses the
+        same way get() does.
+        """
+        # Expected values.
+        exp_etag = '"spam"'
+        exp_body = b'{"eggs": "bacon"}'
+
+        # Test data and state.
+        transport = Transport(exp_body, etag=exp_etag)
+        session = cx.Session(transport=transport, cache=cx.ResponseCache())
+        url = 'https://graph.facebook.com/spam'
+        params = {'access_token': 'tomato', }
+        session.get(url, params)
+
+        # Run test.
+        try:
+            resp = asyncio.run(session.aget(url, params))
+
+        # Clean up.
+        finally:
+            session.close()
+
+        # Determine test result.
+        request, _ = transport.requests[-1]
+        self.assertEqual(exp_etag, request.headers['If-None-Match'])
+        self.assertEqual(exp_body, resp.content)
+
+    def test_pooled_adapter(self):
+        """When no transport is given, the session should use a
+        pooled, blocking HTTP adapter with the given pool sizes.
+        """
+        # Expected values.
+        exp_maxsize = 4
+        exp_block = True
+
+        # Run test.
+        session = cx.Session(pool_maxsize=exp_maxsize)
+
+        # Determine test result.
+        adapter = session._session.get_adapter('https://example.com')
+        self.assertIs(session.transport, adapter)
+        self.assertEqual(exp_maxsize, adapter._pool_maxsize)
+        self.assertEqual(exp_block, adapter._pool_block)
+
+    def test_shared_session(self):
+        """get_session() should return the same session until it is
+        replaced with set_session().
+        """
+        # Test data and state.
+        session = cx.Session(transport=Transport())
+
+        # Run test.
+        first = cx.get_session()
+        second = cx.get_session()
+        cx.set_session(session)
+        third = cx.get_session()
+
+        # Determine test result.
+        self.assertIs(first, second)
+        self.assertIs(session, third)
+
+
 class TokenTestCase(ut.TestCase):
     def setUp(self):
         """Create common test data and state."""
@@ -109,6 +974,22 @@ class TokenTestCase(ut.TestCase):
         # Determine if test passed.
         self.assertEqual(exp, act)
 
+    def test_aget(self):
+        """When awaited, the aget() method should return the value of
+        the secret as a string.
+        """
+        # Expected values.
+        exp = self.value
+
+        # Create specific test data and state.
+        token = cx.Token(self.service, self.user)
+
+        # Run test.
+        act = asyncio.run(token.aget())
+
+        # Determine if test passed.
+        self.assertEqual(exp, act)
+
     def test_get_secret_does_not_exist(self):
         """If the secret doesn't exist in the OS's secret store, get()
         should raise a connect.SecretDoesNotExist exception.
@@ -0,0 +1,306 @@
+"""
+test_export
+~~~~~~~~~~~
+
+Unit tests for the pjisocial.export module.
+"""
+from importlib.util import find_spec
+import json
+import os
+from tempfile import TemporaryDirectory
+import unittest as ut
+from unittest.mock import patch
+
+from pjisocial import connect as cx
+from pjisocial import export as ex
+from pjisocial import facebook as fb
+
+
+# Utility functions.
+def get_page(url, params, account=None):
+    """Return one of three pages of two posts, by the cursor."""
+    after = params.get('after')
+    n = 0 if after is None else int(after)
+    data = [
+        {
+            'id': str(i),
+            'created_time': '2021-01-01T00:00:00+0000',
+            'from': {'id': 'a', 'name': 'Spam'},
+            'shares': {'count': i},
+        }
+        for i in (n * 2, n * 2 + 1)
+    ]
+    return fb.Page(data, str(n), str(n + 1), n < 2)
+
+
+# Test cases.
+class ExportTestCase(ut.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        backend = cx.MemoryBackend({('token', 'u'): 'spam', })
+        self.token = cx.Token('token', 'u', backend=backend)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read_rows(self):
+        rows = []
+        for name in sorted(os.listdir(self.tmp.name)):
+            if name.startswith('part-'):
+                with open(os.path.join(self.tmp.name, name)) as fh:
+                    rows.extend(json.loads(line) for line in fh)
+        return rows
+
+    @patch('pjisocial.facebook._get_page', side_effect=get_page)
+    def test_export_ndjson(self, mock_get_page):
+        """Given an edge, export() should write its items as flattened
+        rows in parts of the chunk size and record that it finished.
+        """
+        # Expected values.
+        exp_ids = ['0', '1', '2', '3', '4', '5']
+        exp_row = {
+            'id': '0',
+            'created_time': '2021-01-01T00:00:00+0000',
+            'from.id': 'a',
+            'from.name': 'Spam',
+            'shares.count': 0,
+        }
+        exp_parts = ['part-00000.ndjson', 'part-00001.ndjson']
+
+        # Run test.
+        act = ex.export('/me/posts', self.token, self.tmp.name, chunk_rows=4)
+
+        # Determine test result.
+        rows = self.read_rows()
+        self.assertEqual(exp_ids, [row['id'] for row in rows])
+        self.assertEqual(exp_row, rows[0])
+        act_parts = sorted(
+            name for name in os.listdir(self.tmp.name)
+            if name.startswith('part-')
+        )
+        self.assertEqual(exp_parts, act_parts)
+        self.assertTrue(act.done)
+        self.assertEqual(6, act.rows)
+
+    def test_resume(self):
+        """When an export stops part way, running it again should
+        start after the last part written.
+        """
+        # Expected values.
+        exp_ids = ['0', '1', '2', '3', '4', '5']
+        exp_after = '1'
+
+        # Test data and state.
+        calls = []
+
+        def failing_get_page(url, params, account=None):
+            calls.append(params.get('after'))
+            if params.get('after') == '1' and len(calls) == 2:
+                raise fb.GraphError('Spam.')
+            return get_page(url, params, account)
+
+        # Run test.
+        with patch('pjisocial.facebook._get_page', failing_get_page):
+            with self.assertRaises(fb.GraphError):
+                ex.export('/me/posts', self.token, self.tmp.name,
+                          chunk_rows=2)
+            stopped = ex.Checkpoint.load(self.tmp.name)
+            calls.clear()
+            act = ex.export('/me/posts', self.token, self.tmp.name,
+                            chunk_rows=2)
+
+        # Determine test result.
+        self.assertEqual(exp_after, stopped.after)
+        self.assertFalse(stopped.done)
+        self.assertEqual(exp_after, calls[0])
+        self.assertEqual(exp_ids, [row['id'] for row in self.read_rows()])
+        self.assertTrue(act.done)
+
+    def test_resume_by_time(self):
+        """When an export of an edge paged by time stops part way,
+        running it again should start at the next page's query of the
+        last part written.
+        """
+        # Expected values.
+        exp_ids = ['0', '1', '2', '3', '4', '5']
+        exp_query = 'until=1'
+
+        # Test data and state.
+        calls = []
+
+        def get_page_by_time(url, params, account=None):
+            calls.append(params.get('until'))
+            if params.get('until') == '1' and len(calls) == 2:
+                raise fb.GraphError('Spam.')
+            page = get_page(url, {'after': params.get('until')}, account)
+            query = f'until={page.after}' if page.has_next else None
+            return fb.Page(page.data, None, None, page.has_next, query)
+
+        # Run test.
+        with patch('pjisocial.facebook._get_page', get_page_by_time):
+            with self.assertRaises(fb.GraphError):
+                ex.export('/me/feed', self.token, self.tmp.name,
+                          chunk_rows=2)
+            stopped = ex.Checkpoint.load(self.tmp.name)
+            calls.clear()
+            act = ex.export('/me/feed', self.token, self.tmp.name,
+                            chunk_rows=2)
+
+        # Determine test result.
+        self.assertEqual(exp_query, stopped.next_query)
+        self.assertEqual('1', calls[0])
+        self.assertEqual(exp_ids, [row['id'] for row in self.read_rows()])
+        self.assertTrue(act.done)
+
+    def test_other_export(self):
+        """When the directory holds an export of another edge, export()
+        should refuse to write to it.
+        """
+        # Expected values.
+        exp_ex = ValueError
+
+        # Test data and state.
+        ex.Checkpoint('/me/feed', 'ndjson').save(self.tmp.name)
+
+        # Run test and determine test result.
+        with self.assertRaises(exp_ex):
+            ex.export('/me/posts', self.token, self.tmp.name)
+
+    def test_export_columns(self):
+        """When a columnar export is written in several parts, each
+        part should be written with the types of the parts before it,
+        widened only where its values don't fit them, and the types
+        should be kept in the checkpoint.
+        """
+        # Expected values.
+        exp = [
+            {'id': 'string', 'score': 'null'},
+            {'id': 'string', 'score': 'int'},
+            {'id': 'string', 'score': 'float', 'name': 'string'},
+        ]
+
+        # Test data and state.
+        pages = [
+            [{'id': '0', 'score': None}, ],
+            [{'id': '1', 'score': 1}, ],
+            [{'id': '2', 'score': 1.5, 'name': 'Spam'}, ],
+        ]
+
+        def get_scores(url, params, account=None):
+            n = int(params.get('after') or 0)
+            return fb.Page(pages[n], str(n), str(n + 1), n < 2)
+
+        # Run test.
+        with patch('pjisocial.facebook._get_page', get_scores), \
+                patch('pjisocial.export._import_pyarrow'), \
+                patch('pjisocial.export.write_part') as mock_write:
+            ex.export('/me/posts', self.token, self.tmp.name,
+                      fmt='parquet', chunk_rows=1)
+        act = [dict(c[0][3]) for c in mock_write.call_args_list]
+        act_saved = ex.Checkpoint.load(self.tmp.name).columns
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+        self.assertEqual(exp[-1], act_saved)
+
+
+class ColumnTestCase(ut.TestCase):
+    def test_column_types(self):
+        """Given rows, column_types() should choose the narrowest type
+        that fits every value of each column.
+        """
+        # Expected values.
+        exp = {
+            'id': 'string',
+            'count': 'float',
+            'created_time': 'timestamp',
+            'hidden': 'bool',
+            'mixed': 'string',
+            'empty': 'null',
+        }
+
+        # Test data and state.
+        rows = [
+            {'id': '1', 'count': 1, 'created_time': None, 'hidden': True,
+             'mixed': 1, 'empty': None},
+            {'id': '2', 'count': 1.5,
+             'created_time': '2021-01-01T00:00:00+0000', 'hidden': False,
+             'mixed': 'spam'},
+        ]
+
+        # Run test.
+        act = ex.column_types(rows)
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+
+    def test_column_types_earlier(self):
+        """Given the types of earlier rows, column_types() should
+        keep them, filling in empty columns and widening the ones the
+        new values don't fit.
+        """
+        # Expected values.
+        exp = {
+            'id': 'string',
+            'count': 'float',
+            'empty': 'timestamp',
+            'hidden': 'bool',
+            'gone': 'int',
+        }
+
+        # Test data and state.
+        types = {'id': 'string', 'count': 'int', 'empty': 'null',
+                 'hidden': 'bool', 'gone': 'int'}
+        rows = [
+            {'id': '3', 'count': 2.5, 'hidden': None,
+             'empty': '2021-01-01T00:00:00+0000'},
+        ]
+
+        # Run test.
+        act = ex.column_types(rows, types)
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+
+    @ut.skipUnless(find_spec('pyarrow'), 'pyarrow is not installed.')
+    def test_write_parquet(self):
+        """Given rows, write_part() should write a typed Parquet
+        file.
+        """
+        from pyarrow import parquet
+
+        # Expected values.
+        exp_types = ['string', 'int64', 'timestamp[s, tz=UTC]']
+
+        # Test data and state.
+        rows = [
+            {'id': '1', 'count': 1, 'created_time': None},
+            {'id': '2', 'count': 2,
+             'created_time': '2021-01-01T00:00:00+0000'},
+        ]
+
+        # Run test.
+        with TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'part-00000.parquet')
+            ex.write_part(rows, filename, 'parquet')
+            table = parquet.read_table(filename)
+
+        # Determine test result.
+        self.assertEqual(exp_types, [str(t) for t in table.schema.types])
+        self.assertEqual(2, table.num_rows)
+
+    @ut.skipIf(find_spec('pyarrow'), 'pyarrow is installed.')
+    def test_columnar_needs_pyarrow(self):
+        """When pyarrow isn't installed, asking for Parquet files
+        should raise a RuntimeError before anything is fetched.
+        """
+        # Expected values.
+        exp_ex = RuntimeError
+
+        # Test data and state.
+        token = cx.Token('token', 'u', backend=cx.MemoryBackend())
+
+        # Run test and determine test result.
+        with TemporaryDirectory() as tmp:
+            with self.assertRaises(exp_ex):
+                ex.export('/me/posts', token, tmp, fmt='parquet')
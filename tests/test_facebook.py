@@ -4,9 +4,17 @@ test_facebook
 
 Unit tests for the pjisocial.facebook module.
 """
+import asyncio
+from datetime import datetime, timezone
 import json
+import os
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import threading
+import time
 import unittest as ut
-from unittest.mock import call, MagicMock, patch
+from unittest.mock import AsyncMock, call, MagicMock, patch
 
 import requests
 import keyring
@@ -26,7 +34,142 @@ def get_facebook_redirect(*args, **kwargs):
     requests.get(url, q, verify=False)
 
 
+def get_facebook_denied(*args, **kwargs):
+    """Call the redirect URI for Facebook as if the user denied the
+    login.
+    """
+    url = 'https://127.0.0.1:5002/facebook_login'
+    q = {
+        'error': 'access_denied',
+        'error_reason': 'user_denied',
+        'error_description': 'Permissions error.',
+        'state': 'eggs',
+    }
+    requests.get(url, q, verify=False)
+
+
 # Test cases.
+class BatchTestCase(ut.TestCase):
+    def setUp(self):
+        self.token_loc = '__test_facebook_BatchTestCase_token'
+        self.token_account = 'pjisocial'
+        keyring.set_password(self.token_loc, self.token_account, 'spam')
+        self.token = cx.Token(self.token_loc, self.token_account)
+
+    def tearDown(self):
+        keyring.delete_password(self.token_loc, self.token_account)
+
+    @staticmethod
+    def respond(url, data):
+        """Answer each batch item with its index in the batch."""
+        items = json.loads(data['batch'])
+        body = []
+        for item in items:
+            if item['relative_url'] == 'fail':
+                error = {'error': {'message': 'eggs', 'code': 100}}
+                body.append({'code': 400, 'body': json.dumps(error)})
+            else:
+                value = {'id': item['relative_url']}
+                body.append({'code': 200, 'body': json.dumps(value)})
+        resp = MagicMock()
+        resp.status_code = 200
+        resp.content = json.dumps(body).encode()
+        return resp
+
+    @patch('pjisocial.facebook.get_session')
+    def test_batch(self, mock_session):
+        """Given a list of calls, batch() should split them into
+        batches of no more than BATCH_SIZE and return the decoded
+        responses in the order of the calls.
+        """
+        # Expected values.
+        exp_posts = 3
+        exp_size = fb.BATCH_SIZE
+        exp = [{'id': str(i)} for i in range(120)]
+
+        # Test data and state.
+        mock_post = mock_session.return_value.post
+        mock_post.side_effect = self.respond
+        requests = [
+            {'method': 'GET', 'relative_url': str(i)}
+            for i in range(120)
+        ]
+
+        # Run test.
+        act = fb.batch(requests, self.token)
+
+        # Determine test result.
+        sizes = [
+            len(json.loads(c[0][1]['batch']))
+            for c in mock_post.call_args_list
+        ]
+        self.assertEqual(exp_posts, mock_post.call_count)
+        self.assertEqual(exp_size, max(sizes))
+        self.assertEqual(exp, act)
+
+    @patch('pjisocial.facebook.get_session')
+    def test_batch_item_error(self, mock_session):
+        """If a call in the batch fails, its result should be a
+        GraphError without affecting the other calls.
+        """
+        # Expected values.
+        exp_ok = {'id': 'spam'}
+        exp_msg = 'eggs'
+        exp_code = 100
+
+        # Test data and state.
+        mock_session.return_value.post.side_effect = self.respond
+        requests = [
+            {'method': 'GET', 'relative_url': 'spam'},
+            {'method': 'GET', 'relative_url': 'fail'},
+        ]
+
+        # Run test.
+        act_ok, act_err = fb.batch(requests, self.token)
+
+        # Determine test result.
+        self.assertEqual(exp_ok, act_ok)
+        self.assertIsInstance(act_err, fb.GraphError)
+        self.assertEqual(exp_msg, str(act_err))
+        self.assertEqual(exp_code, act_err.code)
+
+
+class ImportTestCase(ut.TestCase):
+    def test_import(self):
+        """When imported, pjisocial.facebook should not import the
+        modules only needed for logging in or serving, and it should
+        be imported within the time budget.
+        """
+        # Expected values.
+        exp_loaded = []
+        exp_budget = 1.0
+
+        # Test data and state.
+        code = (
+            'import sys\n'
+            'from time import perf_counter\n'
+            'start = perf_counter()\n'
+            'import pjisocial.facebook\n'
+            'print(perf_counter() - start)\n'
+            'heavy = (\n'
+            '    "cryptography", "flask", "multiprocessing",\n'
+            '    "sqlite3", "webbrowser", "webview", "werkzeug",\n'
+            ')\n'
+            'print(" ".join(m for m in heavy if m in sys.modules))\n'
+        )
+        cmd = [sys.executable, '-c', code]
+
+        # Run test.
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        elapsed, loaded = (result.stdout.split('\n') + ['', ''])[:2]
+        act_loaded = loaded.split()
+        act_elapsed = float(elapsed)
+
+        # Determine test result.
+        self.assertEqual(exp_loaded, act_loaded)
+        self.assertLess(act_elapsed, exp_budget)
+
+
 class LoginTestCase(ut.TestCase):
     def setUp(self):
         self.app_id_loc = '__test_facebook_LoginTestCase_app_id'
@@ -37,6 +180,15 @@ class LoginTestCase(ut.TestCase):
         fb.APP_ID_LOCATION = self.app_id_loc
         fb.APP_ID_ACCOUNT = self.app_id_account
 
+        # Keep the listener's certificate out of the home directory.
+        self.tmp = TemporaryDirectory()
+        cert_path = os.path.join(self.tmp.name, 'listener')
+        self.cert_patch = patch(
+            'pjisocial.httplistener.CERT_PATH',
+            cert_path
+        )
+        self.cert_patch.start()
+
         # Build test token values.
         keyring.set_password(
             self.app_id_loc,
@@ -48,6 +200,8 @@ class LoginTestCase(ut.TestCase):
         fb.APP_ID_LOCATION = self.app_id_loc_buffer
         fb.APP_ID_ACCOUNT = self.app_id_account_buffer
         keyring.delete_password(self.app_id_loc, self.app_id_account)
+        self.cert_patch.stop()
+        self.tmp.cleanup()
 
     @patch('secrets.token_urlsafe')
     @patch('webbrowser.open')
@@ -76,6 +230,72 @@ class LoginTestCase(ut.TestCase):
         self.assertEqual(exp_return, act_return)
         self.assertEqual(exp_url, act_url)
 
+    @patch('secrets.token_urlsafe')
+    @patch('webbrowser.open')
+    def test_alogin(self, mock_get, mock_secrets):
+        """When awaited with an app ID token, send a login request to
+        Facebook and return the code from the redirect.
+        """
+        # Expected values.
+        exp_url = ('https://www.facebook.com/v12.0/dialog/oauth?'
+                   f'client_id={self.app_id}&'
+                   f'redirect_uri=https://127.0.0.1:5002/facebook_login&'
+                   f'state=eggs')
+        exp_return = '_facebook_login_response'
+
+        # Test data and state.
+        mock_secrets.return_value = 'eggs'
+        mock_get.side_effect = get_facebook_redirect
+        token = cx.Token(self.app_id_loc, self.app_id_account)
+
+        # Run test.
+        act_return = asyncio.run(fb.alogin(token))
+
+        # Determine test result.
+        act_url = mock_get.call_args[0][0]
+        self.assertEqual(exp_return, act_return)
+        self.assertEqual(exp_url, act_url)
+
+    @patch('secrets.token_urlsafe')
+    @patch('webbrowser.open')
+    def test_login_denied(self, mock_get, mock_secrets):
+        """If the redirect carries an OAuth error instead of a code,
+        such as when the user denies the login, raise it as a
+        LoginError.
+        """
+        from pjisocial.httplistener import LoginError
+
+        # Expected value.
+        exp_ex = LoginError
+        exp_msg = 'Permissions error.'
+
+        # Test data and state.
+        mock_secrets.return_value = 'eggs'
+        mock_get.side_effect = get_facebook_denied
+        token = cx.Token(self.app_id_loc, self.app_id_account)
+
+        # Run test and determine result.
+        with self.assertRaisesRegex(exp_ex, exp_msg):
+            fb.login(token)
+
+    @patch('pjisocial.facebook.TIMEOUT', .1)
+    @patch('secrets.token_urlsafe')
+    @patch('webbrowser.open')
+    def test_login_timeout(self, mock_open, mock_secrets):
+        """If the login redirect isn't received before the timeout,
+        raise a LoginTimeout exception.
+        """
+        # Expected value.
+        exp_ex = fb.LoginTimeout
+
+        # Test data and state.
+        mock_secrets.return_value = 'eggs'
+        token = cx.Token(self.app_id_loc, self.app_id_account)
+
+        # Run test and determine result.
+        with self.assertRaises(exp_ex):
+            fb.login(token)
+
 
 class OauthTestCase(ut.TestCase):
     def setUp(self):
@@ -115,8 +335,8 @@ class OauthTestCase(ut.TestCase):
         keyring.delete_password(self.app_id_loc, self.app_id_account)
         keyring.delete_password(self.app_secret_loc, self.app_secret_account)
 
-    @patch('pjisocial.facebook.get')
-    def test_get_access_token(self, mock_get):
+    @patch('pjisocial.facebook.get_session')
+    def test_get_access_token(self, mock_session):
         """Given the app ID, the original login URI, the app secret,
         and the login code, call the oauth/access_token endpoint and
         return the response from Facebook.
@@ -139,7 +359,8 @@ class OauthTestCase(ut.TestCase):
 
         # Test data and state.
         resp = MagicMock()
-        resp.text = json.dumps(exp_resp)
+        resp.content = json.dumps(exp_resp).encode()
+        mock_get = mock_session.return_value.get
         mock_get.return_value = resp
         app_id = cx.Token(self.app_id_loc, self.app_id_account)
         redirect_uri = 'https://127.0.0.1:5002/facebook_login'
@@ -153,3 +374,942 @@ class OauthTestCase(ut.TestCase):
         act_call = mock_get.call_args
         self.assertEqual(exp_call, act_call)
         self.assertEqual(exp_resp, act_resp)
+
+    @patch('pjisocial.facebook.get_session')
+    def test_get_access_tokens(self, mock_session):
+        """Given several exchanges, get an access token for each,
+        returning the error for any exchange that fails without
+        affecting the others.
+        """
+        # Expected values.
+        exp_ok = [{'access_token': f'code_{i}', } for i in range(3)]
+        exp_graph = fb.GraphError
+        exp_secret = cx.SecretDoesNotExist
+
+        # Test data and state.
+        def respond(url, q):
+            resp = MagicMock()
+            resp.status_code = 200
+            if q['code'] == 'bad':
+                body = {'error': {'message': 'eggs', 'code': 100}}
+            else:
+                body = {'access_token': f'code_{q["code"]}', }
+            resp.content = json.dumps(body).encode()
+            return resp
+
+        mock_session.return_value.get.side_effect = respond
+        app_id = cx.Token(self.app_id_loc, self.app_id_account)
+        app_secret = cx.Token(self.app_secret_loc, self.app_secret_account)
+        missing = cx.Token('__test_facebook_missing_secret', 'pjisocial')
+        redirect_uri = 'https://127.0.0.1:5002/facebook_login'
+        exchanges = [
+            (app_id, redirect_uri, app_secret, str(i)) for i in range(3)
+        ]
+        exchanges.append((app_id, redirect_uri, app_secret, 'bad'))
+        exchanges.append((app_id, redirect_uri, missing, '4'))
+
+        # Run test.
+        act = fb.get_access_tokens(exchanges, workers=2)
+
+        # Determine test result.
+        self.assertEqual(exp_ok, act[:3])
+        self.assertIsInstance(act[3], exp_graph)
+        self.assertIsInstance(act[4], exp_secret)
+
+    @patch('pjisocial.facebook.get_session')
+    def test_get_access_tokens_warm(self, mock_session):
+        """When the secret cache is enabled, the secrets for all the
+        exchanges should be read in one Token.get_many() call before
+        the exchanges start.
+        """
+        # Expected value.
+        exp = [self.app_id, self.app_secret]
+
+        # Test data and state.
+        resp = MagicMock()
+        resp.status_code = 200
+        resp.content = b'{"access_token": "bacon"}'
+        mock_session.return_value.get.return_value = resp
+        app_id = cx.Token(self.app_id_loc, self.app_id_account)
+        app_secret = cx.Token(self.app_secret_loc, self.app_secret_account)
+        redirect_uri = 'https://127.0.0.1:5002/facebook_login'
+        exchanges = [
+            (app_id, redirect_uri, app_secret, str(i)) for i in range(3)
+        ]
+        get_many = cx.Token.get_many
+
+        # Run test.
+        cx.enable_cache()
+        try:
+            with patch.object(cx.Token, 'get_many',
+                              side_effect=get_many) as mock_get_many:
+                fb.get_access_tokens(exchanges, workers=2)
+
+        # Clean up.
+        finally:
+            cx.disable_cache()
+
+        # Determine test result.
+        act = mock_get_many.call_args_list[0][0][0]
+        self.assertEqual(exp, [token.get() for token in act])
+        self.assertEqual(2, len(act))
+
+    @patch('pjisocial.facebook.get_session')
+    def test_aget_access_token(self, mock_session):
+        """When awaited with the app ID, the original login URI, the
+        app secret, and the login code, call the oauth/access_token
+        endpoint and return the response from Facebook.
+        """
+        # Expected values.
+        exp_call = call(
+            'https://graph.facebook.com/v12.0/oauth/access_token',
+            {
+                'client_id': self.app_id,
+                'redirect_uri': 'https://127.0.0.1:5002/facebook_login',
+                'client_secret': self.app_secret,
+                'code': 'eggs',
+            },
+        )
+        exp_resp = {
+            'access_token': 'bacon',
+            'token_type': 'sausages',
+            'expires_in': 1000,
+        }
+
+        # Test data and state.
+        resp = MagicMock()
+        resp.content = json.dumps(exp_resp).encode()
+        mock_get = AsyncMock(return_value=resp)
+        mock_session.return_value.aget = mock_get
+        app_id = cx.Token(self.app_id_loc, self.app_id_account)
+        redirect_uri = 'https://127.0.0.1:5002/facebook_login'
+        app_secret = cx.Token(self.app_secret_loc, self.app_secret_account)
+        code = 'eggs'
+
+        # Run test.
+        act_resp = asyncio.run(fb.aget_access_token(
+            app_id,
+            redirect_uri,
+            app_secret,
+            code
+        ))
+
+        # Determine test result.
+        act_call = mock_get.call_args
+        self.assertEqual(exp_call, act_call)
+        self.assertEqual(exp_resp, act_resp)
+
+
+class QueryTestCase(ut.TestCase):
+    def test_build_query(self):
+        """Given fields, a limit, and a time window, build_query()
+        should return the parameters for a Graph API read.
+        """
+        # Expected value.
+        exp = {
+            'fields': 'id,message,comments{id,from{name}}',
+            'limit': 25,
+            'since': 1577836800,
+            'until': '2020-02-01',
+            'spam': 'eggs',
+        }
+
+        # Test data and state.
+        fields = ['id', 'message', {'comments': ['id', {'from': 'name'}]}]
+        since = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+        # Run test.
+        act = fb.build_query(fields, 25, since, '2020-02-01', spam='eggs')
+
+        # Determine test result.
+        self.assertDictEqual(exp, act)
+
+    def test_build_query_defaults(self):
+        """By default, build_query() should only ask for the ID."""
+        # Expected value.
+        exp = {'fields': 'id', }
+
+        # Run test.
+        act = fb.build_query()
+
+        # Determine test result.
+        self.assertDictEqual(exp, act)
+
+
+class ResponseTestCase(ut.TestCase):
+    def test_access_token_from_dict(self):
+        """Given a decoded access token response, build an
+        AccessToken.
+        """
+        # Expected value.
+        exp = fb.AccessToken('bacon', 'bearer', 1000)
+
+        # Test data and state.
+        body = {
+            'access_token': 'bacon',
+            'token_type': 'bearer',
+            'expires_in': 1000,
+        }
+
+        # Run test.
+        act = fb.AccessToken.from_dict(body)
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+        self.assertFalse(hasattr(act, '__dict__'))
+
+    def test_page_from_dict(self):
+        """Given a decoded page of an edge, build a Page."""
+        # Expected values.
+        exp = {
+            'data': [{'id': '1'}],
+            'before': 'a',
+            'after': 'b',
+            'has_next': True,
+        }
+
+        # Test data and state.
+        body = {
+            'data': [{'id': '1'}],
+            'paging': {
+                'cursors': {'before': 'a', 'after': 'b'},
+                'next': 'https://graph.facebook.com/spam',
+            },
+        }
+
+        # Run test.
+        page = fb.Page.from_dict(body)
+
+        # Determine test result.
+        act = {name: getattr(page, name) for name in exp}
+        self.assertDictEqual(exp, act)
+
+    def test_page_from_dict_by_time(self):
+        """Given a page of an edge paged by time, build a Page that
+        keeps the next page's query without the access token.
+        """
+        # Expected values.
+        exp_query = 'fields=id&until=300'
+        exp_params = {'fields': 'id', 'until': '300', }
+
+        # Test data and state.
+        body = {
+            'data': [{'id': '1'}],
+            'paging': {
+                'next': 'https://graph.facebook.com/v12.0/1/feed?'
+                        'access_token=spam&fields=id&until=300',
+            },
+        }
+
+        # Run test.
+        page = fb.Page.from_dict(body)
+
+        # Determine test result.
+        self.assertIsNone(page.after)
+        self.assertEqual(exp_query, page.next_query)
+        self.assertEqual(exp_params, page.next_params())
+
+
+class PaginateTestCase(ut.TestCase):
+    def setUp(self):
+        self.token_loc = '__test_facebook_PaginateTestCase_token'
+        self.token_account = 'pjisocial'
+        keyring.set_password(self.token_loc, self.token_account, 'spam')
+        self.token = cx.Token(self.token_loc, self.token_account)
+        self.pages = {
+            None: {
+                'data': [{'id': '1'}, {'id': '2'}],
+                'paging': {'cursors': {'after': 'a'}, 'next': 'x'},
+            },
+            'a': {
+                'data': [{'id': '3'}, {'id': '4'}],
+                'paging': {'cursors': {'after': 'b'}, 'next': 'x'},
+            },
+            'b': {
+                'data': [{'id': '5'}, ],
+                'paging': {'cursors': {'after': 'c'}},
+            },
+        }
+
+    def tearDown(self):
+        keyring.delete_password(self.token_loc, self.token_account)
+
+    def respond(self, url, params):
+        resp = MagicMock()
+        resp.status_code = 200
+        page = self.pages[params.get('after')]
+        resp.content = json.dumps(page).encode()
+        return resp
+
+    @patch('pjisocial.facebook.get_session')
+    def test_paginate(self, mock_session):
+        """Given an edge, paginate() should yield the items of every
+        page, following the after cursors until there is no next page.
+        """
+        # Expected values.
+        exp = [{'id': str(i)} for i in range(1, 6)]
+        exp_params = {
+            'access_token': 'spam',
+            'limit': 2,
+            'fields': 'id,message',
+        }
+
+        # Test data and state.
+        mock_get = mock_session.return_value.get
+        mock_get.side_effect = self.respond
+        gen = fb.paginate(
+            '/me/posts',
+            self.token,
+            fields=['id', 'message'],
+            limit=2
+        )
+
+        # Run test.
+        act = list(gen)
+
+        # Determine test result.
+        first_params = mock_get.call_args_list[0][0][1]
+        self.assertEqual(exp, act)
+        self.assertEqual(3, mock_get.call_count)
+        self.assertDictEqual(exp_params, first_params)
+
+    @patch('pjisocial.facebook.get_session')
+    def test_paginate_lazy(self, mock_session):
+        """Pages should not be fetched until the items before them
+        are being consumed.
+        """
+        # Expected value.
+        exp = 2
+
+        # Test data and state.
+        mock_get = mock_session.return_value.get
+        mock_get.side_effect = self.respond
+        gen = fb.paginate('/me/posts', self.token)
+
+        # Run test.
+        next(gen)
+        gen.close()
+
+        # Determine test result.
+        self.assertGreaterEqual(exp, mock_get.call_count)
+
+    @patch('pjisocial.facebook.get_session')
+    def test_paginate_error(self, mock_session):
+        """If Graph API returns an error, raise a GraphError."""
+        # Expected value.
+        exp_ex = fb.GraphError
+
+        # Test data and state.
+        resp = MagicMock()
+        resp.status_code = 400
+        body = {'error': {'message': 'x', 'code': 100}}
+        resp.content = json.dumps(body).encode()
+        mock_session.return_value.get.return_value = resp
+
+        # Run test and determine result.
+        with self.assertRaises(exp_ex):
+            list(fb.paginate('/me/posts', self.token))
+
+    @patch('pjisocial.facebook.get_session')
+    def test_paginate_by_time(self, mock_session):
+        """Given an edge paged by time, with no cursors, paginate()
+        should follow the next page URLs until there is no next page.
+        """
+        # Expected values.
+        exp = [{'id': str(i)} for i in range(1, 6)]
+        exp_params = [
+            {'access_token': 'spam', 'fields': 'id', 'limit': 2},
+            {'access_token': 'spam', 'fields': 'id', 'limit': '2',
+             'until': '300'},
+            {'access_token': 'spam', 'fields': 'id', 'limit': '2',
+             'until': '200'},
+        ]
+
+        # Test data and state.
+        base = 'https://graph.facebook.com/v12.0/1/feed?'
+        pages = {
+            None: {
+                'data': [{'id': '1'}, {'id': '2'}],
+                'paging': {
+                    'previous': f'{base}since=400',
+                    'next': f'{base}access_token=spam&fields=id&limit=2'
+                            '&until=300',
+                },
+            },
+            '300': {
+                'data': [{'id': '3'}, {'id': '4'}],
+                'paging': {
+                    'next': f'{base}access_token=spam&fields=id&limit=2'
+                            '&until=200',
+                },
+            },
+            '200': {'data': [{'id': '5'}, ], 'paging': {}, },
+        }
+
+        def respond(url, params):
+            resp = MagicMock()
+            resp.status_code = 200
+            resp.content = json.dumps(pages[params.get('until')]).encode()
+            return resp
+
+        mock_get = mock_session.return_value.get
+        mock_get.side_effect = respond
+
+        # Run test.
+        act = list(fb.paginate('/me/feed', self.token, limit=2))
+
+        # Determine test result.
+        act_params = [args[0][1] for args in mock_get.call_args_list]
+        self.assertEqual(exp, act)
+        self.assertEqual(exp_params, act_params)
+
+
+class RetryTestCase(ut.TestCase):
+    def setUp(self):
+        self.url = 'https://graph.facebook.com/v12.0/__RetryTestCase'
+        fb._breakers.pop(self.url, None)
+
+    def tearDown(self):
+        fb._breakers.pop(self.url, None)
+
+    @staticmethod
+    def response(status, headers=None):
+        resp = MagicMock()
+        resp.status_code = status
+        resp.headers = headers if headers else {}
+        return resp
+
+    def test_delay_retry_after(self):
+        """If the response has a Retry-After header, the delay should
+        be the value of the header.
+        """
+        # Expected value.
+        exp = 7
+
+        # Test data and state.
+        policy = fb.RetryPolicy()
+        headers = {'Retry-After': '7', }
+
+        # Run test.
+        act = policy.delay(0, headers)
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+
+    @patch('pjisocial.facebook.uniform')
+    def test_delay_backoff(self, mock_uniform):
+        """Without a Retry-After header, the delay should be a random
+        value up to the exponential backoff for the attempt, capped.
+        """
+        # Expected value.
+        exp = [call(0, 0.5), call(0, 2.0), call(0, 3)]
+
+        # Test data and state.
+        policy = fb.RetryPolicy(base=0.5, cap=3)
+
+        # Run test.
+        for attempt in (0, 2, 5):
+            policy.delay(attempt)
+
+        # Determine test result.
+        self.assertEqual(exp, mock_uniform.call_args_list)
+
+    @patch('pjisocial.facebook.sleep')
+    @patch('pjisocial.facebook.get_session')
+    def test_retry_then_succeed(self, mock_session, mock_sleep):
+        """If a call fails with a retryable status, it should be
+        retried until it succeeds.
+        """
+        # Expected values.
+        exp_calls = 3
+        exp_status = 200
+
+        # Test data and state.
+        mock_get = mock_session.return_value.get
+        mock_get.side_effect = [
+            self.response(503),
+            self.response(429, {'Retry-After': '1'}),
+            self.response(200),
+        ]
+
+        # Run test.
+        resp = fb._get(self.url, {})
+
+        # Determine test result.
+        self.assertEqual(exp_calls, mock_get.call_count)
+        self.assertEqual(exp_status, resp.status_code)
+        self.assertEqual(call(1), mock_sleep.call_args)
+
+    @patch('pjisocial.facebook.sleep')
+    @patch('pjisocial.facebook.get_session')
+    def test_circuit_open(self, mock_session, mock_sleep):
+        """After enough failures in a row, calls to the endpoint
+        should be refused without being made.
+        """
+        # Expected values.
+        exp_ex = fb.CircuitOpen
+        exp_calls = fb.BREAKER_THRESHOLD
+
+        # Test data and state.
+        mock_get = mock_session.return_value.get
+        mock_get.return_value = self.response(500)
+        for _ in range(fb.BREAKER_THRESHOLD):
+            fb._get(self.url, {})
+            if fb.get_breaker(self.url).is_open:
+                break
+
+        # Run test and determine result.
+        with self.assertRaises(exp_ex):
+            fb._get(self.url, {})
+        self.assertEqual(exp_calls, mock_get.call_count)
+
+    @patch('pjisocial.facebook.get_session')
+    def test_hedge_returns_first(self, mock_session):
+        """When a call is hedged, it should return as soon as the
+        faster of the two calls does, without waiting for the slow
+        one.
+        """
+        # Expected values.
+        exp_status = 200
+        exp_max = 1.0
+
+        # Test data and state.
+        release = threading.Event()
+        responses = iter([None, self.response(200)])
+
+        def get(url, params):
+            resp = next(responses)
+            if resp is None:
+                release.wait(5)
+                return self.response(500)
+            return resp
+
+        mock_session.return_value.get.side_effect = get
+        policy = fb.RetryPolicy(hedge_after=.05)
+
+        # Run test.
+        with patch('pjisocial.facebook.retry_policy', policy):
+            start = time.monotonic()
+            try:
+                resp = fb._get(self.url, {})
+                act_elapsed = time.monotonic() - start
+
+            # Clean up.
+            finally:
+                release.set()
+
+        # Determine test result.
+        self.assertEqual(exp_status, resp.status_code)
+        self.assertLess(act_elapsed, exp_max)
+
+    @patch('pjisocial.facebook.sleep')
+    @patch('pjisocial.facebook.get_session')
+    def test_not_idempotent(self, mock_session, mock_sleep):
+        """Calls that aren't idempotent, such as exchanging a code,
+        should be made once, with no retry or hedge.
+        """
+        # Expected value.
+        exp_calls = 1
+        exp_status = 503
+
+        # Test data and state.
+        mock_get = mock_session.return_value.get
+        mock_get.return_value = self.response(503)
+        policy = fb.RetryPolicy(hedge_after=0)
+
+        # Run test.
+        with patch('pjisocial.facebook.retry_policy', policy):
+            resp = fb._get(self.url, {}, idempotent=False)
+
+        # Determine test result.
+        self.assertEqual(exp_calls, mock_get.call_count)
+        self.assertEqual(exp_status, resp.status_code)
+
+
+class SchedulerTestCase(ut.TestCase):
+    @patch('pjisocial.facebook.monotonic')
+    def test_reserve(self, mock_time):
+        """Once the burst is used, calls should be spaced at the rate
+        of the scheduler.
+        """
+        # Expected values.
+        exp = [0, 0, 0.5, 1.0]
+
+        # Test data and state.
+        mock_time.return_value = 100
+        scheduler = fb.Scheduler(rate=2, burst=2)
+
+        # Run test.
+        act = [scheduler.reserve() for _ in range(4)]
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+
+    def test_update_slows_rate(self):
+        """When usage is over the threshold, the rate should be scaled
+        down as usage nears the limit.
+        """
+        # Expected values.
+        exp_app = 5
+        exp_account = 2
+
+        # Test data and state.
+        scheduler = fb.Scheduler(rate=10, threshold=80)
+        headers = {
+            'X-App-Usage': json.dumps({
+                'call_count': 90,
+                'total_cputime': 10,
+                'total_time': 10,
+            }),
+            'X-Business-Use-Case-Usage': json.dumps({
+                'spam': [{
+                    'type': 'pages',
+                    'call_count': 96,
+                    'total_cputime': 10,
+                    'total_time': 10,
+                    'estimated_time_to_regain_access': 0,
+                }],
+            }),
+        }
+
+        # Run test.
+        scheduler.update(headers)
+
+        # Determine test result.
+        self.assertAlmostEqual(exp_app, scheduler.app.rate)
+        self.assertAlmostEqual(exp_account, scheduler.accounts['spam'].rate)
+
+    @patch('pjisocial.facebook.monotonic')
+    def test_update_throttled(self, mock_time):
+        """When an account is at its limit, its calls should be held
+        until Graph API says access is regained.
+        """
+        # Expected value.
+        exp = 300
+
+        # Test data and state.
+        mock_time.return_value = 100
+        scheduler = fb.Scheduler()
+        headers = {
+            'X-Business-Use-Case-Usage': json.dumps({
+                'spam': [{
+                    'type': 'pages',
+                    'call_count': 100,
+                    'estimated_time_to_regain_access': 5,
+                }],
+            }),
+        }
+
+        # Run test.
+        scheduler.update(headers)
+        act = scheduler.reserve('spam')
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+
+    def test_update_bad_headers(self):
+        """When the usage headers can't be read, update() should log
+        them and leave the pace as it was.
+        """
+        # Expected values.
+        exp_rate = 10
+        exp_accounts = {}
+
+        # Test data and state.
+        scheduler = fb.Scheduler(rate=10)
+        headers = {
+            'X-App-Usage': '{"call_count": ',
+            'X-Business-Use-Case-Usage': '["spam"]',
+        }
+
+        # Run test.
+        with self.assertLogs('pjisocial.facebook') as cm:
+            scheduler.update(headers)
+
+        # Determine test result.
+        self.assertEqual(exp_rate, scheduler.app.rate)
+        self.assertEqual(exp_accounts, scheduler.accounts)
+        self.assertEqual(2, len(cm.records))
+
+
+class SyncTestCase(ut.TestCase):
+    def setUp(self):
+        backend = cx.MemoryBackend({('token', 'u'): 'spam', })
+        self.token = cx.Token('token', 'u', backend=backend)
+        self.state = fb.SyncState(':memory:')
+        self.posts = [self.post(i) for i in (5, 4, 3, 2, 1)]
+        self.calls = []
+
+    def tearDown(self):
+        self.state.close()
+
+    def post(self, i):
+        when = datetime.fromtimestamp(1_600_000_000 + i * 1000, timezone.utc)
+        created_time = when.strftime('%Y-%m-%dT%H:%M:%S%z')
+        return {'id': str(i), 'created_time': created_time}
+
+    def get_page(self, url, params, account=None):
+        """Serve the posts newest first, two to a page."""
+        self.calls.append(dict(params))
+        since = params.get('since')
+        posts = [
+            post for post in self.posts
+            if since is None
+            or fb._parse_graph_time(post['created_time']) >= since
+        ]
+        start = int(params.get('after', 0))
+        end = start + 2
+        return fb.Page(posts[start:end], None, str(end), end < len(posts))
+
+    def test_sync(self):
+        """The first sync should return the whole edge. The next sync
+        should only ask for items after the high-water mark, less the
+        overlap, and skip the items it already returned.
+        """
+        # Expected values.
+        exp_first = ['5', '4', '3', '2', '1']
+        exp_second = ['7', '6']
+        exp_since = 1_600_005_000 - fb.SYNC_OVERLAP
+
+        # Test data and state.
+        gen = fb.sync('/me/posts', self.token, self.state)
+
+        # Run test.
+        with patch('pjisocial.facebook._get_page', self.get_page):
+            act_first = [item['id'] for item in gen]
+            self.posts = [self.post(7), self.post(6)] + self.posts
+            self.calls.clear()
+            gen = fb.sync('/me/posts', self.token, self.state)
+            act_second = [item['id'] for item in gen]
+
+        # Determine test result.
+        self.assertEqual(exp_first, act_first)
+        self.assertEqual(exp_second, act_second)
+        self.assertEqual(exp_since, self.calls[0]['since'])
+        since, after, _, _ = self.state.get('', '/me/posts')
+        self.assertEqual(1_600_007_000, since)
+        self.assertIsNone(after)
+
+    def test_resume(self):
+        """When a sync stops part way, the next sync should continue
+        from the cursor of the last page that was consumed.
+        """
+        # Expected values.
+        exp_first = ['5', '4', '3']
+        exp_second = ['3', '2', '1']
+        exp_after = '2'
+
+        # Test data and state.
+        gen = fb.sync('/me/posts', self.token, self.state)
+
+        # Run test.
+        with patch('pjisocial.facebook._get_page', self.get_page):
+            act_first = [next(gen)['id'] for _ in range(3)]
+            gen.close()
+            self.calls.clear()
+            gen = fb.sync('/me/posts', self.token, self.state)
+            act_second = [item['id'] for item in gen]
+
+        # Determine test result.
+        self.assertEqual(exp_first, act_first)
+        self.assertEqual(exp_after, self.calls[0]['after'])
+        self.assertEqual(exp_second, act_second)
+
+    @patch('pjisocial.facebook.time')
+    def test_prune_without_time(self, mock_time):
+        """Objects returned without a time should be stored with the
+        time they were recorded, so they are pruned once syncs get
+        past it.
+        """
+        # Expected values.
+        exp_first = {'old'}
+        exp_second = {'old', 'new'}
+
+        # Test data and state.
+        mock_time.return_value = 1000
+        self.state.record('', '/me/posts', [('old', None)], None, None)
+        mock_time.return_value = 2000
+        self.state.record('', '/me/posts', [('new', None)], None, None)
+
+        # Run test.
+        self.state.prune('', '/me/posts', 1500)
+        act_first = self.state.unseen('', '/me/posts', ['old', 'new'])
+        self.state.prune('', '/me/posts', 2500)
+        act_second = self.state.unseen('', '/me/posts', ['old', 'new'])
+
+        # Determine test result.
+        self.assertEqual(exp_first, act_first)
+        self.assertEqual(exp_second, act_second)
+
+    def test_prune_existing_without_time(self):
+        """Objects stored without a time by an older version should
+        be given the time the database is opened, so they can be
+        pruned.
+        """
+        # Expected value.
+        exp = {'old'}
+
+        # Test data and state.
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sync.db')
+            with fb.SyncState(path) as state:
+                state._db.execute(
+                    "INSERT INTO seen VALUES ('', '/me/posts', 'old', NULL)"
+                )
+                state._db.commit()
+
+            # Run test.
+            with fb.SyncState(path) as state:
+                state.prune('', '/me/posts', fb.time() + 1)
+                act = state.unseen('', '/me/posts', ['old'])
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+
+
+class TokenManagerTestCase(ut.TestCase):
+    def setUp(self):
+        self.app_id = cx.Token('__test_facebook_TokenManager_id', 'x')
+        self.app_secret = cx.Token('__test_facebook_TokenManager_sec', 'x')
+        self.account = '__test_facebook_TokenManagerTestCase'
+        self.manager = fb.TokenManager(
+            self.app_id,
+            self.app_secret,
+            self.account
+        )
+
+    def tearDown(self):
+        self.manager.stop()
+        loc = fb.ACCESS_TOKEN_LOCATION
+        if keyring.get_password(loc, self.account):
+            keyring.delete_password(loc, self.account)
+
+    @patch('pjisocial.facebook.time')
+    def test_set_and_get(self, mock_time):
+        """Given an access token response, the token should be stored
+        so that it can be read by a new manager.
+        """
+        # Expected values.
+        exp_value = 'spam'
+        exp_expires = 1100
+
+        # Test data and state.
+        mock_time.return_value = 1000
+        resp = {'access_token': exp_value, 'expires_in': 100, }
+
+        # Run test.
+        self.manager.set(resp)
+        manager = fb.TokenManager(self.app_id, self.app_secret, self.account)
+
+        # Determine test result.
+        self.assertEqual(exp_value, manager.get())
+        self.assertEqual(exp_expires, manager.expires)
+
+    @patch('pjisocial.facebook.time')
+    def test_get_expired(self, mock_time):
+        """If the stored token has expired, get() should raise a
+        TokenExpired exception.
+        """
+        # Expected value.
+        exp_ex = fb.TokenExpired
+
+        # Test data and state.
+        mock_time.return_value = 1000
+        self.manager.set({'access_token': 'spam', 'expires_in': 100, })
+        mock_time.return_value = 1100
+
+        # Run test and determine result.
+        with self.assertRaises(exp_ex):
+            self.manager.get()
+
+    @patch('pjisocial.facebook.Timer')
+    @patch('pjisocial.facebook.time')
+    def test_start(self, mock_time, mock_timer):
+        """When started, the manager should schedule a refresh for
+        refresh_margin seconds before the token expires.
+        """
+        # Expected value.
+        exp_delay = 5000 - fb.REFRESH_MARGIN
+
+        # Test data and state.
+        mock_time.return_value = 1000
+        self.manager.set({'access_token': 'spam', 'expires_in': 5000, })
+
+        # Run test.
+        self.manager.start()
+
+        # Determine test result.
+        act_delay = mock_timer.call_args[0][0]
+        self.assertEqual(exp_delay, act_delay)
+        mock_timer.return_value.start.assert_called_once()
+
+    @patch('pjisocial.facebook.exchange_token')
+    def test_refresh(self, mock_exchange):
+        """When refreshed, the current token should be exchanged for a
+        long-lived token and the new token stored.
+        """
+        # Expected values.
+        exp_call = call(self.app_id, self.app_secret, 'spam')
+        exp_value = 'eggs'
+
+        # Test data and state.
+        mock_exchange.return_value = {
+            'access_token': exp_value,
+            'expires_in': 5184000,
+        }
+        self.manager.set({'access_token': 'spam', 'expires_in': 100, })
+
+        # Run test.
+        self.manager.refresh()
+
+        # Determine test result.
+        self.assertEqual(exp_call, mock_exchange.call_args)
+        self.assertEqual(exp_value, self.manager.get())
+
+    @patch('pjisocial.facebook.Timer')
+    @patch('pjisocial.facebook.exchange_token')
+    def test_refresh_failure(self, mock_exchange, mock_timer):
+        """When a background refresh fails with any error, the failure
+        should be logged and the refresh tried again, backing off
+        while it keeps failing.
+        """
+        # Expected values.
+        exp_delays = [fb.REFRESH_RETRY, fb.REFRESH_RETRY * 2]
+
+        # Test data and state.
+        mock_exchange.side_effect = cx.SecretDoesNotExist('spam')
+        self.manager.set({'access_token': 'spam', 'expires_in': 5000, })
+
+        # Run test.
+        with self.assertLogs('pjisocial.facebook') as cm:
+            self.manager._refresh_in_background()
+            self.manager._refresh_in_background()
+
+        # Determine test result.
+        act_delays = [args[0][0] for args in mock_timer.call_args_list]
+        self.assertEqual(exp_delays, act_delays)
+        self.assertEqual(2, len(cm.records))
+
+    @patch('pjisocial.facebook.Timer')
+    @patch('pjisocial.facebook.exchange_token')
+    def test_stop_during_failure(self, mock_exchange, mock_timer):
+        """When the manager is stopped while a background refresh is
+        failing, the failed refresh shouldn't schedule another.
+        """
+        # Test data and state.
+        def stop_and_fail(*args):
+            self.manager.stop()
+            raise fb.GraphError('Spam.')
+
+        mock_exchange.side_effect = stop_and_fail
+        self.manager.set({'access_token': 'spam', 'expires_in': 5000, })
+        self.manager.start()
+        mock_timer.reset_mock()
+
+        # Run test.
+        with self.assertLogs('pjisocial.facebook'):
+            self.manager._refresh_in_background()
+
+        # Determine test result.
+        mock_timer.assert_not_called()
+        self.assertIsNone(self.manager._timer)
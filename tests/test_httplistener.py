@@ -4,43 +4,128 @@ test_httplistener
 
 Unit tests for the pjisocial.httplistener module.
 """
-import multiprocessing as mp
+import hashlib
+import hmac
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from threading import Thread
 from time import sleep
 import unittest as ut
 from unittest.mock import patch
 
 from requests import get
+from requests.exceptions import ConnectionError
+import urllib3
 
+from pjisocial import connect as cx
 from pjisocial import httplistener as hl
+from pjisocial import metrics
 
 
-# Configuration.
-mp.set_start_method('fork')
+# Test cases.
+class ListenerTestCase(ut.TestCase):
+    def setUp(self):
+        urllib3.disable_warnings()
+        self.tmp = TemporaryDirectory()
+        self.base_path = os.path.join(self.tmp.name, 'cert', 'listener')
+        ssl_context = hl.get_ssl_context(self.base_path)
+        self.listener = hl.Listener('127.0.0.1', 5003, ssl_context)
+        self.listener.start()
+
+    def tearDown(self):
+        self.listener.stop()
+        self.tmp.cleanup()
+
+    def test_get_ssl_context_cached(self):
+        """Once created, the certificate should be reused rather than
+        generated again.
+        """
+        # Expected value.
+        exp_paths = (f'{self.base_path}.crt', f'{self.base_path}.key')
+
+        # Test data and state.
+        mtime = os.path.getmtime(exp_paths[0])
+
+        # Run test.
+        target = 'pjisocial.httplistener.generate_adhoc_ssl_pair'
+        with patch(target) as mock_dev:
+            act_paths = hl.get_ssl_context(self.base_path)
+
+        # Determine test result.
+        self.assertEqual(exp_paths, act_paths)
+        mock_dev.assert_not_called()
+        self.assertEqual(mtime, os.path.getmtime(exp_paths[0]))
+
+    def test_get_ssl_context_renew(self):
+        """When the cached certificate is about to expire, a new one
+        should be created, with the key only readable by the user.
+        """
+        # Expected value.
+        exp_mode = 0o600
+
+        # Test data and state.
+        cert, key = (f'{self.base_path}.crt', f'{self.base_path}.key')
+        with open(cert, 'rb') as fh:
+            old_cert = fh.read()
+
+        # Run test.
+        with patch('pjisocial.httplistener.CERT_RENEW_MARGIN', 400 * 86400):
+            hl.get_ssl_context(self.base_path)
+        with open(cert, 'rb') as fh:
+            act_cert = fh.read()
+
+        # Determine test result.
+        self.assertNotEqual(old_cert, act_cert)
+        self.assertEqual(exp_mode, os.stat(key).st_mode & 0o777)
+
+    def test_route_by_state(self):
+        """When several logins are waiting, each redirect should be
+        routed to the login with the matching state.
+        """
+        # Expected values.
+        exp = {'spam': 'code_spam', 'eggs': 'code_eggs', }
+
+        # Test data and state.
+        flows = {state: self.listener.register(state) for state in exp}
+        url = self.listener.redirect_uri
+
+        # Run test.
+        threads = [
+            Thread(target=get, args=(url, {'state': s, 'code': c}),
+                   kwargs={'verify': False})
+            for s, c in exp.items()
+        ]
+        for thread in threads:
+            thread.start()
+        act = {state: flows[state].result(timeout=5) for state in exp}
+        for thread in threads:
+            thread.join()
+
+        # Determine test result.
+        self.assertDictEqual(exp, act)
 
 
-# Test cases.
 class HttpListenerTestCase(ut.TestCase):
     def setUp(self):
         self.protocol = 'http'
         self.fqdn = '127.0.0.1'
         self.port = '5001'
 
-        # Start the flask server for testing.
-        kwargs = {
-            'port': self.port,
-        }
-        self.P = hl.ctx.Process(target=hl.app.run, kwargs=kwargs)
-        self.P.start()
-
-        # Give the server time to stand up.
-        sleep(.01)
+        # Start the flask server for testing. The server is bound
+        # before the thread starts, so there is no need to wait for it.
+        self.server = hl.make_server(self.fqdn, self.port, threaded=True)
+        self.T = Thread(target=self.server.serve_forever)
+        self.T.start()
 
     def tearDown(self):
-        if self.P.is_alive():
-            self.P.terminate()
-        sleep(.05)
-        if self.P.is_alive():
-            self.P.kill()
+        self.server.shutdown()
+        self.server.server_close()
+        self.T.join()
 
     def test_health(self):
         """When /health is called, the server should return OK."""
@@ -61,8 +146,7 @@ class HttpListenerTestCase(ut.TestCase):
         self.assertEqual(exp_code, act_code)
         self.assertEqual(exp_body, act_body)
 
-    @patch('secrets.token_urlsafe')
-    def test_facebook_login(self, mock_secrets):
+    def test_facebook_login(self):
         """When /facebook_login is called with the code parameter,
         the server should return the value of code to the application
         that started the server.
@@ -71,7 +155,7 @@ class HttpListenerTestCase(ut.TestCase):
         exp = 'spam'
 
         # Test data and state.
-        mock_secrets.return_value = 'eggs'
+        flow = hl.flows.register('eggs')
         path = '/facebook_login'
         url = f'{self.protocol}://{self.fqdn}:{self.port}{path}'
         query = {
@@ -81,7 +165,402 @@ class HttpListenerTestCase(ut.TestCase):
 
         # Run test.
         _ = get(url, query)
-        act = hl.queue.get()
+        act = flow.result(timeout=5)
 
         # Determine test results.
         self.assertEqual(exp, act)
+
+    def test_facebook_login_bad_state(self):
+        """When /facebook_login is called with a state no login is
+        waiting for, the server should return forbidden and not pass
+        the code to any login.
+        """
+        # Expected values.
+        exp_code = 403
+        exp_done = False
+
+        # Test data and state.
+        flow = hl.flows.register('eggs')
+        path = '/facebook_login'
+        url = f'{self.protocol}://{self.fqdn}:{self.port}{path}'
+        query = {
+            'code': 'spam',
+            'state': 'bacon'
+        }
+
+        # Run test.
+        try:
+            resp = get(url, query)
+            act_done = flow.done()
+
+        # Clean up.
+        finally:
+            hl.flows.unregister('eggs')
+
+        # Determine test results.
+        self.assertEqual(exp_code, resp.status_code)
+        self.assertEqual(exp_done, act_done)
+
+
+class FlowRegistryTestCase(ut.TestCase):
+    @patch('pjisocial.httplistener.monotonic')
+    def test_expire(self, mock_time):
+        """Logins that have waited longer than the TTL should be
+        dropped and their futures cancelled.
+        """
+        # Expected values.
+        exp_count = 1
+        exp_resolved = False
+
+        # Test data and state.
+        mock_time.return_value = 100
+        registry = hl.FlowRegistry(ttl=10)
+        flow = registry.register('spam')
+        registry.register('eggs')
+        mock_time.return_value = 105
+        registry.register('bacon')
+        registry.unregister('eggs')
+        mock_time.return_value = 111
+
+        # Run test.
+        act_count = registry.expire()
+
+        # Determine test result.
+        self.assertEqual(exp_count, act_count)
+        self.assertTrue(flow.cancelled())
+        self.assertEqual(exp_resolved, registry.resolve('spam', 'code'))
+        self.assertIn('bacon', registry)
+
+    def test_resolve(self):
+        """Given a registered state and a code, resolve() should pass
+        the code to that login only.
+        """
+        # Expected value.
+        exp = 'code_spam'
+
+        # Test data and state.
+        registry = hl.FlowRegistry()
+        spam = registry.register('spam')
+        eggs = registry.register('eggs')
+
+        # Run test.
+        result = registry.resolve('spam', exp)
+
+        # Determine test result.
+        self.assertTrue(result)
+        self.assertEqual(exp, spam.result(timeout=0))
+        self.assertFalse(eggs.done())
+        self.assertNotIn('spam', registry)
+
+    def test_reject(self):
+        """Given a registered state and an exception, reject() should
+        fail that login with the exception.
+        """
+        # Expected value.
+        exp_ex = hl.LoginError
+
+        # Test data and state.
+        registry = hl.FlowRegistry()
+        spam = registry.register('spam')
+
+        # Run test.
+        result = registry.reject('spam', hl.LoginError('Denied.'))
+        act_unknown = registry.reject('eggs', hl.LoginError('Denied.'))
+
+        # Determine test result.
+        self.assertTrue(result)
+        self.assertFalse(act_unknown)
+        with self.assertRaises(exp_ex):
+            spam.result(timeout=0)
+        self.assertNotIn('spam', registry)
+
+
+class MetricsTestCase(ut.TestCase):
+    def tearDown(self):
+        metrics.set_sink(None)
+
+    def test_metrics(self):
+        """When metrics are kept by a PrometheusSink, /metrics should
+        return them in the Prometheus text format. Otherwise it should
+        not be found.
+        """
+        # Expected values.
+        exp_code = 200
+        exp_line = b'pjisocial_login_redirects_total{result="forbidden"} 1'
+
+        # Test data and state.
+        client = hl.app.test_client()
+        metrics.set_sink(None)
+        missing = client.get('/metrics')
+        metrics.set_sink(metrics.PrometheusSink())
+
+        # Run test.
+        client.get('/facebook_login', query_string={'state': 'spam'})
+        resp = client.get('/metrics')
+
+        # Determine test result.
+        self.assertEqual(404, missing.status_code)
+        self.assertEqual(exp_code, resp.status_code)
+        self.assertIn(exp_line, resp.data.split(b'\n'))
+
+
+class ServeTestCase(ut.TestCase):
+    def test_pooled_server(self):
+        """A PooledWSGIServer should handle concurrent requests with
+        its worker threads.
+        """
+        # Expected value.
+        exp = ['OK' for _ in range(6)]
+
+        # Test data and state.
+        server = hl.PooledWSGIServer('127.0.0.1', 5004, hl.app, workers=2)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        url = 'http://127.0.0.1:5004/health'
+        act = []
+
+        # Run test.
+        try:
+            threads = [
+                Thread(target=lambda: act.append(get(url).text))
+                for _ in range(6)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        # Clean up.
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+
+    @patch('pjisocial.httplistener.REQUEST_TIMEOUT', 5)
+    def test_pooled_server_idle_tls_client(self):
+        """A client that connects to a TLS PooledWSGIServer and never
+        starts the handshake shouldn't hold up other requests.
+        """
+        # Expected value.
+        exp = 'OK'
+
+        # Test data and state.
+        urllib3.disable_warnings()
+        with TemporaryDirectory() as tmp:
+            ssl_context = hl.get_ssl_context(os.path.join(tmp, 'listener'))
+            server = hl.PooledWSGIServer(
+                '127.0.0.1',
+                5006,
+                hl.app,
+                workers=2,
+                ssl_context=ssl_context
+            )
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        idle = socket.create_connection(('127.0.0.1', 5006))
+
+        # Run test.
+        try:
+            act = get(
+                'https://127.0.0.1:5006/health',
+                verify=False,
+                timeout=2
+            ).text
+
+        # Clean up.
+        finally:
+            idle.close()
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+
+    def test_parse_args_cert_without_key(self):
+        """If a certificate is given without a key, exit with an
+        error.
+        """
+        # Expected value.
+        exp_ex = SystemExit
+
+        # Run test and determine result.
+        with patch('sys.stderr'), self.assertRaises(exp_ex):
+            hl.parse_args(['--cert', 'spam.crt'])
+
+    def test_serve_graceful_shutdown(self):
+        """When run from the command line, the listener should serve
+        requests until sent SIGTERM and then exit cleanly.
+        """
+        # Expected values.
+        exp_body = 'OK'
+        exp_code = 0
+
+        # Test data and state.
+        cmd = [
+            sys.executable,
+            '-m',
+            'pjisocial.httplistener',
+            '--port',
+            '5005',
+        ]
+        P = subprocess.Popen(cmd)
+        url = 'http://127.0.0.1:5005/health'
+
+        # Run test.
+        try:
+            for _ in range(100):
+                try:
+                    act_body = get(url).text
+                    break
+                except ConnectionError:
+                    sleep(.05)
+            P.send_signal(signal.SIGTERM)
+            act_code = P.wait(timeout=10)
+
+        # Clean up.
+        finally:
+            if P.poll() is None:
+                P.kill()
+
+        # Determine test result.
+        self.assertEqual(exp_body, act_body)
+        self.assertEqual(exp_code, act_code)
+
+
+class WebhookTestCase(ut.TestCase):
+    def setUp(self):
+        self.secret = 'spam'
+        backend = cx.MemoryBackend({
+            ('app_secret', 'u'): self.secret,
+            ('verify_token', 'u'): 'eggs',
+        })
+        self.received = []
+        self.processor = hl.WebhookProcessor(
+            self.received.append,
+            cx.Token('app_secret', 'u', backend=backend),
+            cx.Token('verify_token', 'u', backend=backend)
+        )
+        hl.set_webhooks(self.processor)
+        self.client = hl.app.test_client()
+
+    def tearDown(self):
+        hl.set_webhooks(None)
+
+    def sign(self, body):
+        key = self.secret.encode()
+        digest = hmac.new(key, body, hashlib.sha256).hexdigest()
+        return f'sha256={digest}'
+
+    def test_challenge(self):
+        """When the subscription is verified with the right token,
+        the challenge should be returned.
+        """
+        # Expected values.
+        exp_code = 200
+        exp_body = b'bacon'
+
+        # Test data and state.
+        query = {
+            'hub.mode': 'subscribe',
+            'hub.verify_token': 'eggs',
+            'hub.challenge': 'bacon',
+        }
+
+        # Run test.
+        resp = self.client.get('/webhook', query_string=query)
+        bad = self.client.get('/webhook', query_string={
+            **query,
+            'hub.verify_token': 'tomato'
+        })
+
+        # Determine test result.
+        self.assertEqual(exp_code, resp.status_code)
+        self.assertEqual(exp_body, resp.data)
+        self.assertEqual(403, bad.status_code)
+
+    def test_payload(self):
+        """A signed payload should be acknowledged and handed to the
+        handler, and an unsigned one refused.
+        """
+        # Expected values.
+        exp = [{'object': 'page', 'entry': []}]
+        exp_code = 200
+        exp_bad_code = 403
+
+        # Test data and state.
+        body = json.dumps(exp[0]).encode()
+        headers = {'X-Hub-Signature-256': self.sign(body), }
+        bad_headers = {'X-Hub-Signature-256': 'sha256=00', }
+
+        # Run test.
+        resp = self.client.post('/webhook', data=body, headers=headers)
+        bad = self.client.post('/webhook', data=body, headers=bad_headers)
+        self.processor.queue.join()
+
+        # Determine test result.
+        self.assertEqual(exp_code, resp.status_code)
+        self.assertEqual(exp_bad_code, bad.status_code)
+        self.assertEqual(exp, self.received)
+
+    def test_non_ascii(self):
+        """A verify token or signature that isn't ASCII should be
+        refused rather than cause an error.
+        """
+        # Expected value.
+        exp = [403, 403]
+
+        # Test data and state.
+        query = {
+            'hub.mode': 'subscribe',
+            'hub.verify_token': 'eggs\u00e9',
+            'hub.challenge': 'bacon',
+        }
+        body = b'{}'
+        headers = {'X-Hub-Signature-256': 'sha256=\u00e9', }
+
+        # Run test.
+        act = [
+            self.client.get('/webhook', query_string=query).status_code,
+            self.client.post(
+                '/webhook',
+                data=body,
+                headers=headers
+            ).status_code,
+        ]
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+
+    @patch('pjisocial.httplistener.WEBHOOK_PUT_TIMEOUT', .01)
+    def test_backpressure(self):
+        """When the queue is full, payloads should be refused with
+        a 503 so Facebook delivers them again later.
+        """
+        # Expected value.
+        exp = [200, 503]
+
+        # Test data and state.
+        hl.set_webhooks(None)
+        processor = hl.WebhookProcessor(
+            self.received.append,
+            self.processor.app_secret,
+            self.processor.verify_token,
+            maxsize=1,
+            workers=0
+        )
+        hl.set_webhooks(processor)
+        body = b'{}'
+        headers = {'X-Hub-Signature-256': self.sign(body), }
+
+        # Run test.
+        act = [
+            self.client.post('/webhook', data=body, headers=headers)
+            for _ in range(2)
+        ]
+
+        # Determine test result.
+        self.assertEqual(exp, [resp.status_code for resp in act])
@@ -0,0 +1,214 @@
+"""
+test_metrics
+~~~~~~~~~~~~
+
+Unit tests for the pjisocial.metrics module.
+"""
+import logging
+import unittest as ut
+from unittest.mock import MagicMock
+
+from pjisocial import metrics
+
+
+# Utility classes.
+class RecordingSink(metrics.Sink):
+    """A sink that keeps every metric it is sent."""
+    def __init__(self):
+        self.counts = []
+        self.observations = []
+
+    def count(self, name, value, labels):
+        self.counts.append((name, value, dict(labels)))
+
+    def observe(self, name, value, labels):
+        self.observations.append((name, value, dict(labels)))
+
+
+# Test cases.
+class HookTestCase(ut.TestCase):
+    def tearDown(self):
+        metrics.set_sink(None)
+
+    def test_disabled(self):
+        """When no sink is set, the hooks should record nothing and
+        span() should return the shared no-op span.
+        """
+        # Expected values.
+        exp = metrics._NULL_SPAN
+
+        # Test data and state.
+        metrics.set_sink(None)
+
+        # Run test.
+        metrics.count('spam')
+        metrics.observe('spam', 1)
+        act = metrics.span('spam', eggs='bacon')
+
+        # Determine test result.
+        self.assertIs(exp, act)
+        with act:
+            pass
+
+    def test_count_and_observe(self):
+        """When a sink is set, count() and observe() should pass the
+        metric and its labels to the sink.
+        """
+        # Expected values.
+        exp_counts = [('spam', 1, {'eggs': 'bacon'}), ]
+        exp_observations = [('spam', 0.5, {}), ]
+
+        # Test data and state.
+        sink = RecordingSink()
+        metrics.set_sink(sink)
+
+        # Run test.
+        metrics.count('spam', eggs='bacon')
+        metrics.observe('spam', 0.5)
+
+        # Determine test result.
+        self.assertEqual(exp_counts, sink.counts)
+        self.assertEqual(exp_observations, sink.observations)
+
+    def test_reserved_labels(self):
+        """Labels named 'name' or 'value' should be passed to the sink
+        as labels rather than clash with the hooks' arguments.
+        """
+        # Expected values.
+        exp_counts = [('spam', 2, {'name': 'eggs', 'value': 'bacon'}), ]
+        exp_observations = [('spam', 0.5, {'value': 'bacon'}), ]
+
+        # Test data and state.
+        sink = RecordingSink()
+        metrics.set_sink(sink)
+
+        # Run test.
+        metrics.count('spam', 2, name='eggs', value='bacon')
+        metrics.observe('spam', 0.5, value='bacon')
+
+        # Determine test result.
+        self.assertEqual(exp_counts, sink.counts)
+        self.assertEqual(exp_observations, sink.observations)
+
+    def test_span(self):
+        """When a sink is set, a span should record its duration and
+        count the error when one is raised in it.
+        """
+        # Expected values.
+        exp_names = ['spam.seconds', 'spam.seconds']
+        exp_counts = [('spam.errors', 1, {'eggs': 'bacon'}), ]
+
+        # Test data and state.
+        sink = RecordingSink()
+        metrics.set_sink(sink)
+
+        # Run test.
+        with metrics.span('spam', eggs='bacon'):
+            pass
+        with self.assertRaises(ValueError):
+            with metrics.span('spam', eggs='bacon'):
+                raise ValueError('tomato')
+
+        # Determine test result.
+        act_names = [name for name, _, _ in sink.observations]
+        self.assertEqual(exp_names, act_names)
+        self.assertTrue(all(value >= 0 for _, value, _ in sink.observations))
+        self.assertEqual(exp_counts, sink.counts)
+
+    def test_endpoint(self):
+        """Given a Graph API URL, endpoint() should return its path
+        with the object IDs replaced.
+        """
+        # Expected values.
+        exp = '/v12.0/{id}/posts'
+
+        # Test data and state.
+        url = 'https://graph.facebook.com/v12.0/123_456/posts?limit=1'
+
+        # Run test.
+        act = metrics.endpoint(url)
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+
+
+class SinkTestCase(ut.TestCase):
+    def test_logging(self):
+        """A LoggingSink should log each metric at its level."""
+        # Expected values.
+        exp = ["spam +1 {'eggs': 'bacon'}", "spam 0.500000 {}"]
+
+        # Test data and state.
+        logger = logging.getLogger('test_metrics')
+        sink = metrics.LoggingSink(logger, logging.INFO)
+
+        # Run test.
+        with self.assertLogs(logger, logging.INFO) as cm:
+            sink.count('spam', 1, {'eggs': 'bacon'})
+            sink.observe('spam', 0.5, {})
+
+        # Determine test result.
+        act = [record.getMessage() for record in cm.records]
+        self.assertEqual(exp, act)
+
+    def test_prometheus(self):
+        """A PrometheusSink should total the counters and histograms
+        and render them in the Prometheus text format.
+        """
+        # Expected values.
+        exp = (
+            '# TYPE pjisocial_http_responses_total counter\n'
+            'pjisocial_http_responses_total{status="200"} 2\n'
+            'pjisocial_http_responses_total{status="500"} 1\n'
+            '# TYPE pjisocial_http_request_seconds histogram\n'
+            'pjisocial_http_request_seconds_bucket{le="0.1"} 1\n'
+            'pjisocial_http_request_seconds_bucket{le="1"} 2\n'
+            'pjisocial_http_request_seconds_bucket{le="+Inf"} 3\n'
+            'pjisocial_http_request_seconds_sum 3.55\n'
+            'pjisocial_http_request_seconds_count 3\n'
+        )
+
+        # Test data and state.
+        sink = metrics.PrometheusSink(buckets=(1, 0.1))
+
+        # Run test.
+        sink.count('http.responses', 1, {'status': '200'})
+        sink.count('http.responses', 1, {'status': '500'})
+        sink.count('http.responses', 1, {'status': '200'})
+        for value in (0.05, 0.5, 3):
+            sink.observe('http.request.seconds', value, {})
+        act = sink.render()
+
+        # Determine test result.
+        self.assertEqual(exp, act)
+
+    def test_opentelemetry(self):
+        """An OpenTelemetrySink should run spans in the tracer and send
+        the counters and histograms to instruments from the meter.
+        """
+        # Expected values.
+        exp_span = 'spam'
+        exp_attributes = {'eggs': 'bacon'}
+
+        # Test data and state.
+        tracer = MagicMock()
+        meter = MagicMock()
+        sink = metrics.OpenTelemetrySink(tracer, meter)
+
+        # Run test.
+        with sink.span('spam', {'eggs': 'bacon'}):
+            pass
+        sink.count('spam', 1, {'eggs': 'bacon'})
+
+        # Determine test result.
+        tracer.start_as_current_span.assert_called_once_with(
+            exp_span,
+            attributes=exp_attributes
+        )
+        meter.create_histogram.assert_called_once_with(
+            'pjisocial.spam.seconds'
+        )
+        meter.create_counter.return_value.add.assert_called_once_with(
+            1,
+            attributes=exp_attributes
+        )
@@ -0,0 +1,129 @@
+"""
+test_workers
+~~~~~~~~~~~~
+
+Unit tests for the pjisocial.workers module.
+"""
+import json
+import unittest as ut
+
+from pjisocial import connect as cx
+from pjisocial import workers as wk
+
+
+# Utility functions.
+def get_decoder(body):
+    """Return the name of the decoder used in the worker."""
+    return cx.decoder_name
+
+
+# Test cases.
+class ProcessPoolTestCase(ut.TestCase):
+    def setUp(self):
+        self.bodies = [
+            json.dumps({
+                'data': [
+                    {'id': f'{i}_{j}', 'from': {'id': str(i)}}
+                    for j in range(3)
+                ],
+            }).encode()
+            for i in range(10)
+        ]
+
+    def test_map(self):
+        """Given response bodies, map() should return the result for
+        each body in order, whether the batches are pickled or passed
+        through shared memory.
+        """
+        # Expected values.
+        exp = [wk.flatten_page(body) for body in self.bodies]
+
+        # Test data and state.
+        pickled = wk.ProcessPool(wk.flatten_page, workers=2, batch_size=3)
+        shared = wk.ProcessPool(
+            wk.flatten_page,
+            workers=2,
+            batch_size=3,
+            threshold=0
+        )
+
+        # Run test.
+        with pickled, shared:
+            act_pickled = list(pickled.map(self.bodies))
+            act_shared = list(shared.map(self.bodies))
+
+        # Determine test result.
+        self.assertEqual(exp, act_pickled)
+        self.assertEqual(exp, act_shared)
+
+    def test_map_error(self):
+        """When a body can't be processed, map() should raise the error
+        from the worker.
+        """
+        # Expected values.
+        exp_ex = ValueError
+
+        # Test data and state.
+        bodies = [*self.bodies, b'spam']
+
+        # Run test and determine test result.
+        with wk.ProcessPool(wk.flatten_page, workers=2, threshold=0) as pool:
+            with self.assertRaises(exp_ex):
+                list(pool.map(bodies))
+
+    def test_map_decoder(self):
+        """The workers should decode with the decoder chosen with
+        set_decoder() in this process, whether the batches are pickled
+        or passed through shared memory.
+        """
+        # Expected values.
+        exp = ['json' for _ in self.bodies]
+
+        # Test data and state.
+        saved = cx.decoder_name
+        cx.set_decoder('json')
+        pickled = wk.ProcessPool(get_decoder, workers=1)
+        shared = wk.ProcessPool(get_decoder, workers=1, threshold=0)
+
+        # Run test.
+        try:
+            with pickled, shared:
+                act_pickled = list(pickled.map(self.bodies))
+                act_shared = list(shared.map(self.bodies))
+
+        # Clean up.
+        finally:
+            cx.set_decoder(saved)
+
+        # Determine test result.
+        self.assertEqual(exp, act_pickled)
+        self.assertEqual(exp, act_shared)
+
+
+class DecodeTestCase(ut.TestCase):
+    def setUp(self):
+        self.saved = cx.decoder_name
+
+    def tearDown(self):
+        cx.set_decoder(self.saved)
+
+    def test_decode_body(self):
+        """Given a memoryview of a body, decode_body() should decode it
+        with whichever decoder is set.
+        """
+        # Expected values.
+        exp = {'data': [{'id': '1'}, ]}
+
+        # Test data and state.
+        view = memoryview(b'{"data": [{"id": "1"}]}')
+
+        # Run test.
+        act = {}
+        for name in cx.DECODERS:
+            with self.subTest(decoder=name):
+                cx.set_decoder(name)
+                act[name] = wk.decode_body(view)
+
+        # Determine test result.
+        for name in cx.DECODERS:
+            self.assertEqual(exp, act[name])